@@ -0,0 +1,384 @@
+"""
+asyncio client for the ComfyUI HTTP API and its /ws event stream.
+
+AsyncComfyClient covers the endpoints the worker talks to: /prompt, /history,
+/queue, /view, /upload/image, /object_info, /interrupt, /free and /system_stats.
+Every request runs under one semaphore per client, so a job that fans out uploads
+or output fetches cannot open more than max_concurrency connections at once. All
+calls are coroutines and can be cancelled; a cancelled request releases its
+connection and slot immediately.
+
+aiohttp sessions are bound to the event loop that created them, so get_client()
+keeps one client per (event loop, host). Synchronous code goes through ComfyClient,
+a thin facade that runs the same coroutines on a shared background loop:
+
+    comfy_client.ComfyClient("127.0.0.1:8188").history(prompt_id)
+"""
+
+import asyncio
+import atexit
+import inspect
+import json
+import logging
+import threading
+import urllib.parse
+import weakref
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger("worker-comfyui.comfy_client")
+
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_TIMEOUT_S = 30
+VIEW_TIMEOUT_S = 60
+VIEW_CHUNK_SIZE = 1 << 20
+
+
+class ComfyClientError(Exception):
+    """A request to ComfyUI failed: connection error, timeout or closed event stream."""
+
+
+class ComfyHTTPError(ComfyClientError):
+    """ComfyUI answered with an HTTP error status. The response body is kept in .text."""
+
+    def __init__(self, method, path, status, text):
+        super().__init__(f"{status} error for {method} {path}: {text[:500]}")
+        self.status = status
+        self.text = text
+
+
+class ComfyConnectionClosed(ComfyClientError):
+    """The /ws event stream is not connected or was closed by the server."""
+
+
+def _aiohttp():
+    # Imported on first use: aiohttp adds ~100 ms to worker start-up
+    import aiohttp
+
+    return aiohttp
+
+
+class EventStream:
+    """
+    The /ws event stream of one client ID.
+
+    receive() returns decoded JSON messages as dicts and binary frames (images sent
+    by SaveImageWebsocket) as bytes. After a ComfyConnectionClosed the stream can
+    be connected again with connect().
+    """
+
+    def __init__(self, client, client_id, trace=False):
+        self.client = client
+        self.client_id = client_id
+        self.trace = trace
+        self._ws = None
+
+    @property
+    def url(self):
+        return f"ws://{self.client.host}/ws?clientId={self.client_id}"
+
+    @property
+    def connected(self):
+        return self._ws is not None and not self._ws.closed
+
+    async def connect(self, timeout_s=10):
+        aiohttp = _aiohttp()
+        await self.close()
+        try:
+            # max_msg_size=0: binary image frames are routinely larger than 4 MB
+            self._ws = await asyncio.wait_for(
+                self.client._get_session().ws_connect(self.url, max_msg_size=0),
+                timeout_s,
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            raise ComfyConnectionClosed(f"Could not connect to {self.url}: {e!r}") from e
+        return self
+
+    async def receive(self, timeout_s=None):
+        """
+        Wait for the next message.
+
+        Returns:
+            dict for a JSON text frame, bytes for a binary frame, or None if nothing
+            arrived within timeout_s.
+
+        Raises:
+            ComfyConnectionClosed: The stream is closed.
+            json.JSONDecodeError: A text frame was not valid JSON.
+        """
+        aiohttp = _aiohttp()
+        if not self.connected:
+            raise ComfyConnectionClosed("Event stream is not connected")
+        try:
+            message = await self._ws.receive(timeout=timeout_s)
+        except asyncio.TimeoutError:
+            return None
+        if message.type == aiohttp.WSMsgType.TEXT:
+            if self.trace:
+                logger.debug(f"ws <- {message.data[:2000]}")
+            return json.loads(message.data)
+        if message.type == aiohttp.WSMsgType.BINARY:
+            if self.trace:
+                logger.debug(f"ws <- binary frame, {len(message.data)} bytes")
+            return message.data
+        raise ComfyConnectionClosed(
+            f"Event stream closed ({message.type.name}, {self._ws.exception() or message.extra})"
+        )
+
+    async def close(self):
+        if self._ws is not None:
+            ws, self._ws = self._ws, None
+            await ws.close()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class AsyncComfyClient:
+    """
+    Coroutine API for one ComfyUI server.
+
+    Args:
+        host (str): "host:port" of the ComfyUI server.
+        max_concurrency (int): Maximum number of HTTP requests in flight.
+        timeout_s (float): Default total timeout of one request.
+    """
+
+    def __init__(self, host, max_concurrency=DEFAULT_MAX_CONCURRENCY, timeout_s=DEFAULT_TIMEOUT_S):
+        self.host = host
+        self.base_url = f"http://{host}"
+        self.max_concurrency = max_concurrency
+        self.timeout_s = timeout_s
+        self._limit = asyncio.Semaphore(max_concurrency)
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            aiohttp = _aiohttp()
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency * 2),
+            )
+        return self._session
+
+    @asynccontextmanager
+    async def _request(self, method, path, timeout_s=None, **kwargs):
+        """Send one request under the concurrency limit and yield the response."""
+        aiohttp = _aiohttp()
+        timeout = aiohttp.ClientTimeout(total=timeout_s or self.timeout_s)
+        async with self._limit:
+            try:
+                async with self._get_session().request(
+                    method, self.base_url + path, timeout=timeout, **kwargs
+                ) as response:
+                    if response.status >= 400:
+                        text = await response.text(errors="replace")
+                        raise ComfyHTTPError(method, path, response.status, text)
+                    yield response
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise ComfyClientError(f"{method} {path} failed: {e!r}") from e
+
+    async def _json(self, method, path, **kwargs):
+        async with self._request(method, path, **kwargs) as response:
+            return await response.json(content_type=None)
+
+    async def server_status(self):
+        """Return {"reachable": bool, "status_code" or "error": ...} for the HTTP root."""
+        try:
+            async with self._request("GET", "/", timeout_s=5) as response:
+                return {"reachable": response.status == 200, "status_code": response.status}
+        except ComfyHTTPError as e:
+            return {"reachable": False, "status_code": e.status}
+        except ComfyClientError as e:
+            return {"reachable": False, "error": str(e)}
+
+    async def wait_ready(self, retries=500, interval_s=0.05):
+        """Poll the HTTP root until it answers 200. Returns False after `retries` failures."""
+        for _ in range(retries):
+            if (await self.server_status())["reachable"]:
+                return True
+            await asyncio.sleep(interval_s)
+        return False
+
+    async def prompt(self, workflow, client_id, extra_data=None, front=False):
+        """Queue a workflow; returns the /prompt response ({"prompt_id", "number", ...})."""
+        payload = {"prompt": workflow, "client_id": client_id}
+        if extra_data:
+            payload["extra_data"] = extra_data
+        if front:
+            payload["front"] = True
+        return await self._json("POST", "/prompt", json=payload)
+
+    async def history(self, prompt_id=None):
+        return await self._json("GET", f"/history/{prompt_id}" if prompt_id else "/history")
+
+    async def delete_history(self, prompt_ids):
+        await self._json("POST", "/history", json={"delete": list(prompt_ids)}, timeout_s=10)
+
+    async def queue(self):
+        return await self._json("GET", "/queue")
+
+    async def delete_queued(self, prompt_ids):
+        """Remove pending prompts from the queue (running prompts are not affected)."""
+        await self._json("POST", "/queue", json={"delete": list(prompt_ids)}, timeout_s=10)
+
+    async def interrupt(self, prompt_id=None):
+        """Interrupt execution; with a prompt_id only if that prompt is the one running."""
+        await self._json(
+            "POST", "/interrupt", json={"prompt_id": prompt_id} if prompt_id else {}, timeout_s=10
+        )
+
+    async def cancel_prompt(self, prompt_id):
+        """Drop a prompt whether it is still pending or already running."""
+        await self.delete_queued([prompt_id])
+        await self.interrupt(prompt_id)
+
+    async def free(self, unload_models=False, free_memory=False):
+        await self._json(
+            "POST", "/free", json={"unload_models": unload_models, "free_memory": free_memory}
+        )
+
+    async def system_stats(self):
+        return await self._json("GET", "/system_stats", timeout_s=10)
+
+    async def object_info(self, node_class=None):
+        return await self._json(
+            "GET", f"/object_info/{node_class}" if node_class else "/object_info", timeout_s=10
+        )
+
+    async def upload_image(self, name, data, subfolder=None, overwrite=True, content_type="image/png"):
+        """
+        Upload an input image through /upload/image.
+
+        Args:
+            name (str): Filename in the input directory.
+            data (bytes or file-like): Image content; file objects are streamed.
+            subfolder (str, optional): Subfolder of the input directory.
+        """
+        form = _aiohttp().FormData()
+        form.add_field("image", data, filename=name, content_type=content_type)
+        form.add_field("overwrite", "true" if overwrite else "false")
+        if subfolder:
+            form.add_field("subfolder", subfolder)
+        return await self._json("POST", "/upload/image", data=form)
+
+    async def iter_view(self, filename, subfolder, folder_type, chunk_size=VIEW_CHUNK_SIZE):
+        """Stream a file from /view in chunks of at most chunk_size bytes."""
+        query = urllib.parse.urlencode(
+            {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        )
+        async with self._request("GET", f"/view?{query}", timeout_s=VIEW_TIMEOUT_S) as response:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+
+    async def view(self, filename, subfolder, folder_type):
+        """Return the bytes of a file from /view."""
+        query = urllib.parse.urlencode(
+            {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        )
+        async with self._request("GET", f"/view?{query}", timeout_s=VIEW_TIMEOUT_S) as response:
+            return await response.read()
+
+    def events(self, client_id, trace=False):
+        """Return the (not yet connected) /ws EventStream for client_id."""
+        return EventStream(self, client_id, trace=trace)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+# event loop -> {(host, max_concurrency): AsyncComfyClient}
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client(host, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """Return the AsyncComfyClient for host on the running event loop, creating it once."""
+    loop = asyncio.get_running_loop()
+    clients = _clients.setdefault(loop, {})
+    key = (host, max_concurrency)
+    if key not in clients:
+        clients[key] = AsyncComfyClient(host, max_concurrency)
+    return clients[key]
+
+
+async def close_clients():
+    """Close the sessions of all clients created on the running event loop."""
+    for client in _clients.pop(asyncio.get_running_loop(), {}).values():
+        await client.close()
+
+
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+
+
+def _background_loop():
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(
+                target=_loop.run_forever, name="comfy-client-loop", daemon=True
+            )
+            _loop_thread.start()
+            atexit.register(_close_background_clients)
+    return _loop
+
+
+def _close_background_clients():
+    try:
+        asyncio.run_coroutine_threadsafe(close_clients(), _loop).result(2)
+    except Exception:
+        pass
+
+
+def run_sync(coro, timeout_s=None):
+    """
+    Run a coroutine on the shared background event loop and wait for its result.
+
+    If the caller stops waiting (timeout, KeyboardInterrupt) the coroutine is
+    cancelled. Must not be called from the background loop itself; code running
+    there awaits the coroutine directly.
+    """
+    loop = _background_loop()
+    if threading.current_thread() is _loop_thread:
+        coro.close()
+        raise RuntimeError("run_sync() called from the client event loop; await the coroutine instead")
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return future.result(timeout_s)
+    except BaseException:
+        future.cancel()
+        raise
+
+
+class ComfyClient:
+    """
+    Blocking facade over AsyncComfyClient.
+
+    Every coroutine method of AsyncComfyClient is available as a plain method that
+    runs on the shared background loop, e.g. ComfyClient(host).history(prompt_id).
+    """
+
+    def __init__(self, host, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.host = host
+        self.max_concurrency = max_concurrency
+
+    def __getattr__(self, name):
+        method = getattr(AsyncComfyClient, name, None)
+        if name.startswith("_") or not inspect.iscoroutinefunction(method):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            async def run():
+                client = get_client(self.host, self.max_concurrency)
+                return await getattr(client, name)(*args, **kwargs)
+
+            return run_sync(run())
+
+        call.__name__ = name
+        call.__doc__ = method.__doc__
+        return call
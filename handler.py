@@ -1,21 +1,41 @@
-import runpod
-from runpod.serverless.utils import rp_upload
-import json
-import urllib.request
-import urllib.parse
 import time
+
+# Start of module import, for the STARTUP_REPORT
+_IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import json
+import importlib
 import os
-import requests
 import base64
-from io import BytesIO
-import websocket
+import gzip
+import bisect
+import http.server
+from contextlib import contextmanager
 import uuid
+import hashlib
+import mimetypes
+import random
 import tempfile
-import socket
-import traceback
 import logging
+import collections
+import contextvars
+import copy
+import itertools
+import queue
 import sys
+import re
+import shutil
+import glob
+import threading
+import tracemalloc
 import warnings
+import multiprocessing
+import concurrent.futures
+import atexit
+
+import comfy_client
+import media_transcode
 
 # CRITICAL: Configure numba BEFORE importing any modules that use numba
 # Numba's SSA block analysis and other debug logs can be very verbose
@@ -30,22 +50,193 @@ os.environ.setdefault('NUMBA_DEBUG_BACKEND', '0')
 os.environ.setdefault('NUMBA_DISABLE_PERFORMANCE_WARNINGS', '1')
 os.environ.setdefault('NUMBA_LOG_LEVEL', 'ERROR')
 
-# Set AWS region for S3 uploads (if BUCKET_ENDPOINT_URL is set)
-# RunPod S3 requires correct region configuration
-# Extract region from BUCKET_ENDPOINT_URL if it contains region info
-bucket_endpoint = os.environ.get("BUCKET_ENDPOINT_URL", "")
-if bucket_endpoint:
-    # Try to extract region from endpoint URL
+# ---------------------------------------------------------------------------
+# Structured logging
+# ---------------------------------------------------------------------------
+# Log records are queued by the caller and written by a background thread, one write()
+# and one flush() per batch of up to LOG_BATCH_SIZE records, so logging does no blocking
+# I/O on the job path. LOG_FORMAT is "json" (one object per line) or "text".
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", 256))
+# Bound on queued records; emitting blocks (rather than dropping lines) when it is full
+LOG_QUEUE_SIZE = 10000
+
+# Fields (job_id, prompt_id) of the job being handled, added to every record it logs
+_log_context = contextvars.ContextVar("worker_comfyui_log_context", default={})
+
+
+@contextmanager
+def log_context(**fields):
+    """Add fields to every record logged inside the block (restored on exit)."""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+def bind_log_context(**fields):
+    """Add fields to the current log context, e.g. prompt_id once ComfyUI assigned it."""
+    _log_context.set({**_log_context.get(), **fields})
+
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as one JSON object: time, level, logger, message, context, fields."""
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "context", None) or {})
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable variant of JsonFormatter for local development."""
+
+    def format(self, record):
+        line = f"{record.name} - {record.levelname} - {record.getMessage()}"
+        extra = {**(getattr(record, "context", None) or {}), **(getattr(record, "fields", None) or {})}
+        if extra:
+            line += " " + " ".join(f"{k}={v}" for k, v in extra.items())
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    Queue-backed logging handler.
+
+    emit() resolves the message, context and traceback in the calling thread and
+    enqueues the record; a daemon thread formats queued records and writes each
+    batch with a single write() and flush().
+    """
+
+    def __init__(self, stream=None, batch_size=LOG_BATCH_SIZE, max_queue=LOG_QUEUE_SIZE):
+        super().__init__()
+        self.stream = stream if stream is not None else sys.stdout
+        self.batch_size = max(1, batch_size)
+        self.queue = queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            record.context = _log_context.get()
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put(record)
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for record in batch:
+                try:
+                    lines.append(self.format(record))
+                except Exception:
+                    self.handleError(record)
+            try:
+                if lines:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+            except Exception:
+                pass
+            for _ in batch:
+                self.queue.task_done()
+
+    def flush(self):
+        """Block until every queued record has been written."""
+        if self._thread.is_alive():
+            self.queue.join()
+
+
+def configure_logging():
+    """Attach the async handler to the worker logger (once) and silence numba's loggers."""
+    worker_logger = logging.getLogger("worker-comfyui")
+    handler = next((h for h in worker_logger.handlers if isinstance(h, AsyncLogHandler)), None)
+    if handler is None:
+        handler = AsyncLogHandler()
+        handler.setFormatter(TextFormatter() if LOG_FORMAT == "text" else JsonFormatter())
+        worker_logger.addHandler(handler)
+    worker_logger.setLevel(LOG_LEVEL)
+    # runpod configures a plain root handler; don't let our records be printed twice
+    worker_logger.propagate = False
+    # numba's debug and type-inference records are dropped at the source: the level
+    # filters them before a record is created, and nothing propagates to the root
+    numba_logger = logging.getLogger("numba")
+    numba_logger.setLevel(logging.CRITICAL)
+    numba_logger.propagate = False
+    return handler
+
+
+configure_logging()
+logger = logging.getLogger("worker-comfyui")
+
+class _LazyModule:
+    """Module proxy that imports the real module on first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+# runpod (and boto3 behind rp_upload) take seconds to import and are only needed to
+# start the worker loop and for S3 uploads; init_worker() imports them as a timed step
+runpod = _LazyModule("runpod")
+rp_upload = _LazyModule("runpod.serverless.utils.rp_upload")
+# requests is only used to download input images from URLs (and by check_server); the
+# transcode pool's spawned children re-import this module and never need it
+requests = _LazyModule("requests")
+
+
+def detect_s3_region():
+    """
+    Set AWS region for S3 uploads (if BUCKET_ENDPOINT_URL is set).
+
+    RunPod S3 requires correct region configuration, so the region is extracted from
+    BUCKET_ENDPOINT_URL if it contains region info. Must run before the first S3 client
+    is created.
+    """
+    bucket_endpoint = os.environ.get("BUCKET_ENDPOINT_URL", "")
+    if not bucket_endpoint:
+        return
     # Examples:
     # - https://s3api-eu-ro-1.runpod.io/bucket-name -> eu-ro-1
     # - https://bucket.s3.us-east-1.amazonaws.com -> us-east-1
-    import re
     region_match = re.search(r's3api-([a-z0-9-]+)\.runpod\.io', bucket_endpoint)
     if region_match:
         aws_region = region_match.group(1)
         os.environ['AWS_DEFAULT_REGION'] = aws_region
         os.environ['AWS_REGION'] = aws_region
-        print(f"worker-comfyui: Detected S3 region from endpoint: {aws_region}")
+        logger.info(f"Detected S3 region from endpoint: {aws_region}")
     elif 's3.' in bucket_endpoint and 'amazonaws.com' in bucket_endpoint:
         # AWS S3 format: https://bucket.s3.region.amazonaws.com
         region_match = re.search(r's3\.([a-z0-9-]+)\.amazonaws\.com', bucket_endpoint)
@@ -53,105 +244,56 @@ if bucket_endpoint:
             aws_region = region_match.group(1)
             os.environ['AWS_DEFAULT_REGION'] = aws_region
             os.environ['AWS_REGION'] = aws_region
-            print(f"worker-comfyui: Detected AWS S3 region from endpoint: {aws_region}")
+            logger.info(f"Detected AWS S3 region from endpoint: {aws_region}")
+
 
-# Set Hugging Face cache directories for BLIP and other transformers models
+# Hugging Face cache directories for BLIP and other transformers models
 # Priority: Network Volume > Image default path
 # transformers library stores models in cache_dir/models--Salesforce--blip-vqa-base/ structure
-blip_cache_network = '/runpod-volume/models/blip'
-blip_cache_image = '/comfyui/models/blip'
-
-# Prefer Network Volume, fallback to image default path
-if os.path.isdir(blip_cache_network):
-    blip_cache_dir = blip_cache_network
-    cache_source = "Network Volume"
-elif os.path.isdir(blip_cache_image):
-    blip_cache_dir = blip_cache_image
-    cache_source = "image default path"
-else:
-    blip_cache_dir = None
-    cache_source = None
-
-if blip_cache_dir:
+BLIP_CACHE_NETWORK = '/runpod-volume/models/blip'
+BLIP_CACHE_IMAGE = '/comfyui/models/blip'
+
+
+def configure_blip_cache():
+    """
+    Point the Hugging Face cache variables at the BLIP cache directory.
+
+    Returns:
+        tuple: (cache_dir, cache_source), or (None, None) if neither directory exists.
+    """
+    # Prefer Network Volume, fallback to image default path
+    if os.path.isdir(BLIP_CACHE_NETWORK):
+        blip_cache_dir, cache_source = BLIP_CACHE_NETWORK, "Network Volume"
+    elif os.path.isdir(BLIP_CACHE_IMAGE):
+        blip_cache_dir, cache_source = BLIP_CACHE_IMAGE, "image default path"
+    else:
+        logger.warning("BLIP cache directory not found (checked Network Volume and image path)")
+        return None, None
+
     os.environ['HF_HUB_CACHE'] = blip_cache_dir
     os.environ['TRANSFORMERS_CACHE'] = blip_cache_dir
     os.environ['HF_HOME'] = blip_cache_dir
     os.environ['HUGGINGFACE_HUB_CACHE'] = blip_cache_dir
-    print(f"worker-comfyui: Using {cache_source} for BLIP models: {blip_cache_dir}")
-    
-    # Verify model directories exist
-    import glob
+    logger.info(f"Using {cache_source} for BLIP models: {blip_cache_dir}")
+    return blip_cache_dir, cache_source
+
+
+def verify_blip_cache(blip_cache_dir, cache_source):
+    """Log the BLIP model directories found in the cache (globs the network volume)."""
     model_dirs = glob.glob(os.path.join(blip_cache_dir, 'models--Salesforce--*'))
     if model_dirs:
-        print(f"worker-comfyui: Found {len(model_dirs)} BLIP model directory(ies):")
-        for model_dir in model_dirs:
-            print(f"worker-comfyui:   - {model_dir}")
+        logger.info(f"Found {len(model_dirs)} BLIP model directory(ies): {model_dirs}")
     else:
-        print(f"worker-comfyui: WARNING: No BLIP model directories found in {blip_cache_dir}")
+        logger.warning(f"No BLIP model directories found in {blip_cache_dir}")
         if cache_source == "Network Volume":
-            print(f"worker-comfyui: Please run download-models-to-volume.sh to download BLIP models")
-else:
-    print(f"worker-comfyui: WARNING: BLIP cache directory not found (checked Network Volume and image path)")
-
-# Configure logging to reduce numba verbose output
-# Set numba logger to CRITICAL level to suppress all messages including type inference errors
-numba_logger = logging.getLogger('numba')
-numba_logger.setLevel(logging.CRITICAL)
-
-# Also suppress numba.core and all numba sub-loggers
-numba_core_logger = logging.getLogger('numba.core')
-numba_core_logger.setLevel(logging.CRITICAL)
-
-# Suppress all numba-related loggers (including type inference and compilation messages)
-for logger_name in ['numba', 'numba.core', 'numba.core.ssa', 'numba.core.ir', 'numba.core.types', 
-                     'numba.core.compiler', 'numba.core.errors', 'numba.cpython', 'numba.core.rewrites',
-                     'numba.core.untyped_passes', 'numba.core.typed_passes']:
-    logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.CRITICAL)
-    # Disable propagation to prevent output
-    logger.propagate = False
+            logger.warning("Please run download-models-to-volume.sh to download BLIP models")
+
 
 # Suppress numba warnings at Python level
 warnings.filterwarnings('ignore', category=UserWarning, module='numba')
 warnings.filterwarnings('ignore', category=RuntimeWarning, module='numba')
 warnings.filterwarnings('ignore', message='.*numba.*')
 
-# Create a custom stdout filter to suppress numba debug prints
-# This is a workaround for numba's internal print statements that bypass logging
-class NumbaOutputFilter:
-    """Filter out numba debug output from stdout/stderr"""
-    def __init__(self, original_stream):
-        self.original_stream = original_stream
-        self.buffer = ''
-    
-    def write(self, text):
-        # Filter out numba debug patterns
-        if any(pattern in text for pattern in [
-            'SSA block',
-            'dispatch pc',
-            'on stmt:',
-            'State(pc_initial=',
-            'RESUME(arg=',
-            'NOP(arg=',
-            'LOAD_GLOBAL(arg=',
-            '==== SSA block',
-        ]):
-            return  # Suppress numba debug output
-        self.original_stream.write(text)
-        self.original_stream.flush()
-    
-    def flush(self):
-        self.original_stream.flush()
-    
-    def __getattr__(self, name):
-        return getattr(self.original_stream, name)
-
-# Apply filter to stdout and stderr to catch numba's print statements
-if not isinstance(sys.stdout, NumbaOutputFilter):
-    sys.stdout = NumbaOutputFilter(sys.stdout)
-if not isinstance(sys.stderr, NumbaOutputFilter):
-    sys.stderr = NumbaOutputFilter(sys.stderr)
-
 # Time to wait between API check attempts in milliseconds
 COMFY_API_AVAILABLE_INTERVAL_MS = 50
 # Maximum number of API check attempts
@@ -165,54 +307,396 @@ COMFY_API_AVAILABLE_MAX_RETRIES = 1000
 # If the respective env-vars are not supplied we fall back to sensible defaults ("5" and "3").
 WEBSOCKET_RECONNECT_ATTEMPTS = int(os.environ.get("WEBSOCKET_RECONNECT_ATTEMPTS", 5))
 WEBSOCKET_RECONNECT_DELAY_S = int(os.environ.get("WEBSOCKET_RECONNECT_DELAY_S", 3))
-
+# Completion reconciliation: messages sent while the websocket is down are lost, so
+# after every reconnect – and every WEBSOCKET_RECONCILE_INTERVAL_S seconds of silence –
+# we ask /history and /queue directly whether the prompt already finished.
+WEBSOCKET_RECONCILE_INTERVAL_S = int(
+    os.environ.get("WEBSOCKET_RECONCILE_INTERVAL_S", 15)
+)
+# Number of consecutive reconciliations in which the prompt is neither queued nor in
+# history before we consider it lost (e.g. ComfyUI restarted underneath us).
+PROMPT_MISSING_MAX_CHECKS = 2
+
+# Seconds to wait for a websocket message before checking whether to reconcile
+WEBSOCKET_RECEIVE_TIMEOUT_S = 10
 # Extra verbose websocket trace logs (set WEBSOCKET_TRACE=true to enable)
-if os.environ.get("WEBSOCKET_TRACE", "false").lower() == "true":
-    # This prints low-level frame information to stdout which is invaluable for diagnosing
-    # protocol errors but can be noisy in production – therefore gated behind an env-var.
-    websocket.enableTrace(True)
-
-# Host where ComfyUI is running
-COMFY_HOST = "127.0.0.1:8188"
+# Every received frame is logged at DEBUG level, which is invaluable for diagnosing
+# protocol errors but noisy in production – therefore gated behind an env-var.
+WEBSOCKET_TRACE = os.environ.get("WEBSOCKET_TRACE", "false").lower() == "true"
+# Maximum number of HTTP requests to ComfyUI in flight per event loop. Input uploads
+# and output fetches of a job run in parallel up to this limit.
+COMFY_CLIENT_MAX_CONCURRENCY = int(os.environ.get("COMFY_CLIENT_MAX_CONCURRENCY", 8))
+
+# ComfyUI instances jobs are routed to, e.g. one per GPU plus a CPU-only instance for
+# light preprocessing graphs ("127.0.0.1:8188,127.0.0.1:8189"). Every job runs entirely
+# on one of them, chosen by backend_pool (see BackendPool). Duplicates are dropped.
+COMFY_HOSTS = list(dict.fromkeys(
+    host.strip() for host in os.environ.get("COMFY_HOSTS", "").split(",") if host.strip()
+))
+# Host where ComfyUI is running (the only backend unless COMFY_HOSTS is set)
+COMFY_HOST = COMFY_HOSTS[0] if COMFY_HOSTS else "127.0.0.1:8188"
+# How strongly a backend that already has a workflow's models loaded is preferred,
+# in jobs in flight: with 1.0 it wins unless it is busier by more than one job
+COMFY_BACKEND_AFFINITY_WEIGHT = float(os.environ.get("COMFY_BACKEND_AFFINITY_WEIGHT", 1.0))
+# Seconds an unreachable backend is skipped before jobs are routed to it again
+COMFY_BACKEND_RETRY_S = int(os.environ.get("COMFY_BACKEND_RETRY_S", 30))
+# Jobs this worker runs at once (see concurrency_modifier). RunPod hands a worker one
+# job at a time by default, which would leave all but one backend idle; 0 means one
+# job per backend in COMFY_HOSTS.
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 0)) or len(COMFY_HOSTS) or 1
+# How outputs get back to the handler: "disk" (SaveImage -> /comfyui/output -> /view) or
+# "websocket" (SaveImage is swapped for SaveImageWebsocket and the PNG bytes arrive as
+# binary websocket frames). Can be overridden per job via input.output_mode.
+OUTPUT_MODE = os.environ.get("OUTPUT_MODE", "disk").lower()
+OUTPUT_MODES = ("disk", "websocket")
+# Maximum number of workflows in one multi-workflow job (input.workflows). They share
+# the job's input images and are queued back to back on the same ComfyUI backend.
+MAX_JOB_WORKFLOWS = int(os.environ.get("MAX_JOB_WORKFLOWS", 64))
+# Sweeps (input.sweep) expand one workflow into variants that run as a multi-workflow
+# job: "product" runs every combination of the swept values, "zip" pairs them up.
+SWEEP_MODES = ("product", "zip")
+# Priority lanes (input.priority, see PriorityLanes):
+#   • "high" prompts are queued at the front of ComfyUI's queue
+#   • "normal" prompts are appended
+#   • "low" prompts are held in the handler while the backend already has
+#     PRIORITY_LOW_QUEUE_DEPTH or more prompts queued or running (ComfyUI's /queue,
+#     so prompts of other clients count too)
+# Starvation protection: a low prompt is held at most PRIORITY_MAX_HOLD_S, and high
+# prompts stop jumping the queue while another prompt has waited longer than that.
+PRIORITY_LANES = ("high", "normal", "low")
+PRIORITY_LOW_QUEUE_DEPTH = int(os.environ.get("PRIORITY_LOW_QUEUE_DEPTH", 2))
+PRIORITY_MAX_HOLD_S = float(os.environ.get("PRIORITY_MAX_HOLD_S", 120))
+# Output transcoding (see media_transcode), overridable per job via input.output_format,
+# input.output_quality, input.output_lossless, input.video_format and input.video_reencode.
+# Empty formats return ComfyUI's files unchanged. Transcoding runs after the fetch and
+# before base64 / S3, in a pool of TRANSCODE_WORKERS processes.
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "").lower()
+OUTPUT_QUALITY = int(os.environ.get("OUTPUT_QUALITY", 90))
+OUTPUT_LOSSLESS = os.environ.get("OUTPUT_LOSSLESS", "false").lower() == "true"
+VIDEO_FORMAT = os.environ.get("VIDEO_FORMAT", "").lower()
+VIDEO_REENCODE = os.environ.get("VIDEO_REENCODE", "false").lower() == "true"
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", min(4, os.cpu_count() or 1)))
+TRANSCODE_TIMEOUT_S = int(os.environ.get("TRANSCODE_TIMEOUT_S", 300))
+# Inline previews next to each output (input.thumbnails): a thumbnail per image, and a
+# poster frame plus a PREVIEW_SECONDS low-bitrate clip per video (0 skips the clip).
+# They are built in the transcode process pool while the full output is delivered.
+THUMBNAILS = os.environ.get("THUMBNAILS", "false").lower() == "true"
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", 256))
+THUMBNAIL_FORMAT = os.environ.get("THUMBNAIL_FORMAT", "webp").lower()
+PREVIEW_SECONDS = float(os.environ.get("PREVIEW_SECONDS", 3))
+# Compression of inline base64 results, overridable per job via input.result_encoding:
+# "none", "gzip" or "zstd" (Python 3.14+ or backports.zstd). Already compressed formats
+# are sent as-is, as is any file that compression would not make smaller.
+RESULT_ENCODING = os.environ.get("RESULT_ENCODING", "none").lower()
+RESULT_ENCODINGS = ("none", "gzip", "zstd")
+RESULT_ENCODING_SKIP_EXTENSIONS = (
+    ".mp4", ".m4v", ".webm", ".mov", ".mkv", ".avi", ".flv", ".wmv",
+    ".jpg", ".jpeg", ".webp", ".avif", ".gif", ".mp3", ".ogg", ".zip", ".gz", ".zst",
+)
+# Binary websocket frame layout used by ComfyUI for images:
+# 4-byte big-endian event type (1 = PREVIEW_IMAGE) + 4-byte image format (1 = JPEG, 2 = PNG)
+WS_BINARY_EVENT_PREVIEW_IMAGE = 1
+WS_BINARY_IMAGE_FORMATS = {1: ".jpg", 2: ".png"}
+# Post-job cleanup (see cleanup_job / sweep_comfy_directories)
+#   • CLEANUP_AFTER_JOB removes the prompt from /history, the delivered output files
+#     and the uploaded input files once a job is finished.
+#   • CLEANUP_SWEEP_INTERVAL_S runs a background sweep of the per-job subfolders
+#     (job-*) in the input/output folders that removes files older than
+#     CLEANUP_MAX_AGE_S and trims each folder to CLEANUP_MAX_DIR_MB (oldest first).
+#     Opt-in: 0 (the default) disables the sweep. Files outside job-* subfolders,
+#     such as assets baked into the image, are never swept.
+#   • Files below a folder named in CLEANUP_EXEMPT_DIRS (cached assets) are never swept.
+CLEANUP_AFTER_JOB = os.environ.get("CLEANUP_AFTER_JOB", "true").lower() == "true"
+CLEANUP_SWEEP_INTERVAL_S = int(os.environ.get("CLEANUP_SWEEP_INTERVAL_S", 0))
+CLEANUP_MAX_AGE_S = int(os.environ.get("CLEANUP_MAX_AGE_S", 24 * 3600))
+CLEANUP_MAX_DIR_MB = int(os.environ.get("CLEANUP_MAX_DIR_MB", 10240))
+CLEANUP_EXEMPT_DIRS = tuple(
+    name.strip()
+    for name in os.environ.get("CLEANUP_EXEMPT_DIRS", "cache").split(",")
+    if name.strip()
+)
+# Give each job its own subfolder in /comfyui/input and /comfyui/output so concurrent
+# jobs cannot overwrite each other's files and cleanup is a single directory removal
+JOB_SUBFOLDERS = os.environ.get("JOB_SUBFOLDERS", "true").lower() == "true"
+JOB_SUBFOLDER_PREFIX = "job-"
+# Content-addressed S3 uploads (see ContentAddressedStore)
+#   • S3_CONTENT_ADDRESSED stores outputs as {S3_CONTENT_PREFIX}/{sha256}{ext} and
+#     returns the existing object's URL instead of uploading the same bytes again.
+#   • S3_CONTENT_BUCKET is the bucket to use (default: the month bucket of rp_upload).
+#   • Hashes seen within S3_DEDUP_INDEX_TTL_S are trusted without asking S3; older or
+#     unknown hashes are checked with a HEAD request first.
+#   • S3_DEDUP_INDEX_PATH persists the known-hash index (e.g. on the network volume)
+#     so it survives worker restarts and is shared by workers on the same volume.
+S3_CONTENT_ADDRESSED = os.environ.get("S3_CONTENT_ADDRESSED", "false").lower() == "true"
+S3_CONTENT_PREFIX = os.environ.get("S3_CONTENT_PREFIX", "cas").strip("/")
+S3_CONTENT_BUCKET = os.environ.get("S3_CONTENT_BUCKET", "")
+S3_DEDUP_INDEX_PATH = os.environ.get("S3_DEDUP_INDEX_PATH", "")
+S3_DEDUP_INDEX_TTL_S = int(os.environ.get("S3_DEDUP_INDEX_TTL_S", 24 * 3600))
+# Model residency management between jobs (see ModelResidencyManager)
+#   • MODEL_RESIDENCY enables the manager and adds a "residency" report to job output.
+#   • MODEL_RESIDENCY_VRAM_MB overrides the VRAM budget (default: vram_total from /system_stats).
+#   • MODEL_RESIDENCY_DECAY is the per-job decay of a model's usage score.
+#   • MODEL_RESIDENCY_COLD_SCORE is the score below which a resident model counts as cold.
+MODEL_RESIDENCY = os.environ.get("MODEL_RESIDENCY", "false").lower() == "true"
+MODEL_RESIDENCY_VRAM_MB = int(os.environ.get("MODEL_RESIDENCY_VRAM_MB", 0))
+MODEL_RESIDENCY_DECAY = float(os.environ.get("MODEL_RESIDENCY_DECAY", 0.8))
+MODEL_RESIDENCY_COLD_SCORE = float(os.environ.get("MODEL_RESIDENCY_COLD_SCORE", 0.25))
+# File extensions that identify model weights referenced from workflow inputs
+MODEL_FILE_EXTENSIONS = (
+    ".safetensors", ".ckpt", ".pt", ".pth", ".bin", ".onnx", ".gguf", ".sft",
+)
+# Predictive model preloading between jobs (see ModelPreloader)
+#   • MODEL_PRELOAD learns which model set tends to follow which and, once a backend
+#     has been idle for MODEL_PRELOAD_IDLE_S, reads the files of the most likely next
+#     set into the OS page cache.
+#   • MODEL_PRELOAD_PROMPT also queues a tiny prompt with the loader nodes of the last
+#     workflow that used those models, so ComfyUI loads them itself. This replaces
+#     ComfyUI's node cache of the previous job.
+#   • MODEL_PRELOAD_HISTORY_SIZE is the number of model sets the history remembers.
+#   • MODEL_PRELOAD_TIMEOUT_S bounds the wait for a preload prompt; one that fails,
+#     disappears from ComfyUI or outlasts it does not mark its models as loaded.
+# Every new job cancels running preloads before it touches ComfyUI.
+MODEL_PRELOAD = os.environ.get("MODEL_PRELOAD", "false").lower() == "true"
+MODEL_PRELOAD_IDLE_S = float(os.environ.get("MODEL_PRELOAD_IDLE_S", 2))
+MODEL_PRELOAD_PROMPT = os.environ.get("MODEL_PRELOAD_PROMPT", "false").lower() == "true"
+MODEL_PRELOAD_HISTORY_SIZE = int(os.environ.get("MODEL_PRELOAD_HISTORY_SIZE", 64))
+MODEL_PRELOAD_TIMEOUT_S = float(os.environ.get("MODEL_PRELOAD_TIMEOUT_S", 300))
 # Enforce a clean state after each job is done
 # see https://docs.runpod.io/docs/handler-additional-controls#refresh-worker
 REFRESH_WORKER = os.environ.get("REFRESH_WORKER", "false").lower() == "true"
 
 # ---------------------------------------------------------------------------
-# Helper: quick reachability probe of ComfyUI HTTP endpoint (port 8188)
+# In-process metrics (Prometheus text format, served on METRICS_PORT)
 # ---------------------------------------------------------------------------
 
-
-def _comfy_server_status():
-    """Return a dictionary with basic reachability info for the ComfyUI HTTP server."""
-    try:
-        resp = requests.get(f"http://{COMFY_HOST}/", timeout=5)
+# Port of the local /metrics HTTP endpoint; 0 disables it
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+# Production trace recording (see record_job_trace and tests/replay_trace.py):
+# anonymized job envelopes are appended as JSON lines to TRACE_RECORD_PATH for a
+# TRACE_RECORD_SAMPLE_RATE share of jobs. Unset path disables recording.
+TRACE_RECORD_PATH = os.environ.get("TRACE_RECORD_PATH", "")
+TRACE_RECORD_SAMPLE_RATE = float(os.environ.get("TRACE_RECORD_SAMPLE_RATE", 1.0))
+# Per-job memory profiling (see MemoryProfiler): RSS and tracemalloc readings at phase
+# boundaries, reported under "memory" in the result. Enabled for a
+# MEMORY_PROFILE_SAMPLE_RATE share of jobs, or per job with "memory_profile": true.
+#   • MEMORY_PROFILE_TOP_SITES is the number of allocation sites reported.
+#   • MEMORY_PROFILE_FRAMES is the traceback depth stored per allocation (1 is cheapest).
+MEMORY_PROFILE_SAMPLE_RATE = float(os.environ.get("MEMORY_PROFILE_SAMPLE_RATE", 0.0))
+MEMORY_PROFILE_TOP_SITES = int(os.environ.get("MEMORY_PROFILE_TOP_SITES", 10))
+MEMORY_PROFILE_FRAMES = int(os.environ.get("MEMORY_PROFILE_FRAMES", 1))
+# Fixed histogram buckets (upper bounds, milliseconds) for phase durations
+PHASE_HISTOGRAM_BUCKETS_MS = (
+    5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 300000,
+)
+
+
+class Histogram:
+    """Fixed-bucket histogram (cumulative counts are derived on read)."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
         return {
-            "reachable": resp.status_code == 200,
-            "status_code": resp.status_code,
+            "buckets": dict(zip([*map(str, self.buckets), "+Inf"], self.counts)),
+            "sum": round(self.sum, 2),
+            "count": self.count,
         }
-    except Exception as exc:
-        return {"reachable": False, "error": str(exc)}
 
 
-def _attempt_websocket_reconnect(ws_url, max_attempts, delay_s, initial_error):
+class MetricsRegistry:
+    """
+    Counters, gauges and fixed-bucket histograms rendered as Prometheus text.
+
+    Updates are a dict operation under a lock, so they are cheap enough for the
+    hot path. Metrics must be declared before use.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._values = {}
+        self._histograms = {}
+
+    def counter(self, name, help_text):
+        self._meta[name] = ("counter", help_text)
+        self._values.setdefault(name, {})
+
+    def gauge(self, name, help_text):
+        self._meta[name] = ("gauge", help_text)
+        self._values.setdefault(name, {})
+
+    def histogram(self, name, help_text, buckets, label=None):
+        """Declare a histogram family; returns its label value -> Histogram dict."""
+        self._meta[name] = ("histogram", help_text)
+        family = self._histograms.setdefault(name, (label, tuple(buckets), {}))
+        return family[2]
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[name][key] = value
+
+    def observe(self, name, value, label_value=None):
+        label, buckets, series = self._histograms[name]
+        with self._lock:
+            if label_value not in series:
+                series[label_value] = Histogram(buckets)
+            series[label_value].observe(value)
+
+    def value(self, name, **labels):
+        return self._values[name].get(tuple(sorted(labels.items())), 0)
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, (metric_type, help_text) in self._meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                if metric_type != "histogram":
+                    for key, value in self._values[name].items():
+                        lines.append(f"{name}{self._labels(key)} {value}")
+                    continue
+                label, buckets, series = self._histograms[name]
+                for label_value, hist in series.items():
+                    base = [(label, label_value)] if label else []
+                    cumulative = 0
+                    for bound, count in zip([*buckets, "+Inf"], hist.counts):
+                        cumulative += count
+                        lines.append(
+                            f"{name}_bucket{self._labels(base + [('le', bound)])} {cumulative}"
+                        )
+                    lines.append(f"{name}_sum{self._labels(base)} {round(hist.sum, 3)}")
+                    lines.append(f"{name}_count{self._labels(base)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+metrics.gauge("worker_jobs_in_flight", "Jobs currently being handled")
+metrics.counter("worker_jobs_total", "Finished jobs by result status")
+metrics.gauge("comfy_queue_remaining", "queue_remaining from the latest ComfyUI status message")
+metrics.counter("comfy_websocket_reconnects_total", "Successful websocket reconnects")
+metrics.counter("comfy_restarts_total", "Times ComfyUI was detected to have restarted")
+metrics.counter("worker_url_download_bytes_total", "Bytes downloaded from input image URLs")
+metrics.counter("worker_input_upload_bytes_total", "Bytes uploaded to ComfyUI /upload/image")
+metrics.counter("worker_output_fetch_bytes_total", "Bytes fetched from ComfyUI /view")
+metrics.counter("worker_base64_bytes_total", "Base64 characters returned inline in job output")
+metrics.counter("worker_s3_upload_bytes_total", "Bytes uploaded to S3")
+metrics.counter("worker_s3_dedup_hits_total", "Outputs already stored in S3 under their content hash")
+metrics.counter("worker_s3_dedup_saved_bytes_total", "Bytes not uploaded to S3 thanks to deduplication")
+metrics.counter("comfy_nodes_executed_total", "Workflow nodes executed by ComfyUI")
+metrics.counter("comfy_nodes_cached_total", "Workflow nodes served from ComfyUI's cache")
+metrics.counter("model_residency_requests_total", "Model references checked by the residency manager")
+metrics.counter("model_residency_hits_total", "Model references already resident")
+metrics.counter("model_preload_bytes_total", "Model file bytes read into the page cache ahead of jobs")
+metrics.counter("model_preload_hits_total", "Preloaded models that the next job used")
+metrics.counter("model_preload_cancelled_total", "Preloads cancelled by an incoming job")
+metrics.gauge("comfy_backend_in_flight", "Jobs in flight per ComfyUI backend")
+metrics.gauge("comfy_backend_healthy", "1 if the ComfyUI backend answered its last check, else 0")
+metrics.gauge("comfy_backend_loaded_models", "Models believed to be loaded per ComfyUI backend")
+metrics.counter("comfy_backend_jobs_total", "Jobs routed to each ComfyUI backend")
+metrics.counter("worker_result_encoding_saved_bytes_total", "Bytes saved by result_encoding before base64")
+metrics.counter("worker_derivative_bytes_total", "Bytes of inline thumbnails, poster frames and previews")
+metrics.counter("worker_transcode_input_bytes_total", "Bytes of outputs passed to the transcoder")
+metrics.counter("worker_transcode_output_bytes_total", "Bytes of outputs after transcoding")
+metrics.gauge("worker_priority_held", "Low-priority jobs currently held back by the handler")
+metrics.counter(
+    "worker_priority_front_skipped_total",
+    "High-priority prompts appended instead of queued in front to avoid starvation",
+)
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes would otherwise log a line every few seconds
+
+
+def start_metrics_server(port):
+    """Serve /metrics on 0.0.0.0:port from a daemon thread."""
+    server = http.server.ThreadingHTTPServer(("0.0.0.0", port), _MetricsRequestHandler)
+    threading.Thread(
+        target=server.serve_forever, name="metrics-server", daemon=True
+    ).start()
+    logger.info(f"Serving Prometheus metrics on :{port}/metrics")
+    return server
+
+
+# ---------------------------------------------------------------------------
+# ComfyUI client
+# ---------------------------------------------------------------------------
+# All ComfyUI I/O goes through comfy_client. The job itself runs as a coroutine on
+# the AsyncComfyClient of the running event loop; the synchronous helpers below
+# (queue_workflow, get_history, ...) are thin facades for other callers.
+# Both talk to the backend bound to the current job, so every call of a job (and of
+# the worker threads it starts) goes to the same ComfyUI instance.
+
+# ComfyBackend the current job runs on; None outside a job
+_job_backend = contextvars.ContextVar("job_backend", default=None)
+
+
+def current_comfy_host():
+    """Return the host of the current job's backend, or COMFY_HOST outside a job."""
+    backend = _job_backend.get()
+    return backend.host if backend is not None else COMFY_HOST
+
+
+def comfy():
+    """Return the AsyncComfyClient for the current backend on the running event loop."""
+    return comfy_client.get_client(current_comfy_host(), COMFY_CLIENT_MAX_CONCURRENCY)
+
+
+def comfy_sync():
+    """Return the blocking facade over comfy() for synchronous callers."""
+    return comfy_client.ComfyClient(current_comfy_host(), COMFY_CLIENT_MAX_CONCURRENCY)
+
+
+async def _attempt_websocket_reconnect(events, max_attempts, delay_s, initial_error):
     """
-    Attempts to reconnect to the WebSocket server after a disconnect.
+    Attempts to reconnect the event stream after a disconnect.
 
     Args:
-        ws_url (str): The WebSocket URL (including client_id).
+        events (comfy_client.EventStream): The stream to reconnect (same client_id).
         max_attempts (int): Maximum number of reconnection attempts.
         delay_s (int): Delay in seconds between attempts.
         initial_error (Exception): The error that triggered the reconnect attempt.
 
-    Returns:
-        websocket.WebSocket: The newly connected WebSocket object.
-
     Raises:
-        websocket.WebSocketConnectionClosedException: If reconnection fails after all attempts.
+        comfy_client.ComfyConnectionClosed: If reconnection fails after all attempts.
     """
-    print(
-        f"worker-comfyui - Websocket connection closed unexpectedly: {initial_error}. Attempting to reconnect..."
+    logger.warning(
+        f"Websocket connection closed unexpectedly: {initial_error}. Attempting to reconnect..."
     )
     last_reconnect_error = initial_error
     for attempt in range(max_attempts):
@@ -220,48 +704,42 @@ def _attempt_websocket_reconnect(ws_url, max_attempts, delay_s, initial_error):
         # see whether ComfyUI is still alive (HTTP port 8188 responding) even if
         # the websocket dropped. This is extremely useful to differentiate
         # between a network glitch and an outright ComfyUI crash/OOM-kill.
-        srv_status = _comfy_server_status()
+        srv_status = await events.client.server_status()
         if not srv_status["reachable"]:
             # If ComfyUI itself is down there is no point in retrying the websocket –
             # bail out immediately so the caller gets a clear "ComfyUI crashed" error.
-            print(
-                f"worker-comfyui - ComfyUI HTTP unreachable – aborting websocket reconnect: {srv_status.get('error', 'status '+str(srv_status.get('status_code')))}"
+            logger.error(
+                f"ComfyUI HTTP unreachable – aborting websocket reconnect: {srv_status.get('error', 'status '+str(srv_status.get('status_code')))}"
             )
-            raise websocket.WebSocketConnectionClosedException(
+            raise comfy_client.ComfyConnectionClosed(
                 "ComfyUI HTTP unreachable during websocket reconnect"
             )
 
         # Otherwise we proceed with reconnect attempts while server is up
-        print(
-            f"worker-comfyui - Reconnect attempt {attempt + 1}/{max_attempts}... (ComfyUI HTTP reachable, status {srv_status.get('status_code')})"
+        logger.debug(
+            f"Reconnect attempt {attempt + 1}/{max_attempts}... (ComfyUI HTTP reachable, status {srv_status.get('status_code')})"
         )
         try:
-            # Need to create a new socket object for reconnect
-            new_ws = websocket.WebSocket()
-            new_ws.connect(ws_url, timeout=10)  # Use existing ws_url
-            print(f"worker-comfyui - Websocket reconnected successfully.")
-            return new_ws  # Return the new connected socket
-        except (
-            websocket.WebSocketException,
-            ConnectionRefusedError,
-            socket.timeout,
-            OSError,
-        ) as reconn_err:
+            await events.connect()
+            logger.info(f"Websocket reconnected successfully.")
+            metrics.inc("comfy_websocket_reconnects_total")
+            return
+        except comfy_client.ComfyConnectionClosed as reconn_err:
             last_reconnect_error = reconn_err
-            print(
-                f"worker-comfyui - Reconnect attempt {attempt + 1} failed: {reconn_err}"
+            logger.warning(
+                f"Reconnect attempt {attempt + 1} failed: {reconn_err}"
             )
             if attempt < max_attempts - 1:
-                print(
-                    f"worker-comfyui - Waiting {delay_s} seconds before next attempt..."
+                logger.debug(
+                    f"Waiting {delay_s} seconds before next attempt..."
                 )
-                time.sleep(delay_s)
+                await asyncio.sleep(delay_s)
             else:
-                print(f"worker-comfyui - Max reconnection attempts reached.")
+                logger.warning(f"Max reconnection attempts reached.")
 
     # If loop completes without returning, raise an exception
-    print("worker-comfyui - Failed to reconnect websocket after connection closed.")
-    raise websocket.WebSocketConnectionClosedException(
+    logger.error("Failed to reconnect websocket after connection closed.")
+    raise comfy_client.ComfyConnectionClosed(
         f"Connection closed and failed to reconnect. Last error: {last_reconnect_error}"
     )
 
@@ -288,11 +766,36 @@ def validate_input(job_input):
         except json.JSONDecodeError:
             return None, "Invalid JSON format in input"
 
-    # Validate 'workflow' in input
+    # Validate 'workflow' in input, or 'workflows' for a multi-workflow job
     workflow = job_input.get("workflow")
-    if workflow is None:
+    workflows = job_input.get("workflows")
+    if workflows is not None:
+        if workflow is not None:
+            return None, "Provide either 'workflow' or 'workflows', not both"
+        if not isinstance(workflows, list) or not workflows or not all(
+            isinstance(item, dict) for item in workflows
+        ):
+            return None, "'workflows' must be a non-empty list of workflow objects"
+        if len(workflows) > MAX_JOB_WORKFLOWS:
+            return None, f"'workflows' may contain at most {MAX_JOB_WORKFLOWS} workflows"
+    elif workflow is None:
         return None, "Missing 'workflow' parameter"
 
+    # Optional: expand the workflow into one variant per swept input value
+    sweep = job_input.get("sweep")
+    sweep_parameters = None
+    if sweep is not None:
+        if workflows is not None:
+            return None, "'sweep' expands 'workflow' and cannot be combined with 'workflows'"
+        sweep_mode = job_input.get("sweep_mode", "product")
+        if sweep_mode not in SWEEP_MODES:
+            return None, f"'sweep_mode' must be one of: {', '.join(SWEEP_MODES)}"
+        variants, error_message = expand_sweep(workflow, sweep, sweep_mode)
+        if error_message:
+            return None, error_message
+        sweep_parameters = [parameters for parameters, _ in variants]
+        workflows = [variant for _, variant in variants]
+
     # Validate 'images' in input, if provided
     images = job_input.get("images")
     if images is not None:
@@ -307,14 +810,189 @@ def validate_input(job_input):
     # Optional: API key for Comfy.org API Nodes, passed per-request
     comfy_org_api_key = job_input.get("comfy_org_api_key")
 
+    # Optional: include the per-node execution timeline in the output
+    node_timeline = bool(job_input.get("node_timeline", False))
+
+    # Optional: how outputs are returned from ComfyUI ("disk" or "websocket")
+    output_mode = job_input.get("output_mode", OUTPUT_MODE)
+    if output_mode not in OUTPUT_MODES:
+        return None, f"'output_mode' must be one of: {', '.join(OUTPUT_MODES)}"
+
+    # Optional: transcode outputs before they are returned
+    output_format = job_input.get("output_format", OUTPUT_FORMAT) or None
+    if output_format is not None and output_format not in media_transcode.IMAGE_FORMATS:
+        return None, f"'output_format' must be one of: {', '.join(media_transcode.IMAGE_FORMATS)}"
+    video_format = job_input.get("video_format", VIDEO_FORMAT) or None
+    if video_format is not None and video_format not in media_transcode.VIDEO_FORMATS:
+        return None, f"'video_format' must be one of: {', '.join(media_transcode.VIDEO_FORMATS)}"
+    output_quality = job_input.get("output_quality", OUTPUT_QUALITY)
+    if isinstance(output_quality, bool) or not isinstance(output_quality, int) or not 1 <= output_quality <= 100:
+        return None, "'output_quality' must be an integer between 1 and 100"
+    transcode = None
+    if output_format or video_format:
+        transcode = {
+            "image_format": output_format,
+            "quality": output_quality,
+            "lossless": bool(job_input.get("output_lossless", OUTPUT_LOSSLESS)),
+            "video_format": video_format,
+            "video_reencode": bool(job_input.get("video_reencode", VIDEO_REENCODE)),
+            "ffmpeg_timeout_s": TRANSCODE_TIMEOUT_S,
+        }
+
+    # Optional: small inline previews (thumbnail / poster frame / clip) per output
+    derivatives = None
+    if job_input.get("thumbnails", THUMBNAILS):
+        thumbnail_size = job_input.get("thumbnail_size", THUMBNAIL_SIZE)
+        if isinstance(thumbnail_size, bool) or not isinstance(thumbnail_size, int) or not 16 <= thumbnail_size <= 2048:
+            return None, "'thumbnail_size' must be an integer between 16 and 2048"
+        if THUMBNAIL_FORMAT not in media_transcode.IMAGE_FORMATS:
+            return None, f"THUMBNAIL_FORMAT must be one of: {', '.join(media_transcode.IMAGE_FORMATS)}"
+        derivatives = {
+            "size": thumbnail_size,
+            "image_format": THUMBNAIL_FORMAT,
+            "quality": 80,
+            "preview_seconds": PREVIEW_SECONDS,
+            "ffmpeg_timeout_s": TRANSCODE_TIMEOUT_S,
+        }
+
+    # Optional: compress inline base64 results ("none", "gzip" or "zstd")
+    result_encoding = job_input.get("result_encoding", RESULT_ENCODING)
+    if result_encoding not in RESULT_ENCODINGS:
+        return None, f"'result_encoding' must be one of: {', '.join(RESULT_ENCODINGS)}"
+    if result_encoding == "zstd" and _zstd_module() is None:
+        return None, "'result_encoding' zstd needs Python 3.14+ or the backports.zstd package"
+
+    # Optional: scheduling lane ("high", "normal" or "low")
+    priority = job_input.get("priority", "normal")
+    if priority not in PRIORITY_LANES:
+        return None, f"'priority' must be one of: {', '.join(PRIORITY_LANES)}"
+
     # Return validated data and no error
     return {
         "workflow": workflow,
+        "workflows": workflows,
+        "sweep": sweep_parameters,
         "images": images,
         "comfy_org_api_key": comfy_org_api_key,
+        "output_mode": output_mode,
+        "node_timeline": node_timeline,
+        "priority": priority,
+        "transcode": transcode,
+        "result_encoding": result_encoding,
+        "derivatives": derivatives,
     }, None
 
 
+def _node_depths(workflow):
+    """Longest distance of each node from a node without linked inputs (loaders are 0)."""
+    depths = {}
+
+    def visit(node_id, trail):
+        if node_id in depths:
+            return depths[node_id]
+        if node_id in trail:
+            return 0
+        node_data = workflow.get(node_id)
+        inputs = node_data.get("inputs") if isinstance(node_data, dict) else None
+        upstream = [
+            str(value[0])
+            for value in (inputs if isinstance(inputs, dict) else {}).values()
+            if isinstance(value, list) and len(value) == 2 and str(value[0]) in workflow
+        ]
+        depths[node_id] = 1 + max(
+            (visit(upstream_id, trail | {node_id}) for upstream_id in upstream), default=-1
+        )
+        return depths[node_id]
+
+    for node_id in workflow:
+        visit(str(node_id), frozenset())
+    return depths
+
+
+def _sweep_values(key, spec):
+    """Values of one swept input: a list, or {"start", "count", "step"} for a range."""
+    if isinstance(spec, dict):
+        start, count, step = spec.get("start", 0), spec.get("count"), spec.get("step", 1)
+        if (
+            isinstance(count, bool) or not isinstance(count, int) or count < 1
+            or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in (start, step))
+        ):
+            return None, f"'sweep' range for '{key}' needs a positive integer 'count' and numeric 'start'/'step'"
+        # Checked before building the list, so a huge count cannot exhaust memory
+        if count > MAX_JOB_WORKFLOWS:
+            return None, f"'sweep' range for '{key}' has {count} values; at most {MAX_JOB_WORKFLOWS} are allowed"
+        values = [start + i * step for i in range(count)]
+        if any(isinstance(v, float) for v in (start, step)):
+            values = [round(value, 10) for value in values]
+        return values, None
+    if not isinstance(spec, list) or not spec:
+        return None, f"'sweep' values for '{key}' must be a non-empty list or a range object"
+    if len(spec) > MAX_JOB_WORKFLOWS:
+        return None, f"'sweep' for '{key}' lists {len(spec)} values; at most {MAX_JOB_WORKFLOWS} are allowed"
+    return spec, None
+
+
+def expand_sweep(workflow, sweep, mode="product"):
+    """
+    Expand a workflow into one variant per combination of swept input values.
+
+    Args:
+        workflow (dict): The workflow in API format.
+        sweep (dict): "node_id.input_name" -> list of values, or a range object
+            {"start", "count", "step"}, e.g. {"3.seed": {"start": 1, "count": 8}}.
+        mode (str): "product" for every combination, "zip" to pair the i-th values.
+
+    Returns:
+        tuple: (list of (parameters, workflow) variants, error message or None).
+        In "product" mode the most downstream input varies fastest, so consecutive
+        variants share as many upstream nodes as possible and ComfyUI serves those
+        from its cache.
+    """
+    if not isinstance(workflow, dict):
+        return None, "'sweep' needs 'workflow' to be a workflow object"
+    if not isinstance(sweep, dict) or not sweep:
+        return None, "'sweep' must be an object mapping 'node_id.input_name' to values"
+
+    swept = []
+    for key, spec in sweep.items():
+        node_id, _, input_name = str(key).rpartition(".")
+        node_data = workflow.get(node_id)
+        if not isinstance(node_data, dict) or input_name not in (node_data.get("inputs") or {}):
+            return None, f"'sweep' key '{key}' does not name an input of a workflow node"
+        values, error_message = _sweep_values(key, spec)
+        if error_message:
+            return None, error_message
+        swept.append((key, node_id, input_name, values))
+
+    if mode == "zip":
+        lengths = {len(values) for _, _, _, values in swept}
+        if len(lengths) > 1:
+            return None, "'sweep' values must all have the same length when 'sweep_mode' is zip"
+        combinations = list(zip(*(values for _, _, _, values in swept)))
+    else:
+        depths = _node_depths(workflow)
+        swept.sort(key=lambda item: depths.get(item[1], 0))
+        total = 1
+        for _, _, _, values in swept:
+            total *= len(values)
+        if total > MAX_JOB_WORKFLOWS:
+            return None, f"'sweep' expands to {total} variants; at most {MAX_JOB_WORKFLOWS} are allowed"
+        combinations = list(itertools.product(*(values for _, _, _, values in swept)))
+    if len(combinations) > MAX_JOB_WORKFLOWS:
+        return None, f"'sweep' expands to {len(combinations)} variants; at most {MAX_JOB_WORKFLOWS} are allowed"
+
+    variants = []
+    for combination in combinations:
+        variant = copy.deepcopy(workflow)
+        parameters = {}
+        for (key, node_id, input_name, _), value in zip(swept, combination):
+            variant[node_id]["inputs"][input_name] = value
+            parameters[key] = value
+        # Parameters are reported in the order the job listed them
+        variants.append(({key: parameters[key] for key in sweep}, variant))
+    return variants, None
+
+
 def check_server(url, retries=500, delay=50):
     """
     Check if a server is reachable via HTTP GET request
@@ -328,14 +1006,14 @@ def check_server(url, retries=500, delay=50):
     bool: True if the server is reachable within the given number of retries, otherwise False
     """
 
-    print(f"worker-comfyui - Checking API server at {url}...")
+    logger.debug(f"Checking API server at {url}...")
     for i in range(retries):
         try:
             response = requests.get(url, timeout=5)
 
             # If the response status code is 200, the server is up and running
             if response.status_code == 200:
-                print(f"worker-comfyui - API is reachable")
+                logger.debug(f"API is reachable")
                 return True
         except requests.Timeout:
             pass
@@ -345,8 +1023,8 @@ def check_server(url, retries=500, delay=50):
         # Wait for the specified delay before retrying
         time.sleep(delay / 1000)
 
-    print(
-        f"worker-comfyui - Failed to connect to server at {url} after {retries} attempts."
+    logger.error(
+        f"Failed to connect to server at {url} after {retries} attempts."
     )
     return False
 
@@ -399,7 +1077,7 @@ def normalize_workflow_paths(workflow):
                     if is_path_field or is_likely_file_path:
                         normalized = value.replace("\\", "/")
                         node_data["inputs"][key] = normalized
-                        print(f"worker-comfyui - Normalized path in node {node_id}, field '{key}': {value} -> {normalized}")
+                        logger.debug(f"Normalized path in node {node_id}, field '{key}': {value} -> {normalized}")
     
     return workflow
 
@@ -416,22 +1094,69 @@ def convert_url_to_base64(image_url, timeout=30):
         str: base64 编码的图片字符串，如果失败则返回 None
     """
     try:
-        print(f"worker-comfyui - Downloading image from URL: {image_url}")
+        logger.info(f"Downloading image from URL: {image_url}")
         response = requests.get(image_url, timeout=timeout, stream=True)
         response.raise_for_status()
         image_bytes = response.content
+        metrics.inc("worker_url_download_bytes_total", len(image_bytes))
         base64_encoded = base64.b64encode(image_bytes).decode('utf-8')
-        print(f"worker-comfyui - Successfully downloaded and encoded image from URL")
+        logger.info(f"Successfully downloaded and encoded image from URL")
         return base64_encoded
     except requests.RequestException as e:
-        print(f"worker-comfyui - Error downloading image from URL {image_url}: {e}")
+        logger.error(f"Error downloading image from URL {image_url}: {e}")
         return None
     except Exception as e:
-        print(f"worker-comfyui - Unexpected error converting URL to base64: {e}")
+        logger.error(f"Unexpected error converting URL to base64: {e}")
         return None
 
 
-def upload_images(images):
+def job_subfolder_name(job_id):
+    """
+    Build the per-job scratch subfolder name used for inputs and outputs.
+
+    Args:
+        job_id (str): The RunPod job ID.
+
+    Returns:
+        str: A filesystem-safe folder name.
+    """
+    return JOB_SUBFOLDER_PREFIX + re.sub(r"[^A-Za-z0-9_-]", "_", str(job_id))
+
+
+def scope_workflow_to_subfolder(workflow, subfolder, input_names):
+    """
+    Point a workflow at a per-job subfolder.
+
+    Inputs that reference an uploaded image by name (LoadImage and friends) are
+    rewritten to "subfolder/name", and every filename_prefix is prefixed with the
+    subfolder so outputs land in /comfyui/output/subfolder.
+
+    Args:
+        workflow (dict): The workflow to modify in place.
+        subfolder (str): The per-job subfolder.
+        input_names (iterable): Names of the images uploaded for this job.
+
+    Returns:
+        dict: The modified workflow.
+    """
+    if not isinstance(workflow, dict):
+        return workflow
+    input_names = set(input_names)
+    for node_id, node_data in workflow.items():
+        if not isinstance(node_data, dict) or not isinstance(node_data.get("inputs"), dict):
+            continue
+        inputs = node_data["inputs"]
+        for key, value in inputs.items():
+            if not isinstance(value, str):
+                continue
+            if value in input_names:
+                inputs[key] = f"{subfolder}/{value}"
+            elif key == "filename_prefix":
+                inputs[key] = f"{subfolder}/{value}"
+    return workflow
+
+
+def upload_images(images, subfolder=None):
     """
     Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
     注意: 此函数现在只处理 base64 编码的图片。URL 图片应在调用此函数前先转换为 base64。
@@ -439,79 +1164,65 @@ def upload_images(images):
     Args:
         images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as:
             - A base64 encoded string (with optional data URI prefix)
+        subfolder (str, optional): Subfolder of the ComfyUI input directory to upload into.
 
     Returns:
         dict: A dictionary indicating success or error.
     """
-    if not images:
-        return {"status": "success", "message": "No images to upload", "details": []}
-
-    responses = []
-    upload_errors = []
+    return comfy_client.run_sync(upload_images_async(images, subfolder))
 
-    print(f"worker-comfyui - Uploading {len(images)} image(s)...")
 
-    for image in images:
-        try:
-            name = image["name"]
-            image_data_uri = image["image"]  # Get the full string (should be base64 now)
-
-            # Handle base64 encoded data
-            # --- Strip Data URI prefix if present ---
-            if "," in image_data_uri:
-                # Find the comma and take everything after it
-                base64_data = image_data_uri.split(",", 1)[1]
-            else:
-                # Assume it's already pure base64
-                base64_data = image_data_uri
-            # --- End strip ---
-
-            blob = base64.b64decode(base64_data)  # Decode the cleaned data
-            content_type = "image/png"  # Default for base64
-
-            # Prepare the form data
-            files = {
-                "image": (name, BytesIO(blob), content_type),
-                "overwrite": (None, "true"),
-            }
+async def _upload_image_async(image, subfolder):
+    """Upload one image; returns (success message, None) or (None, error message)."""
+    name = image.get("name", "unknown")
+    try:
+        image_data_uri = image["image"]  # Get the full string (should be base64 now)
+
+        # Handle base64 encoded data
+        # --- Strip Data URI prefix if present ---
+        if "," in image_data_uri:
+            # Find the comma and take everything after it
+            base64_data = image_data_uri.split(",", 1)[1]
+        else:
+            # Assume it's already pure base64
+            base64_data = image_data_uri
+        # --- End strip ---
+
+        blob = base64.b64decode(base64_data)  # Decode the cleaned data
+        await comfy().upload_image(name, blob, subfolder=subfolder, content_type="image/png")
+
+        metrics.inc("worker_input_upload_bytes_total", len(blob))
+        logger.debug(f"Successfully uploaded {name}")
+        return f"Successfully uploaded {name}", None
+    except base64.binascii.Error as e:
+        error_msg = f"Error decoding base64 for {name}: {e}"
+    except comfy_client.ComfyClientError as e:
+        error_msg = f"Error uploading {name}: {e}"
+    except Exception as e:
+        error_msg = f"Unexpected error uploading {name}: {e}"
+    logger.error(error_msg)
+    return None, error_msg
 
-            # POST request to upload the image
-            response = requests.post(
-                f"http://{COMFY_HOST}/upload/image", files=files, timeout=30
-            )
-            response.raise_for_status()
 
-            responses.append(f"Successfully uploaded {name}")
-            print(f"worker-comfyui - Successfully uploaded {name}")
+async def upload_images_async(images, subfolder=None):
+    """Coroutine version of upload_images(); all images are uploaded concurrently."""
+    if not images:
+        return {"status": "success", "message": "No images to upload", "details": []}
 
-        except base64.binascii.Error as e:
-            error_msg = f"Error decoding base64 for {image.get('name', 'unknown')}: {e}"
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
-        except requests.Timeout:
-            error_msg = f"Timeout uploading {image.get('name', 'unknown')}"
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
-        except requests.RequestException as e:
-            error_msg = f"Error uploading {image.get('name', 'unknown')}: {e}"
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
-        except Exception as e:
-            error_msg = (
-                f"Unexpected error uploading {image.get('name', 'unknown')}: {e}"
-            )
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
+    logger.info(f"Uploading {len(images)} image(s)...")
+    results = await asyncio.gather(*(_upload_image_async(image, subfolder) for image in images))
+    responses = [ok for ok, _ in results if ok]
+    upload_errors = [error for _, error in results if error]
 
     if upload_errors:
-        print(f"worker-comfyui - image(s) upload finished with errors")
+        logger.warning(f"image(s) upload finished with errors")
         return {
             "status": "error",
             "message": "Some images failed to upload",
             "details": upload_errors,
         }
 
-    print(f"worker-comfyui - image(s) upload complete")
+    logger.info(f"image(s) upload complete")
     return {
         "status": "success",
         "message": "All images uploaded successfully",
@@ -519,297 +1230,2645 @@ def upload_images(images):
     }
 
 
-def get_available_models():
+_websocket_save_node_available = None
+
+
+async def websocket_save_node_available():
     """
-    Get list of available models from ComfyUI
+    Check (once per worker) whether ComfyUI provides the SaveImageWebsocket node.
 
     Returns:
-        dict: Dictionary containing available models by type
+        bool: True if the node is registered in /object_info.
     """
-    try:
-        response = requests.get(f"http://{COMFY_HOST}/object_info", timeout=10)
-        response.raise_for_status()
-        object_info = response.json()
-
-        # Extract available checkpoints from CheckpointLoaderSimple
-        available_models = {}
-        if "CheckpointLoaderSimple" in object_info:
-            checkpoint_info = object_info["CheckpointLoaderSimple"]
-            if "input" in checkpoint_info and "required" in checkpoint_info["input"]:
-                ckpt_options = checkpoint_info["input"]["required"].get("ckpt_name")
-                if ckpt_options and len(ckpt_options) > 0:
-                    available_models["checkpoints"] = (
-                        ckpt_options[0] if isinstance(ckpt_options[0], list) else []
-                    )
-
-        return available_models
-    except Exception as e:
-        print(f"worker-comfyui - Warning: Could not fetch available models: {e}")
-        return {}
+    global _websocket_save_node_available
+    if _websocket_save_node_available is None:
+        try:
+            object_info = await comfy().object_info("SaveImageWebsocket")
+            _websocket_save_node_available = "SaveImageWebsocket" in object_info
+        except Exception as e:
+            logger.warning(f"Could not query SaveImageWebsocket node: {e}")
+            return False
+    return _websocket_save_node_available
 
 
-def queue_workflow(workflow, client_id, comfy_org_api_key=None):
+def prepare_websocket_outputs(workflow):
     """
-    Queue a workflow to be processed by ComfyUI
+    Swap SaveImage nodes for SaveImageWebsocket so images are streamed in-band.
 
     Args:
-        workflow (dict): A dictionary containing the workflow to be processed
-        client_id (str): The client ID for the websocket connection
-        comfy_org_api_key (str, optional): Comfy.org API key for API Nodes
+        workflow (dict): The workflow to modify in place.
 
     Returns:
-        dict: The JSON response from ComfyUI after processing the workflow
-
-    Raises:
-        ValueError: If the workflow validation fails with detailed error information
+        dict: Mapping of swapped node ID -> original filename_prefix, used to name the
+        captured images.
     """
-    # Include client_id in the prompt payload
-    payload = {"prompt": workflow, "client_id": client_id}
-
-    # Optionally inject Comfy.org API key for API Nodes.
-    # Precedence: per-request key (argument) overrides environment variable.
-    # Note: We use our consistent naming (comfy_org_api_key) but transform to
-    # ComfyUI's expected format (api_key_comfy_org) when sending.
-    key_from_env = os.environ.get("COMFY_ORG_API_KEY")
-    effective_key = comfy_org_api_key if comfy_org_api_key else key_from_env
-    if effective_key:
-        payload["extra_data"] = {"api_key_comfy_org": effective_key}
-    data = json.dumps(payload).encode("utf-8")
-
-    # Use requests for consistency and timeout
-    headers = {"Content-Type": "application/json"}
-    response = requests.post(
-        f"http://{COMFY_HOST}/prompt", data=data, headers=headers, timeout=30
-    )
-
-    # Handle validation errors with detailed information
-    if response.status_code == 400:
-        print(f"worker-comfyui - ComfyUI returned 400. Response body: {response.text}")
-        try:
-            error_data = response.json()
-            print(f"worker-comfyui - Parsed error data: {error_data}")
-
-            # Try to extract meaningful error information
-            error_message = "Workflow validation failed"
-            error_details = []
-
-            # ComfyUI seems to return different error formats, let's handle them all
-            if "error" in error_data:
-                error_info = error_data["error"]
-                if isinstance(error_info, dict):
-                    error_message = error_info.get("message", error_message)
-                    if error_info.get("type") == "prompt_outputs_failed_validation":
-                        error_message = "Workflow validation failed"
-                else:
-                    error_message = str(error_info)
-
-            # Check for node validation errors in the response
-            if "node_errors" in error_data:
-                for node_id, node_error in error_data["node_errors"].items():
-                    if isinstance(node_error, dict):
-                        for error_type, error_msg in node_error.items():
-                            error_details.append(
-                                f"Node {node_id} ({error_type}): {error_msg}"
-                            )
-                    else:
-                        error_details.append(f"Node {node_id}: {node_error}")
-
-            # Check if the error data itself contains validation info
-            if error_data.get("type") == "prompt_outputs_failed_validation":
-                error_message = error_data.get("message", "Workflow validation failed")
-                # For this type of error, we need to parse the validation details from logs
-                # Since ComfyUI doesn't seem to include detailed validation errors in the response
-                # Let's provide a more helpful generic message
-                available_models = get_available_models()
-                if available_models.get("checkpoints"):
-                    error_message += f"\n\nThis usually means a required model or parameter is not available."
-                    error_message += f"\nAvailable checkpoint models: {', '.join(available_models['checkpoints'])}"
-                else:
-                    error_message += "\n\nThis usually means a required model or parameter is not available."
-                    error_message += "\nNo checkpoint models appear to be available. Please check your model installation."
-
-                raise ValueError(error_message)
-
-            # If we have specific validation errors, format them nicely
-            if error_details:
-                detailed_message = f"{error_message}:\n" + "\n".join(
-                    f"• {detail}" for detail in error_details
-                )
-
-                # Try to provide helpful suggestions for common errors
-                if any(
-                    "not in list" in detail and "ckpt_name" in detail
-                    for detail in error_details
-                ):
-                    available_models = get_available_models()
-                    if available_models.get("checkpoints"):
-                        detailed_message += f"\n\nAvailable checkpoint models: {', '.join(available_models['checkpoints'])}"
-                    else:
-                        detailed_message += "\n\nNo checkpoint models appear to be available. Please check your model installation."
-
-                raise ValueError(detailed_message)
-            else:
-                # Fallback to the raw response if we can't parse specific errors
-                raise ValueError(f"{error_message}. Raw response: {response.text}")
-
-        except (json.JSONDecodeError, KeyError) as e:
-            # If we can't parse the error response, fall back to the raw text
-            raise ValueError(
-                f"ComfyUI validation failed (could not parse error response): {response.text}"
-            )
-
-    # For other HTTP errors, raise them normally
-    response.raise_for_status()
-    return response.json()
+    capture_nodes = {}
+    for node_id, node_data in workflow.items():
+        if not isinstance(node_data, dict) or node_data.get("class_type") != "SaveImage":
+            continue
+        inputs = node_data.get("inputs", {})
+        capture_nodes[str(node_id)] = os.path.basename(
+            str(inputs.get("filename_prefix") or "ComfyUI")
+        )
+        node_data["class_type"] = "SaveImageWebsocket"
+        node_data["inputs"] = {"images": inputs.get("images")}
+    if capture_nodes:
+        logger.info(
+            f"Streaming outputs of {len(capture_nodes)} SaveImage node(s) via websocket"
+        )
+    return capture_nodes
 
 
-def get_history(prompt_id):
+def parse_binary_image_frame(frame):
     """
-    Retrieve the history of a given prompt using its ID
+    Decode a binary websocket frame carrying an image.
 
     Args:
-        prompt_id (str): The ID of the prompt whose history is to be retrieved
+        frame (bytes): The raw frame as returned by EventStream.receive().
 
     Returns:
-        dict: The history of the prompt, containing all the processing steps and results
+        tuple: (file_extension, image_bytes), or None if the frame is not an image.
     """
-    # Use requests for consistency and timeout
-    response = requests.get(f"http://{COMFY_HOST}/history/{prompt_id}", timeout=30)
-    response.raise_for_status()
-    return response.json()
+    if len(frame) < 8:
+        return None
+    event_type = int.from_bytes(frame[:4], "big")
+    if event_type != WS_BINARY_EVENT_PREVIEW_IMAGE:
+        return None
+    image_format = int.from_bytes(frame[4:8], "big")
+    return WS_BINARY_IMAGE_FORMATS.get(image_format, ".png"), frame[8:]
 
 
-def get_image_data(filename, subfolder, image_type):
+def extract_model_references(workflow):
     """
-    Fetch image bytes from the ComfyUI /view endpoint.
+    Collect the model files a workflow refers to.
 
     Args:
-        filename (str): The filename of the image.
-        subfolder (str): The subfolder where the image is stored.
-        image_type (str): The type of the image (e.g., 'output').
+        workflow (dict): The workflow in API format.
 
     Returns:
-        bytes: The raw image data, or None if an error occurs.
+        list: Sorted, de-duplicated model file references (e.g. "SDXL/model.safetensors").
     """
-    print(
-        f"worker-comfyui - Fetching image data: type={image_type}, subfolder={subfolder}, filename={filename}"
-    )
-    data = {"filename": filename, "subfolder": subfolder, "type": image_type}
-    url_values = urllib.parse.urlencode(data)
+    models = set()
+    if not isinstance(workflow, dict):
+        return []
+    for node_data in workflow.values():
+        if not isinstance(node_data, dict) or not isinstance(node_data.get("inputs"), dict):
+            continue
+        for value in node_data["inputs"].values():
+            if isinstance(value, str) and value.lower().endswith(MODEL_FILE_EXTENSIONS):
+                models.add(value.replace("\\", "/"))
+    return sorted(models)
+
+
+def find_model_file(name):
+    """Path of a referenced model file in the model folders, or None."""
+    models_root = os.environ.get("COMFY_MODELS_PATH", "/comfyui/models")
     try:
-        # Use requests for consistency and timeout
-        response = requests.get(f"http://{COMFY_HOST}/view?{url_values}", timeout=60)
-        response.raise_for_status()
-        print(f"worker-comfyui - Successfully fetched image data for {filename}")
-        return response.content
-    except requests.Timeout:
-        print(f"worker-comfyui - Timeout fetching image data for {filename}")
-        return None
-    except requests.RequestException as e:
-        print(f"worker-comfyui - Error fetching image data for {filename}: {e}")
-        return None
-    except Exception as e:
-        print(
-            f"worker-comfyui - Unexpected error fetching image data for {filename}: {e}"
-        )
+        folders = os.listdir(models_root)
+    except OSError:
         return None
+    for folder in folders:
+        path = os.path.join(models_root, folder, name)
+        if os.path.isfile(path):
+            return path
+    return None
 
 
-def get_video_data(filename, subfolder, image_type):
+def get_system_stats():
     """
-    Fetch video bytes from the ComfyUI /view endpoint.
-    This function uses the same endpoint as get_image_data since ComfyUI's /view endpoint
-    can handle both images and videos.
-
-    Args:
-        filename (str): The filename of the video.
-        subfolder (str): The subfolder where the video is stored.
-        image_type (str): The type of the file (e.g., 'output').
+    Retrieve ComfyUI's /system_stats (RAM and per-device VRAM information)
 
     Returns:
-        bytes: The raw video data, or None if an error occurs.
+        dict: The JSON response from ComfyUI
     """
-    print(
-        f"worker-comfyui - Fetching video data: type={image_type}, subfolder={subfolder}, filename={filename}"
-    )
-    # Use the same endpoint as images - ComfyUI's /view endpoint handles both
-    return get_image_data(filename, subfolder, image_type)
+    return comfy_sync().system_stats()
 
 
-def is_video_file(filename):
+def free_comfy_memory(unload_models=False, free_memory=False):
     """
-    Check if a filename represents a video file based on its extension.
+    Ask ComfyUI to unload models and/or release cached memory via /free
 
     Args:
-        filename (str): The filename to check.
-
-    Returns:
-        bool: True if the file is a video, False otherwise.
+        unload_models (bool): Unload all models from VRAM/RAM.
+        free_memory (bool): Release cached allocator memory.
     """
-    video_extensions = ('.mp4', '.webm', '.mov', '.avi', '.mkv', '.flv', '.wmv', '.m4v')
-    return filename.lower().endswith(video_extensions)
+    comfy_sync().free(unload_models=unload_models, free_memory=free_memory)
 
 
-def handler(job):
+class ModelResidencyManager:
     """
-    Handles a job using ComfyUI via websockets for status and media file retrieval.
-    Supports both image and video outputs from ComfyUI workflows.
+    Decide between jobs whether ComfyUI should keep its loaded models.
 
-    Args:
-        job (dict): A dictionary containing job details and input parameters.
+    Every model gets a usage score that decays per job and is bumped whenever a job
+    uses it. ComfyUI's /free can only unload all models at once, so before a job whose
+    new models would not fit next to the resident ones, the manager unloads everything
+    if any resident model is cold. A resident set that is entirely hot is kept and
+    ComfyUI's own offloading handles the overflow.
+    """
+
+    def __init__(self, vram_budget_bytes=0, decay=0.8, cold_score=0.25):
+        self.vram_budget_bytes = vram_budget_bytes
+        self.decay = decay
+        self.cold_score = cold_score
+        self.scores = {}
+        self.resident = set()
+        self.size_cache = {}
+        self.requests = 0
+        self.hits = 0
+
+    def model_size(self, name):
+        """Size in bytes of a referenced model file, searched in the model folders."""
+        if name not in self.size_cache:
+            path = find_model_file(name)
+            try:
+                self.size_cache[name] = os.path.getsize(path) if path else 0
+            except OSError:
+                self.size_cache[name] = 0
+        return self.size_cache[name]
+
+    def _budget(self):
+        if not self.vram_budget_bytes:
+            try:
+                devices = get_system_stats().get("devices", [])
+                self.vram_budget_bytes = devices[0].get("vram_total", 0) if devices else 0
+            except Exception as e:
+                logger.warning(f"Could not read VRAM budget from /system_stats: {e}")
+        return self.vram_budget_bytes
+
+    def before_job(self, models):
+        """
+        Prepare ComfyUI for a job needing the given models.
+
+        Args:
+            models (list): Model references of the incoming workflow.
+
+        Returns:
+            dict: The decision report for the job output.
+        """
+        needed = set(models)
+        hits = needed & self.resident
+        self.requests += len(needed)
+        self.hits += len(hits)
+        metrics.inc("model_residency_requests_total", len(needed))
+        metrics.inc("model_residency_hits_total", len(hits))
+
+        missing_bytes = sum(self.model_size(m) for m in needed - self.resident)
+        resident_bytes = sum(self.model_size(m) for m in self.resident)
+        cold = sorted(
+            m for m in self.resident - needed
+            if self.scores.get(m, 0.0) < self.cold_score
+        )
+        budget = self._budget()
+
+        decision = "keep"
+        if not needed - self.resident:
+            decision = "hit"
+        elif budget and resident_bytes + missing_bytes > budget and cold:
+            try:
+                free_comfy_memory(unload_models=True, free_memory=True)
+                decision = "evict"
+                self.resident = set()
+            except Exception as e:
+                logger.warning(f"/free request failed: {e}")
+
+        logger.info(
+            f"Model residency: {decision} "
+            f"({len(hits)}/{len(needed)} resident, {len(cold)} cold)"
+        )
+        return {
+            "decision": decision,
+            "models": len(needed),
+            "resident_hits": len(hits),
+            "evicted_cold": cold if decision == "evict" else [],
+            "hit_rate": round(self.hits / self.requests, 3) if self.requests else None,
+        }
+
+    def after_job(self, models):
+        """Record that the given models were used (and are now loaded)."""
+        for name in self.scores:
+            self.scores[name] *= self.decay
+        for name in models:
+            self.scores[name] = self.scores.get(name, 0.0) + 1.0
+        self.resident |= set(models)
+
+
+# ---------------------------------------------------------------------------
+# ComfyUI backend pool
+# ---------------------------------------------------------------------------
+
+
+class ComfyBackend:
+    """One ComfyUI instance of the pool and what the scheduler knows about it."""
+
+    def __init__(self, host):
+        self.host = host
+        self.in_flight = 0
+        self.jobs_total = 0
+        self.unhealthy_until = 0.0
+        # Per-instance residency decisions; the resident set doubles as the hint of
+        # which models are loaded there
+        self.residency = ModelResidencyManager(
+            vram_budget_bytes=MODEL_RESIDENCY_VRAM_MB * 1024 * 1024,
+            decay=MODEL_RESIDENCY_DECAY,
+            cold_score=MODEL_RESIDENCY_COLD_SCORE,
+        )
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+    def affinity(self, models):
+        """Fraction of the given models that recent jobs loaded on this backend."""
+        needed = set(models)
+        if not needed:
+            return 0.0
+        return len(needed & self.residency.resident) / len(needed)
+
+
+class BackendPool:
+    """
+    Route jobs over several ComfyUI instances.
+
+    acquire() picks the healthy backend with the lowest
+    in_flight - affinity_weight * affinity(models), so a backend that already has the
+    workflow's models loaded wins unless it is busier by more than affinity_weight
+    jobs. Ties go to the earlier host. Unreachable backends are skipped for retry_s
+    seconds; when every candidate is marked unhealthy, all of them are tried again.
+    """
+
+    def __init__(self, affinity_weight=1.0, retry_s=30):
+        self.affinity_weight = affinity_weight
+        self.retry_s = retry_s
+        self.backends = {}
+        self._lock = threading.Lock()
+
+    def _backend(self, host):
+        if host not in self.backends:
+            self.backends[host] = ComfyBackend(host)
+        return self.backends[host]
+
+    def acquire(self, hosts, models, exclude=()):
+        """
+        Reserve a slot on the best backend among hosts.
+
+        Returns:
+            ComfyBackend, or None if every host is excluded. Give it back with release().
+        """
+        with self._lock:
+            candidates = [self._backend(host) for host in hosts if host not in exclude]
+            if not candidates:
+                return None
+            healthy = [backend for backend in candidates if backend.healthy] or candidates
+            backend = min(
+                healthy,
+                key=lambda b: b.in_flight - self.affinity_weight * b.affinity(models),
+            )
+            backend.in_flight += 1
+            backend.jobs_total += 1
+            in_flight = backend.in_flight
+        metrics.set("comfy_backend_in_flight", in_flight, backend=backend.host)
+        metrics.inc("comfy_backend_jobs_total", backend=backend.host)
+        return backend
+
+    def release(self, backend):
+        with self._lock:
+            backend.in_flight -= 1
+            in_flight = backend.in_flight
+        metrics.set("comfy_backend_in_flight", in_flight, backend=backend.host)
+        metrics.set("comfy_backend_loaded_models", len(backend.residency.resident), backend=backend.host)
+
+    def mark_healthy(self, backend):
+        backend.unhealthy_until = 0.0
+        metrics.set("comfy_backend_healthy", 1, backend=backend.host)
+
+    def mark_unhealthy(self, backend):
+        backend.unhealthy_until = time.monotonic() + self.retry_s
+        metrics.set("comfy_backend_healthy", 0, backend=backend.host)
+        logger.warning(
+            f"ComfyUI backend {backend.host} is unreachable, skipping it for {self.retry_s}s"
+        )
+
+
+backend_pool = BackendPool(
+    affinity_weight=COMFY_BACKEND_AFFINITY_WEIGHT, retry_s=COMFY_BACKEND_RETRY_S
+)
+
+
+def concurrency_modifier(current_concurrency):
+    """
+    Tell runpod.serverless how many jobs this worker takes at once.
+
+    Args:
+        current_concurrency (int): The concurrency RunPod currently uses.
+
+    Returns:
+        int: WORKER_CONCURRENCY, so every backend of the pool gets a job.
+    """
+    return WORKER_CONCURRENCY
+
+
+async def _acquire_backend(models):
+    """
+    Reserve a reachable backend for a job, failing over to the next best one.
+
+    Args:
+        models (list): Model references of the job's workflow, for affinity.
+
+    Returns:
+        ComfyBackend, or None if no backend answered.
+    """
+    hosts = COMFY_HOSTS or [COMFY_HOST]
+    tried = set()
+    while len(tried) < len(set(hosts)):
+        backend = backend_pool.acquire(hosts, models, exclude=tried)
+        if backend is None:
+            break
+        tried.add(backend.host)
+        # While other backends are left to fail over to, one probe is enough; the
+        # last one gets the full wait because ComfyUI may still be starting
+        retries = COMFY_API_AVAILABLE_MAX_RETRIES if len(tried) == len(set(hosts)) else 1
+        client = comfy_client.get_client(backend.host, COMFY_CLIENT_MAX_CONCURRENCY)
+        if await client.wait_ready(retries, COMFY_API_AVAILABLE_INTERVAL_MS / 1000):
+            backend_pool.mark_healthy(backend)
+            return backend
+        backend_pool.release(backend)
+        backend_pool.mark_unhealthy(backend)
+    return None
+
+
+# ---------------------------------------------------------------------------
+# Priority lanes
+# ---------------------------------------------------------------------------
+
+
+class LaneTicket:
+    """A job's place in PriorityLanes, from admission until its prompt finishes."""
+
+    __slots__ = ("host", "lane", "admitted_at", "started")
+
+    def __init__(self, host, lane):
+        self.host = host
+        self.lane = lane
+        self.admitted_at = time.monotonic()
+        self.started = False
+
+
+class PriorityLanes:
+    """
+    Handler-side admission to ComfyUI's FIFO queue.
+
+    The queue depth is the number of prompts queued or running on a backend: the
+    larger of this worker's own prompts there and ComfyUI's /queue, when admit() is
+    given a way to read it. /queue also sees prompts of other clients and of jobs
+    that were queued before this worker started.
+
+    admit() holds low jobs while that depth is low_queue_depth or more, for at most
+    max_hold_s, and tells high jobs to queue in front unless a prompt admitted more
+    than max_hold_s ago has not started yet. Every ticket must be given back with
+    finish().
+    """
+
+    def __init__(self, low_queue_depth=2, max_hold_s=120, poll_interval_s=0.1):
+        self.low_queue_depth = low_queue_depth
+        self.max_hold_s = max_hold_s
+        self.poll_interval_s = poll_interval_s
+        self._tickets = {}
+        self._lock = threading.Lock()
+
+    def depth(self, host):
+        with self._lock:
+            return len(self._tickets.get(host, ()))
+
+    async def _queue_depth(self, host, queue_depth):
+        """ComfyUI's queue depth on host, or 0 if it is unknown."""
+        if queue_depth is None:
+            return 0
+        try:
+            return await queue_depth()
+        except comfy_client.ComfyClientError as e:
+            logger.debug(f"Could not read the queue of {host}: {e}")
+            return 0
+
+    def _try_admit(self, host, lane, force, queue_depth=0):
+        with self._lock:
+            tickets = self._tickets.setdefault(host, set())
+            depth = max(len(tickets), queue_depth)
+            if lane == "low" and not force and depth >= self.low_queue_depth:
+                return None
+            ticket = LaneTicket(host, lane)
+            tickets.add(ticket)
+            return ticket
+
+    async def admit(self, host, lane, queue_depth=None):
+        """
+        Wait until a job of the given lane may queue its prompt on host.
+
+        Args:
+            host (str): The backend the prompt goes to.
+            lane (str): One of PRIORITY_LANES.
+            queue_depth (callable, optional): Coroutine function returning the number
+                of prompts queued or running on host according to ComfyUI.
+
+        Returns:
+            tuple: (LaneTicket, front) where front says whether to queue the prompt
+            ahead of the pending ones.
+        """
+        if lane != "low":
+            queue_depth = None  # only the low lane looks at the depth
+        deadline = time.monotonic() + self.max_hold_s
+        ticket = self._try_admit(
+            host, lane, force=False, queue_depth=await self._queue_depth(host, queue_depth)
+        )
+        if ticket is None:
+            metrics.inc("worker_priority_held")
+            try:
+                while ticket is None:
+                    await asyncio.sleep(self.poll_interval_s)
+                    force = time.monotonic() >= deadline
+                    ticket = self._try_admit(
+                        host,
+                        lane,
+                        force=force,
+                        queue_depth=0 if force else await self._queue_depth(host, queue_depth),
+                    )
+            finally:
+                metrics.inc("worker_priority_held", -1)
+        if lane != "high":
+            return ticket, False
+        with self._lock:
+            starving = any(
+                not other.started and ticket.admitted_at - other.admitted_at > self.max_hold_s
+                for other in self._tickets[host]
+            )
+        if starving:
+            metrics.inc("worker_priority_front_skipped_total")
+        return ticket, not starving
+
+    def start(self, ticket):
+        """Record that the ticket's prompt started executing."""
+        if not ticket.started:
+            ticket.started = True
+            metrics.observe(
+                "worker_lane_queue_wait_ms",
+                (time.monotonic() - ticket.admitted_at) * 1000,
+                ticket.lane,
+            )
+
+    def finish(self, ticket):
+        with self._lock:
+            self._tickets.get(ticket.host, set()).discard(ticket)
+
+
+priority_lanes = PriorityLanes(
+    low_queue_depth=PRIORITY_LOW_QUEUE_DEPTH, max_hold_s=PRIORITY_MAX_HOLD_S
+)
+
+
+# ---------------------------------------------------------------------------
+# Predictive model preloading
+# ---------------------------------------------------------------------------
+
+
+class ModelTransitionHistory:
+    """
+    Remember which model set tends to follow which.
+
+    A model set is the sorted model references of a job. For every set the history
+    counts the sets of the jobs that came right after it, keeping at most
+    max_successors of them. Beyond max_sets, the least recently seen sets are dropped.
+    """
+
+    def __init__(self, max_sets=64, max_successors=8):
+        self.max_sets = max_sets
+        self.max_successors = max_successors
+        # set -> {following set: count}, least recently seen first
+        self.transitions = collections.OrderedDict()
+        # set -> loader nodes of the last workflow that used it (see _loader_nodes)
+        self.loaders = collections.OrderedDict()
+        self.last = None
+
+    def record(self, models, loaders=None):
+        """Record a job's model sets; jobs without model references are ignored."""
+        key = tuple(sorted(set(models)))
+        if not key:
+            return
+        if self.last is not None:
+            successors = self.transitions.pop(self.last, {})
+            # Re-inserted so that the most recent successor comes last
+            successors[key] = successors.pop(key, 0) + 1
+            if len(successors) > self.max_successors:
+                del successors[min(successors, key=successors.get)]
+            self.transitions[self.last] = successors
+            while len(self.transitions) > self.max_sets:
+                self.transitions.popitem(last=False)
+        if loaders:
+            self.loaders.pop(key, None)
+            self.loaders[key] = loaders
+            while len(self.loaders) > self.max_sets:
+                self.loaders.popitem(last=False)
+        self.last = key
+
+    def predict(self):
+        """The model set most likely to follow the last one (ties go to the most recent), or None."""
+        successors = self.transitions.get(self.last)
+        if not successors:
+            return None
+        return max(reversed(list(successors.items())), key=lambda item: item[1])[0]
+
+
+def _loader_nodes(workflows, models):
+    """
+    Loader nodes of the given workflows: nodes without linked inputs that reference
+    one of the models (checkpoint, VAE, CLIP, ControlNet loaders, ...).
+    """
+    models = set(models)
+    loaders = []
+    for workflow in workflows:
+        for node_data in workflow.values() if isinstance(workflow, dict) else ():
+            if not isinstance(node_data, dict) or not isinstance(node_data.get("inputs"), dict):
+                continue
+            inputs = node_data["inputs"]
+            if any(isinstance(value, list) for value in inputs.values()):
+                continue
+            if any(isinstance(value, str) and value.replace("\\", "/") in models for value in inputs.values()):
+                node = {"class_type": node_data.get("class_type"), "inputs": dict(inputs)}
+                if node not in loaders:
+                    loaders.append(node)
+    return loaders
+
+
+_preview_any_node_available = None
+
+
+async def preview_any_node_available():
+    """
+    Check (once per worker) whether ComfyUI provides the PreviewAny output node, which
+    the loader-only preload prompt needs to be a valid prompt.
+    """
+    global _preview_any_node_available
+    if _preview_any_node_available is None:
+        try:
+            object_info = await comfy().object_info("PreviewAny")
+            _preview_any_node_available = "PreviewAny" in object_info
+        except Exception as e:
+            logger.warning(f"Could not query PreviewAny node: {e}")
+            return False
+    return _preview_any_node_available
+
+
+class ModelPreloader:
+    """
+    Preload the models the next job most likely needs while a backend is idle.
+
+    Jobs report their models with record(). When a backend goes idle, schedule()
+    starts a task that waits idle_s, asks the transition history for the next model
+    set and reads its files into the OS page cache, skipping the models of the last
+    job. With use_prompt it then queues a loader-only prompt so ComfyUI loads them too,
+    waiting at most prompt_timeout_s for it to finish.
+    cancel() stops every preload at once: page cache reads stop at the next chunk and
+    a queued or running preload prompt is removed from ComfyUI.
+    """
+
+    def __init__(
+        self,
+        idle_s=2.0,
+        use_prompt=False,
+        history_size=64,
+        chunk_bytes=8 * 1024 * 1024,
+        prompt_timeout_s=300,
+    ):
+        self.idle_s = idle_s
+        self.use_prompt = use_prompt
+        self.prompt_timeout_s = prompt_timeout_s
+        self.chunk_bytes = chunk_bytes
+        self.history = ModelTransitionHistory(max_sets=history_size)
+        # host -> (asyncio.Task, threading.Event stopping its page cache reads)
+        self.tasks = {}
+        # Models preloaded since the last job, to count hits
+        self.preloaded = set()
+
+    def record(self, models, workflows):
+        """Add a job's models to the history and count the preloaded ones it uses."""
+        hits = len(self.preloaded & set(models))
+        if hits:
+            metrics.inc("model_preload_hits_total", hits)
+        self.preloaded = set()
+        self.history.record(models, _loader_nodes(workflows, models))
+
+    def schedule(self, backend):
+        """Start preloading for an idle backend (no-op if one is already running)."""
+        entry = self.tasks.get(backend.host)
+        if entry is not None and not entry[0].done():
+            return
+        stop = threading.Event()
+        task = asyncio.get_running_loop().create_task(self._preload(backend, stop))
+        self.tasks[backend.host] = (task, stop)
+
+    async def cancel(self):
+        """Stop all running preloads and wait until they have let go of ComfyUI."""
+        entries, self.tasks = list(self.tasks.values()), {}
+        running = [task for task, _ in entries if not task.done()]
+        loop = asyncio.get_running_loop()
+        for task, stop in entries:
+            stop.set()
+        # Tasks of another (finished) event loop cannot be awaited; their reads stop anyway
+        running = [task for task in running if task.get_loop() is loop]
+        for task in running:
+            task.cancel()
+        if running:
+            metrics.inc("model_preload_cancelled_total", len(running))
+            await asyncio.gather(*running, return_exceptions=True)
+
+    def _read_into_page_cache(self, paths, stop):
+        """Read files chunk by chunk (blocking); returns the bytes read."""
+        buffer = bytearray(self.chunk_bytes)
+        total = 0
+        for path in paths:
+            try:
+                with open(path, "rb", buffering=0) as f:
+                    while not stop.is_set():
+                        read = f.readinto(buffer)
+                        if not read:
+                            break
+                        total += read
+            except OSError as e:
+                logger.warning(f"Could not preload {path}: {e}")
+            if stop.is_set():
+                break
+        return total
+
+    async def _preload(self, backend, stop):
+        await asyncio.sleep(self.idle_s)
+        predicted = self.history.predict()
+        models = [name for name in predicted or () if name not in (self.history.last or ())]
+        if not models or backend.in_flight:
+            return
+        paths = [path for path in map(find_model_file, models) if path]
+        with log_context(backend=backend.host):
+            logger.info(f"Preloading {len(models)} model(s) predicted for the next job: {models}")
+            read = await asyncio.to_thread(self._read_into_page_cache, paths, stop)
+            metrics.inc("model_preload_bytes_total", read)
+            if stop.is_set():
+                return
+            self.preloaded |= set(models)
+            if self.use_prompt:
+                _job_backend.set(backend)
+                await self._load_with_prompt(backend, predicted, models)
+
+    async def _load_with_prompt(self, backend, model_set, models):
+        loaders = self.history.loaders.get(model_set) or []
+        loaders = [
+            node for node in loaders
+            if any(isinstance(value, str) and value.replace("\\", "/") in models for value in node["inputs"].values())
+        ]
+        if not loaders or not await preview_any_node_available():
+            return
+        workflow = {}
+        for index, node in enumerate(loaders):
+            workflow[f"preload_{index}"] = node
+            workflow[f"preload_{index}_out"] = {
+                "class_type": "PreviewAny",
+                "inputs": {"source": [f"preload_{index}", 0]},
+            }
+        prompt_id = None
+        try:
+            queued = await queue_workflow_async(workflow, f"preload-{uuid.uuid4()}")
+            prompt_id = queued.get("prompt_id")
+            deadline = time.monotonic() + self.prompt_timeout_s
+            missing_checks = 0
+            # Poll instead of holding a websocket: the prompt only runs while idle
+            while prompt_id:
+                state = await _reconcile_prompt_status_async(prompt_id)
+                if state["status"] == "success":
+                    break
+                missing_checks = missing_checks + 1 if state["status"] == "missing" else 0
+                if (
+                    state["status"] == "error"
+                    or missing_checks >= PROMPT_MISSING_MAX_CHECKS
+                    or time.monotonic() >= deadline
+                ):
+                    reason = state["status"] if state["status"] in ("error", "missing") else "timed out"
+                    logger.warning(
+                        f"Preload prompt {prompt_id} did not finish ({reason}), "
+                        f"models are not marked as loaded"
+                    )
+                    return
+                await asyncio.sleep(0.5)
+            backend.residency.resident |= set(models)
+            logger.info(f"Preload prompt {prompt_id} loaded {len(loaders)} loader node(s)")
+        except asyncio.CancelledError:
+            if prompt_id:
+                # Shielded so the preload cannot keep the GPU from the incoming job
+                try:
+                    await asyncio.shield(comfy().cancel_prompt(prompt_id))
+                    logger.info(f"Cancelled preload prompt {prompt_id}")
+                except comfy_client.ComfyClientError as e:
+                    logger.warning(f"Could not cancel preload prompt {prompt_id}: {e}")
+            raise
+        except (comfy_client.ComfyClientError, ValueError) as e:
+            # ValueError: ComfyUI rejected the preload workflow (400)
+            logger.warning(f"Preload prompt failed: {e}")
+        finally:
+            if prompt_id:
+                try:
+                    await asyncio.shield(comfy().delete_history([prompt_id]))
+                except comfy_client.ComfyClientError:
+                    pass
+
+
+model_preloader = ModelPreloader(
+    idle_s=MODEL_PRELOAD_IDLE_S,
+    use_prompt=MODEL_PRELOAD_PROMPT,
+    history_size=MODEL_PRELOAD_HISTORY_SIZE,
+    prompt_timeout_s=MODEL_PRELOAD_TIMEOUT_S,
+)
+
+
+def get_available_models():
+    """
+    Get list of available models from ComfyUI
+
+    Returns:
+        dict: Dictionary containing available models by type
+    """
+    try:
+        object_info = comfy_sync().object_info()
+
+        # Extract available checkpoints from CheckpointLoaderSimple
+        available_models = {}
+        if "CheckpointLoaderSimple" in object_info:
+            checkpoint_info = object_info["CheckpointLoaderSimple"]
+            if "input" in checkpoint_info and "required" in checkpoint_info["input"]:
+                ckpt_options = checkpoint_info["input"]["required"].get("ckpt_name")
+                if ckpt_options and len(ckpt_options) > 0:
+                    available_models["checkpoints"] = (
+                        ckpt_options[0] if isinstance(ckpt_options[0], list) else []
+                    )
+
+        return available_models
+    except Exception as e:
+        logger.warning(f"Could not fetch available models: {e}")
+        return {}
+
+
+def queue_workflow(workflow, client_id, comfy_org_api_key=None, front=False):
+    """
+    Queue a workflow to be processed by ComfyUI
+
+    Args:
+        workflow (dict): A dictionary containing the workflow to be processed
+        client_id (str): The client ID for the websocket connection
+        comfy_org_api_key (str, optional): Comfy.org API key for API Nodes
+        front (bool, optional): Queue ahead of all pending prompts
+
+    Returns:
+        dict: The JSON response from ComfyUI after processing the workflow
+
+    Raises:
+        ValueError: If the workflow validation fails with detailed error information
+    """
+    return comfy_client.run_sync(
+        queue_workflow_async(workflow, client_id, comfy_org_api_key, front=front)
+    )
+
+
+async def queue_workflow_async(workflow, client_id, comfy_org_api_key=None, front=False):
+    """Coroutine version of queue_workflow()."""
+    # Optionally inject Comfy.org API key for API Nodes.
+    # Precedence: per-request key (argument) overrides environment variable.
+    # Note: We use our consistent naming (comfy_org_api_key) but transform to
+    # ComfyUI's expected format (api_key_comfy_org) when sending.
+    key_from_env = os.environ.get("COMFY_ORG_API_KEY")
+    effective_key = comfy_org_api_key if comfy_org_api_key else key_from_env
+    extra_data = {"api_key_comfy_org": effective_key} if effective_key else None
+
+    try:
+        return await comfy().prompt(workflow, client_id, extra_data=extra_data, front=front)
+    except comfy_client.ComfyHTTPError as e:
+        # For other HTTP errors, raise them normally
+        if e.status != 400:
+            raise
+        # Handle validation errors with detailed information. Building the message
+        # may query /object_info through the blocking facade, so it runs in a thread.
+        logger.error(f"ComfyUI returned 400. Response body: {e.text}")
+        raise ValueError(await asyncio.to_thread(_describe_validation_error, e.text)) from None
+
+
+def _describe_validation_error(response_text):
+    """Turn the body of a 400 response from /prompt into a readable error message."""
+    try:
+        error_data = json.loads(response_text)
+        logger.debug(f"Parsed error data: {error_data}")
+
+        # Try to extract meaningful error information
+        error_message = "Workflow validation failed"
+        error_details = []
+
+        # ComfyUI seems to return different error formats, let's handle them all
+        if "error" in error_data:
+            error_info = error_data["error"]
+            if isinstance(error_info, dict):
+                error_message = error_info.get("message", error_message)
+                if error_info.get("type") == "prompt_outputs_failed_validation":
+                    error_message = "Workflow validation failed"
+            else:
+                error_message = str(error_info)
+
+        # Check for node validation errors in the response
+        if "node_errors" in error_data:
+            for node_id, node_error in error_data["node_errors"].items():
+                if isinstance(node_error, dict):
+                    for error_type, error_msg in node_error.items():
+                        error_details.append(
+                            f"Node {node_id} ({error_type}): {error_msg}"
+                        )
+                else:
+                    error_details.append(f"Node {node_id}: {node_error}")
+
+        # Check if the error data itself contains validation info
+        if error_data.get("type") == "prompt_outputs_failed_validation":
+            error_message = error_data.get("message", "Workflow validation failed")
+            # For this type of error, we need to parse the validation details from logs
+            # Since ComfyUI doesn't seem to include detailed validation errors in the response
+            # Let's provide a more helpful generic message
+            available_models = get_available_models()
+            if available_models.get("checkpoints"):
+                error_message += f"\n\nThis usually means a required model or parameter is not available."
+                error_message += f"\nAvailable checkpoint models: {', '.join(available_models['checkpoints'])}"
+            else:
+                error_message += "\n\nThis usually means a required model or parameter is not available."
+                error_message += "\nNo checkpoint models appear to be available. Please check your model installation."
+
+            return error_message
+
+        # If we have specific validation errors, format them nicely
+        if error_details:
+            detailed_message = f"{error_message}:\n" + "\n".join(
+                f"• {detail}" for detail in error_details
+            )
+
+            # Try to provide helpful suggestions for common errors
+            if any(
+                "not in list" in detail and "ckpt_name" in detail
+                for detail in error_details
+            ):
+                available_models = get_available_models()
+                if available_models.get("checkpoints"):
+                    detailed_message += f"\n\nAvailable checkpoint models: {', '.join(available_models['checkpoints'])}"
+                else:
+                    detailed_message += "\n\nNo checkpoint models appear to be available. Please check your model installation."
+
+            return detailed_message
+        # Fallback to the raw response if we can't parse specific errors
+        return f"{error_message}. Raw response: {response_text}"
+
+    except (json.JSONDecodeError, KeyError, AttributeError):
+        # If we can't parse the error response, fall back to the raw text
+        return f"ComfyUI validation failed (could not parse error response): {response_text}"
+
+
+def get_history(prompt_id):
+    """
+    Retrieve the history of a given prompt using its ID
+
+    Args:
+        prompt_id (str): The ID of the prompt whose history is to be retrieved
+
+    Returns:
+        dict: The history of the prompt, containing all the processing steps and results
+    """
+    return comfy_sync().history(prompt_id)
+
+
+def get_queue():
+    """
+    Retrieve the current ComfyUI execution queue
+
+    Returns:
+        dict: The queue state with "queue_running" and "queue_pending" lists. Each entry
+        is a list whose second element is the prompt ID.
+    """
+    return comfy_sync().queue()
+
+
+def _format_history_error(status_info):
+    """Build a human readable error from the 'status' block of a history entry."""
+    for message in status_info.get("messages", []):
+        if (
+            isinstance(message, (list, tuple))
+            and len(message) == 2
+            and message[0] == "execution_error"
+        ):
+            data = message[1] or {}
+            return f"Node Type: {data.get('node_type')}, Node ID: {data.get('node_id')}, Message: {data.get('exception_message')}"
+    return f"ComfyUI reported status '{status_info.get('status_str')}'"
+
+
+def _reconcile_prompt_status(prompt_id):
+    """
+    Determine the state of a prompt from /history and /queue instead of the websocket.
+
+    Used after a websocket reconnect (events sent during the gap are lost) and
+    periodically while waiting, so completion is detected even if the final
+    'executing' message never reaches us.
+
+    Args:
+        prompt_id (str): The prompt to look up.
+
+    Returns:
+        dict: {"status": "success" | "error" | "running" | "pending" | "missing" | "unknown",
+               "error": str or None, "history": dict or None}. "history" holds the
+               /history response when the prompt has finished so it can be reused.
+    """
+    try:
+        history = get_history(prompt_id)
+        return _status_from_history(prompt_id, history) or _status_from_queue(
+            prompt_id, get_queue()
+        )
+    except Exception as e:
+        logger.warning(f"Could not reconcile prompt status for {prompt_id}: {e}")
+        return {"status": "unknown", "error": None, "history": None}
+
+
+async def _reconcile_prompt_status_async(prompt_id):
+    """Coroutine version of _reconcile_prompt_status()."""
+    try:
+        history = await comfy().history(prompt_id)
+        return _status_from_history(prompt_id, history) or _status_from_queue(
+            prompt_id, await comfy().queue()
+        )
+    except Exception as e:
+        logger.warning(f"Could not reconcile prompt status for {prompt_id}: {e}")
+        return {"status": "unknown", "error": None, "history": None}
+
+
+def _status_from_history(prompt_id, history):
+    """Reconciled status of a finished prompt, or None if history does not settle it."""
+    prompt_history = history.get(prompt_id)
+    if prompt_history is not None:
+        status_info = prompt_history.get("status") or {}
+        if status_info.get("status_str") == "error":
+            return {
+                "status": "error",
+                "error": _format_history_error(status_info),
+                "history": history,
+            }
+        if status_info.get("completed", True):
+            return {"status": "success", "error": None, "history": history}
+    return None
+
+
+def _status_from_queue(prompt_id, queue):
+    """Reconciled status of a prompt that has not finished: running, pending or missing."""
+    for state, key in (("running", "queue_running"), ("pending", "queue_pending")):
+        for entry in queue.get(key, []):
+            if isinstance(entry, (list, tuple)) and len(entry) > 1 and entry[1] == prompt_id:
+                return {"status": state, "error": None, "history": None}
+    return {"status": "missing", "error": None, "history": None}
+
+
+async def _comfy_queue_depth():
+    """Number of prompts queued or running on the job's backend, according to /queue."""
+    queue = await comfy().queue()
+    return len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+
+
+def delete_history(prompt_id):
+    """
+    Remove a prompt from ComfyUI's in-memory history
+
+    Args:
+        prompt_id (str or list): The ID of the prompt to delete, or a list of IDs
+    """
+    comfy_sync().delete_history(prompt_id if isinstance(prompt_id, list) else [prompt_id])
+
+
+def get_image_data(filename, subfolder, image_type):
+    """
+    Fetch image bytes from the ComfyUI /view endpoint.
+
+    Args:
+        filename (str): The filename of the image.
+        subfolder (str): The subfolder where the image is stored.
+        image_type (str): The type of the image (e.g., 'output').
+
+    Returns:
+        bytes: The raw image data, or None if an error occurs.
+    """
+    return comfy_client.run_sync(get_image_data_async(filename, subfolder, image_type))
+
+
+async def get_image_data_async(filename, subfolder, image_type):
+    """Coroutine version of get_image_data(); the body is streamed from /view."""
+    logger.debug(
+        f"Fetching image data: type={image_type}, subfolder={subfolder}, filename={filename}"
+    )
+    try:
+        data = await comfy().view(filename, subfolder, image_type)
+        logger.debug(f"Successfully fetched image data for {filename}")
+        return data
+    except comfy_client.ComfyClientError as e:
+        logger.error(f"Error fetching image data for {filename}: {e}")
+        return None
+    except Exception as e:
+        logger.error(
+            f"Unexpected error fetching image data for {filename}: {e}"
+        )
+        return None
+
+
+def get_video_data(filename, subfolder, image_type):
+    """
+    Fetch video bytes from the ComfyUI /view endpoint.
+    This function uses the same endpoint as get_image_data since ComfyUI's /view endpoint
+    can handle both images and videos.
+
+    Args:
+        filename (str): The filename of the video.
+        subfolder (str): The subfolder where the video is stored.
+        image_type (str): The type of the file (e.g., 'output').
+
+    Returns:
+        bytes: The raw video data, or None if an error occurs.
+    """
+    logger.debug(
+        f"Fetching video data: type={image_type}, subfolder={subfolder}, filename={filename}"
+    )
+    # Use the same endpoint as images - ComfyUI's /view endpoint handles both
+    return get_image_data(filename, subfolder, image_type)
+
+
+def is_video_file(filename):
+    """
+    Check if a filename represents a video file based on its extension.
+
+    Args:
+        filename (str): The filename to check.
+
+    Returns:
+        bool: True if the file is a video, False otherwise.
+    """
+    video_extensions = ('.mp4', '.webm', '.mov', '.avi', '.mkv', '.flv', '.wmv', '.m4v')
+    return filename.lower().endswith(video_extensions)
+
+
+def get_video_mime_type(filename):
+    """
+    Return the MIME type used in data URIs for a video filename.
+
+    Args:
+        filename (str): The video filename.
+
+    Returns:
+        str: The MIME type, defaulting to "video/mp4" for unknown extensions.
+    """
+    filename_lower = filename.lower()
+    if filename_lower.endswith('.mp4') or filename_lower.endswith('.m4v'):
+        return "video/mp4"
+    elif filename_lower.endswith('.webm'):
+        return "video/webm"
+    elif filename_lower.endswith('.mov'):
+        return "video/quicktime"
+    elif filename_lower.endswith('.avi'):
+        return "video/x-msvideo"
+    elif filename_lower.endswith('.mkv'):
+        return "video/x-matroska"
+    elif filename_lower.endswith('.flv'):
+        return "video/x-flv"
+    elif filename_lower.endswith('.wmv'):
+        return "video/x-ms-wmv"
+    # Default fallback for unknown video formats
+    return "video/mp4"
+
+
+def _upload_output_to_s3(job_id, filename, file_bytes, in_memory=False):
+    """
+    Upload output bytes to the configured S3 bucket.
+
+    Args:
+        job_id (str): The job ID, used by rp_upload to build the object key.
+        filename (str): The output filename (its extension is preserved).
+        file_bytes (bytes): The file content.
+        in_memory (bool): Upload straight from memory instead of via a temporary file.
+
+    Returns:
+        str: The uploaded object URL.
+    """
+    file_extension = os.path.splitext(filename)[1] or (
+        ".mp4" if is_video_file(filename) else ".png"
+    )
+    if in_memory:
+        # Same key layout as upload_image: {job_id}/{random}{ext}
+        object_name = f"{uuid.uuid4().hex[:8]}{file_extension}"
+        return rp_upload.upload_in_memory_object(
+            object_name, file_bytes, prefix=job_id
+        )
+
+    temp_file_path = None
+    try:
+        with tempfile.NamedTemporaryFile(
+            suffix=file_extension, delete=False
+        ) as temp_file:
+            temp_file.write(file_bytes)
+            temp_file_path = temp_file.name
+        logger.debug(
+            f"Wrote output bytes to temporary file: {temp_file_path}"
+        )
+        # Note: RunPod S3-compatible API does NOT support presigned URLs
+        # The returned URL is the S3 path that requires S3 API Key authentication
+        return rp_upload.upload_image(job_id, temp_file_path)
+    finally:
+        if temp_file_path and os.path.exists(temp_file_path):
+            try:
+                os.remove(temp_file_path)  # Clean up temp file
+            except OSError as rm_err:
+                logger.error(
+                    f"Error removing temp file {temp_file_path}: {rm_err}"
+                )
+
+
+class ContentAddressedStore:
+    """
+    Upload outputs to S3 under their content hash, once.
+
+    Objects are keyed {prefix}/{sha256}{ext}. A local index remembers when each key
+    was last known to exist; within ttl_s it is trusted as is, otherwise a HEAD
+    request checks the bucket before anything is uploaded. Identical bytes therefore
+    cost one upload in total, and jobs repeating them get the existing object's URL.
+    """
+
+    def __init__(self, prefix="cas", bucket="", index_path="", ttl_s=24 * 3600):
+        self.prefix = prefix
+        self.bucket = bucket
+        self.index_path = index_path
+        self.ttl_s = ttl_s
+        self.index = None
+        self._client = None
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def client(self):
+        """The boto3 client of rp_upload (None if S3 is not configured)."""
+        if self._client is None:
+            self._client, _ = rp_upload.get_boto_client()
+        return self._client
+
+    def object_key(self, filename, data):
+        """Content-addressed key of an output."""
+        file_extension = os.path.splitext(filename)[1].lower() or (
+            ".mp4" if is_video_file(filename) else ".png"
+        )
+        digest = hashlib.sha256(data).hexdigest()
+        return f"{self.prefix}/{digest}{file_extension}" if self.prefix else f"{digest}{file_extension}"
+
+    def _load_index(self):
+        self.index = {}
+        if not self.index_path or not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        entry = (record["bucket"], record["key"])
+                        self.index[entry] = max(self.index.get(entry, 0), float(record["ts"]))
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except OSError as e:
+            logger.warning(f"Could not read S3 dedup index {self.index_path}: {e}")
+
+    def known(self, bucket, key):
+        """True if the object was seen in the bucket less than ttl_s ago."""
+        with self._lock:
+            if self.index is None:
+                self._load_index()
+            seen_at = self.index.get((bucket, key))
+        return seen_at is not None and time.time() - seen_at < self.ttl_s
+
+    def remember(self, bucket, key):
+        """Record that the object exists now, persisting it if index_path is set."""
+        now = time.time()
+        with self._lock:
+            if self.index is None:
+                self._load_index()
+            self.index[(bucket, key)] = now
+            if self.index_path:
+                try:
+                    os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+                    with open(self.index_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps({"bucket": bucket, "key": key, "ts": now}) + "\n")
+                except OSError as e:
+                    logger.warning(f"Could not write S3 dedup index {self.index_path}: {e}")
+
+    def exists(self, client, bucket, key):
+        """HEAD the object; errors other than "not found" count as missing."""
+        try:
+            client.head_object(Bucket=bucket, Key=key)
+            return True
+        except Exception as e:
+            code = str(getattr(e, "response", {}).get("Error", {}).get("Code", ""))
+            if code not in ("404", "NoSuchKey", "NotFound"):
+                logger.warning(f"HEAD {bucket}/{key} failed, uploading anyway: {e}")
+            return False
+
+    def upload(self, filename, data):
+        """
+        Store an output unless an object with the same content already exists.
+
+        Args:
+            filename (str): The output filename (its extension is kept in the key).
+            data (bytes): The file content.
+
+        Returns:
+            tuple: (object URL, True if an existing object was reused), or None if
+            S3 is not configured.
+        """
+        client = self.client()
+        if client is None:
+            return None
+        bucket = self.bucket or time.strftime("%m-%y")
+        key = self.object_key(filename, data)
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault((bucket, key), threading.Lock())
+        # Concurrent outputs with identical bytes wait for the first upload
+        with key_lock:
+            reused = self.known(bucket, key)
+            if not reused:
+                reused = self.exists(client, bucket, key)
+                if not reused:
+                    content_type = (
+                        get_video_mime_type(filename)
+                        if is_video_file(filename)
+                        else mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                    )
+                    client.put_object(Bucket=bucket, Key=key, Body=data, ContentType=content_type)
+                self.remember(bucket, key)
+        with self._lock:
+            self._key_locks.pop((bucket, key), None)
+
+        url = client.generate_presigned_url(
+            "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=604800
+        )
+        return url, reused
+
+
+content_store = ContentAddressedStore(
+    prefix=S3_CONTENT_PREFIX,
+    bucket=S3_CONTENT_BUCKET,
+    index_path=S3_DEDUP_INDEX_PATH,
+    ttl_s=S3_DEDUP_INDEX_TTL_S,
+)
+
+
+def _zstd_module():
+    """Return the zstd module of Python 3.14+ or backports.zstd, or None."""
+    try:
+        from compression import zstd
+    except ImportError:
+        try:
+            from backports import zstd
+        except ImportError:
+            return None
+    return zstd
+
+
+def compress_result_bytes(filename, data, encoding):
+    """
+    Compress an output before it is base64-encoded.
+
+    Args:
+        filename (str): The output filename; already compressed formats are skipped.
+        data (bytes): The file content.
+        encoding (str): "gzip" or "zstd".
+
+    Returns:
+        tuple: (bytes, encoding used), with "identity" if the data was left as is.
+    """
+    if filename.lower().endswith(RESULT_ENCODING_SKIP_EXTENSIONS):
+        return data, "identity"
+    if encoding == "gzip":
+        compressed = gzip.compress(data, compresslevel=6, mtime=0)
+    else:
+        compressed = _zstd_module().compress(data, level=3)
+    if len(compressed) >= len(data):
+        return data, "identity"
+    return compressed, encoding
+
+
+def _deliver_output(
+    job_id, filename, file_bytes, output_data, errors, in_memory=False, timer=None,
+    result_encoding=None,
+):
+    """
+    Upload one output file to S3 or encode it as base64 and record the result.
+
+    Args:
+        job_id (str): The job ID.
+        filename (str): The output filename.
+        file_bytes (bytes): The file content.
+        output_data (list): Receives the {"filename", "type", "data"} entry on success.
+            With S3_CONTENT_ADDRESSED, S3 entries also report "deduplicated".
+        errors (list): Receives an error message on failure.
+        in_memory (bool): Upload to S3 without writing a temporary file.
+        timer (PhaseTimer, optional): Receives the "s3_upload" / "compress" / "encode" durations.
+        result_encoding (str, optional): "gzip" or "zstd" compresses base64 results;
+            the entry then reports "encoding", "original_size" and "compression_ratio".
+
+    Returns:
+        bool: True if the output was delivered.
+    """
+    timer = timer or PhaseTimer()
+    is_video = is_video_file(filename)
+    media_type = "video" if is_video else "image"
+
+    if os.environ.get("BUCKET_ENDPOINT_URL"):
+        try:
+            logger.info(f"Uploading {filename} to S3...")
+            with timer.phase("s3_upload"):
+                stored = (
+                    content_store.upload(filename, file_bytes)
+                    if S3_CONTENT_ADDRESSED
+                    else None
+                )
+                if stored is None:
+                    uploaded_url = _upload_output_to_s3(
+                        job_id, filename, file_bytes, in_memory=in_memory
+                    )
+                    deduplicated = False
+                else:
+                    uploaded_url, deduplicated = stored
+            if deduplicated:
+                metrics.inc("worker_s3_dedup_hits_total")
+                metrics.inc("worker_s3_dedup_saved_bytes_total", len(file_bytes))
+                logger.info(f"{filename} is already in S3: {uploaded_url}")
+            else:
+                metrics.inc("worker_s3_upload_bytes_total", len(file_bytes))
+                logger.info(f"Uploaded {filename} to S3: {uploaded_url}")
+
+            # Remove query parameters from URL for cleaner output
+            # Query parameters are not needed since RunPod S3 doesn't support presigned URLs
+            if "?" in uploaded_url:
+                s3_url = uploaded_url.split("?")[0]
+                logger.debug(
+                    f"Removed query parameters from URL for cleaner output"
+                )
+            else:
+                s3_url = uploaded_url
+
+            logger.debug(
+                f"Note: Access this file using S3 API Key credentials"
+            )
+
+            # Append dictionary with filename and URL
+            output_data.append(
+                {
+                    "filename": filename,
+                    "type": "s3_url",
+                    "data": s3_url,
+                    **({"deduplicated": deduplicated} if S3_CONTENT_ADDRESSED else {}),
+                }
+            )
+            return True
+        except Exception as e:
+            error_msg = f"Error uploading {filename} to S3: {e}"
+            logger.error(error_msg)
+            errors.append(error_msg)
+            return False
+
+    # Return as base64 string
+    try:
+        # Check file size before encoding (videos can be very large)
+        file_size_mb = len(file_bytes) / (1024 * 1024)
+        max_size_mb = 100  # 100MB limit for base64 encoding
+
+        if is_video and file_size_mb > max_size_mb:
+            error_msg = (
+                f"Video file {filename} is too large ({file_size_mb:.2f} MB) "
+                f"for base64 encoding (max {max_size_mb} MB). "
+                f"Please configure S3 upload (BUCKET_ENDPOINT_URL) for large files."
+            )
+            logger.error(error_msg)
+            errors.append(error_msg)
+            return False
+
+        payload, encoding_fields = file_bytes, {}
+        if result_encoding and result_encoding != "none":
+            with timer.phase("compress"):
+                payload, used_encoding = compress_result_bytes(filename, file_bytes, result_encoding)
+            encoding_fields = {
+                "encoding": used_encoding,
+                "original_size": len(file_bytes),
+                "compression_ratio": round(len(file_bytes) / max(1, len(payload)), 3),
+            }
+            metrics.inc("worker_result_encoding_saved_bytes_total", len(file_bytes) - len(payload))
+
+        with timer.phase("encode"):
+            base64_data = base64.b64encode(payload).decode("utf-8")
+            # For videos, add data URI prefix similar to images (not for compressed data)
+            if is_video and payload is file_bytes:
+                base64_data = f"data:{get_video_mime_type(filename)};base64,{base64_data}"
+        del payload
+
+        metrics.inc("worker_base64_bytes_total", len(base64_data))
+        # Append dictionary with filename and base64 data
+        output_data.append(
+            {
+                "filename": filename,
+                "type": "base64",
+                "data": base64_data,
+                **encoding_fields,
+            }
+        )
+        logger.info(f"Encoded {filename} as base64 ({media_type}, {file_size_mb:.2f} MB)")
+        return True
+    except MemoryError as e:
+        error_msg = (
+            f"Out of memory while encoding {filename} to base64. "
+            f"File size: {len(file_bytes) / (1024 * 1024):.2f} MB. "
+            f"Please configure S3 upload (BUCKET_ENDPOINT_URL) for large files."
+        )
+        logger.error(error_msg)
+        errors.append(error_msg)
+    except Exception as e:
+        error_msg = f"Error encoding {filename} to base64: {e}"
+        logger.exception(error_msg)
+        errors.append(error_msg)
+    return False
+
+
+def _comfy_dir(kind):
+    """Return the ComfyUI 'output' or 'input' directory (overridable via COMFY_<KIND>_PATH)."""
+    return os.environ.get(f"COMFY_{kind.upper()}_PATH", f"/comfyui/{kind}")
+
+
+def _resolve_comfy_file(root, subfolder, filename):
+    """Join subfolder/filename onto root, refusing paths that escape root."""
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, subfolder or "", filename))
+    if os.path.commonpath([root, path]) != root:
+        return None
+    return path
+
+
+def cleanup_job(prompt_id, output_files, input_files, job_subfolder=None):
+    """
+    Remove everything a finished job left behind in ComfyUI.
+
+    Args:
+        prompt_id (str or list): The prompt(s) to delete from /history (None if
+            never queued).
+        output_files (list): (subfolder, filename) tuples of delivered outputs.
+        input_files (list): (subfolder, filename) tuples of uploaded inputs.
+        job_subfolder (str, optional): Per-job subfolder removed from both the input
+            and output directory in one go.
+
+    Returns:
+        dict: Counts of removed history entries and files.
+    """
+    removed = {"history": 0, "outputs": 0, "inputs": 0}
+    if prompt_id:
+        try:
+            delete_history(prompt_id)
+            removed["history"] = len(prompt_id) if isinstance(prompt_id, list) else 1
+        except Exception as e:
+            logger.warning(f"Could not delete history for {prompt_id}: {e}")
+
+    for kind, files in (("outputs", output_files), ("inputs", input_files)):
+        root = _comfy_dir(kind[:-1])
+        if job_subfolder:
+            job_dir = _resolve_comfy_file(root, job_subfolder, "")
+            if job_dir and job_dir != os.path.realpath(root) and os.path.isdir(job_dir):
+                removed[kind] += sum(len(names) for _, _, names in os.walk(job_dir))
+                shutil.rmtree(job_dir, ignore_errors=True)
+        for subfolder, filename in files:
+            path = _resolve_comfy_file(root, subfolder, filename)
+            if not path:
+                continue
+            try:
+                os.remove(path)
+                removed[kind] += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not remove {path}: {e}")
+
+    logger.info(
+        f"Cleanup removed {removed['history']} history entry, "
+        f"{removed['outputs']} output file(s), {removed['inputs']} input file(s)"
+    )
+    _maybe_start_sweep()
+    return removed
+
+
+def sweep_comfy_directories(max_age_s, max_dir_bytes, now=None):
+    """
+    Age- and size-bounded sweep of the ComfyUI input and output folders.
+
+    Only files inside per-job subfolders (see job_subfolder_name) are considered, so
+    static assets in the folders themselves are never touched. Files older than
+    max_age_s are removed; if the job files of a folder are still larger than
+    max_dir_bytes, the oldest remaining ones are removed until they fit. Files below
+    a folder named in CLEANUP_EXEMPT_DIRS are left alone.
+
+    Args:
+        max_age_s (int): Maximum file age in seconds.
+        max_dir_bytes (int): Maximum total size per folder in bytes.
+        now (float, optional): Reference timestamp, defaults to time.time().
+
+    Returns:
+        dict: Number of removed files and bytes per folder kind.
+    """
+    now = time.time() if now is None else now
+    stats = {}
+    for kind in ("output", "input"):
+        root = _comfy_dir(kind)
+        files = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d not in CLEANUP_EXEMPT_DIRS]
+            if dirpath == root:
+                dirnames[:] = [d for d in dirnames if d.startswith(JOB_SUBFOLDER_PREFIX)]
+                continue
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+
+        files.sort()
+        total_bytes = sum(size for _, size, _ in files)
+        removed_files = 0
+        removed_bytes = 0
+        for mtime, size, path in files:
+            if now - mtime <= max_age_s and total_bytes <= max_dir_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            removed_files += 1
+            removed_bytes += size
+
+        # Drop per-job subfolders emptied by the sweep
+        for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+            parts = os.path.relpath(dirpath, root).split(os.sep)
+            if (
+                dirpath != root
+                and parts[0].startswith(JOB_SUBFOLDER_PREFIX)
+                and not os.listdir(dirpath)
+                and not any(part in CLEANUP_EXEMPT_DIRS for part in parts)
+            ):
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass
+
+        stats[kind] = {"files": removed_files, "bytes": removed_bytes}
+    return stats
+
+
+_sweep_lock = threading.Lock()
+_last_sweep = 0.0
+
+
+def _maybe_start_sweep():
+    """Start a background directory sweep if CLEANUP_SWEEP_INTERVAL_S has elapsed."""
+    global _last_sweep
+    if CLEANUP_SWEEP_INTERVAL_S <= 0:
+        return
+    if time.monotonic() - _last_sweep < CLEANUP_SWEEP_INTERVAL_S:
+        return
+    if not _sweep_lock.acquire(blocking=False):
+        return  # a sweep is already running
+    _last_sweep = time.monotonic()
+
+    def _run():
+        try:
+            stats = sweep_comfy_directories(
+                CLEANUP_MAX_AGE_S, CLEANUP_MAX_DIR_MB * 1024 * 1024
+            )
+            logger.info(f"Directory sweep finished: {stats}")
+        except Exception as e:
+            logger.error(f"Directory sweep failed: {e}")
+        finally:
+            _sweep_lock.release()
+
+    threading.Thread(target=_run, name="comfy-sweep", daemon=True).start()
+
+
+# ---------------------------------------------------------------------------
+# Per-phase timing of each job
+# ---------------------------------------------------------------------------
+
+class PhaseTimer:
+    """Accumulate monotonic wall time per named job phase."""
+
+    def __init__(self, profiler=None):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.per_output = {}
+        # Optional MemoryProfiler, sampled at the end of every phase
+        self.profiler = profiler
+        # Output deliveries record their phases from worker threads
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+            if self.profiler is not None:
+                self.profiler.checkpoint(name)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def report(self):
+        """Return the breakdown in milliseconds, as placed under "timings" in the result."""
+        report = {f"{name}_ms": round(sec * 1000, 2) for name, sec in self.phases.items()}
+        if self.per_output:
+            report["per_output_fetch_ms"] = {
+                name: round(sec * 1000, 2) for name, sec in self.per_output.items()
+            }
+        report["total_ms"] = round((time.perf_counter() - self.started) * 1000, 2)
+        return report
+
+
+# phase name -> Histogram of its duration in ms, aggregated over the worker's lifetime
+phase_histograms = metrics.histogram(
+    "worker_phase_duration_ms",
+    "Duration of each handler phase in milliseconds",
+    PHASE_HISTOGRAM_BUCKETS_MS,
+    label="phase",
+)
+metrics.histogram(
+    "worker_lane_latency_ms",
+    "End-to-end job duration per priority lane in milliseconds",
+    PHASE_HISTOGRAM_BUCKETS_MS,
+    label="lane",
+)
+metrics.histogram(
+    "worker_lane_queue_wait_ms",
+    "Time from admission until the prompt started executing, per priority lane",
+    PHASE_HISTOGRAM_BUCKETS_MS,
+    label="lane",
+)
+
+
+def record_phase_timings(timings):
+    """Add a job's "timings" report to the in-process phase histograms."""
+    for key, value in timings.items():
+        if not key.endswith("_ms") or not isinstance(value, (int, float)):
+            continue
+        metrics.observe("worker_phase_duration_ms", value, key[:-3])
+
+
+# ---------------------------------------------------------------------------
+# Per-job memory profiling
+# ---------------------------------------------------------------------------
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+# Number of MemoryProfiler instances currently using tracemalloc
+_tracemalloc_users = 0
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_owned = False
+
+
+def current_rss_bytes():
+    """Resident set size of this process from /proc/self/statm, or None if unavailable."""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _mb(num_bytes):
+    return round(num_bytes / (1024 * 1024), 2) if num_bytes is not None else None
+
+
+class MemoryProfiler:
+    """
+    Sample handler memory at phase boundaries of one job.
+
+    Each checkpoint reads RSS and the tracemalloc counters, which is cheap. Only two
+    tracemalloc snapshots are taken per job: a baseline at start and one at the
+    checkpoint where traced memory was highest, so the reported allocation sites are
+    the ones holding memory at the job's peak. tracemalloc is process-wide; while
+    several jobs run concurrently, traced figures include the other jobs.
+    """
+
+    def __init__(self, top_sites=MEMORY_PROFILE_TOP_SITES, frames=MEMORY_PROFILE_FRAMES):
+        self.top_sites = top_sites
+        self.frames = max(1, frames)
+        self.checkpoints = []
+        self.baseline = None
+        self.peak_snapshot = None
+        self.peak_traced = 0
+        self.peak_snapshot_traced = -1
+        self.rss_start = None
+        self.started = False
+
+    def start(self):
+        global _tracemalloc_users, _tracemalloc_owned
+        with _tracemalloc_lock:
+            if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                _tracemalloc_owned = True
+            elif _tracemalloc_users == 0:
+                tracemalloc.reset_peak()
+            _tracemalloc_users += 1
+        self.started = True
+        self.rss_start = current_rss_bytes()
+        self.baseline = tracemalloc.take_snapshot()
+        return self
+
+    def checkpoint(self, name):
+        """Record RSS and traced memory after a phase; snapshot when traced memory is at a new high."""
+        if not self.started:
+            return
+        traced, peak = tracemalloc.get_traced_memory()
+        self.peak_traced = max(self.peak_traced, peak)
+        self.checkpoints.append((name, current_rss_bytes(), traced))
+        # Re-snapshot only on >10% growth so steadily growing jobs don't snapshot every phase
+        if traced > self.peak_snapshot_traced * 1.1:
+            self.peak_snapshot_traced = traced
+            self.peak_snapshot = tracemalloc.take_snapshot()
+
+    def stop(self):
+        global _tracemalloc_users, _tracemalloc_owned
+        if not self.started:
+            return
+        self.started = False
+        with _tracemalloc_lock:
+            _tracemalloc_users -= 1
+            if _tracemalloc_users == 0 and _tracemalloc_owned:
+                tracemalloc.stop()
+                _tracemalloc_owned = False
+
+    def _top_sites(self):
+        if self.baseline is None or self.peak_snapshot is None:
+            return []
+        ignore = (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        )
+        diff = self.peak_snapshot.filter_traces(ignore).compare_to(
+            self.baseline.filter_traces(ignore), "lineno"
+        )
+        sites = []
+        for stat in diff[: self.top_sites]:
+            if stat.size_diff <= 0:
+                break
+            frame = stat.traceback[0]
+            sites.append(
+                {
+                    "site": f"{os.path.basename(frame.filename)}:{frame.lineno}",
+                    "size_kb": round(stat.size_diff / 1024, 1),
+                    "count": stat.count_diff,
+                }
+            )
+        return sites
+
+    def report(self, output_data=None):
+        """
+        Stop profiling and summarise the job's memory use.
+
+        Args:
+            output_data (list, optional): The result's "images" list; the bytes of
+                its inline base64 payloads are reported as output_data_mb.
+
+        Returns:
+            dict: The report placed under "memory" in the job result.
+        """
+        self.stop()
+        rss_values = [rss for _, rss, _ in self.checkpoints if rss is not None]
+        if self.rss_start is not None:
+            rss_values.append(self.rss_start)
+        held = sum(
+            len(item.get("data") or "")
+            for item in output_data or []
+            if isinstance(item, dict) and item.get("type") == "base64"
+        )
+        return {
+            "rss_start_mb": _mb(self.rss_start),
+            "peak_rss_mb": _mb(max(rss_values)) if rss_values else None,
+            "traced_peak_mb": _mb(self.peak_traced),
+            "output_data_mb": _mb(held),
+            "phases": {
+                name: {"rss_mb": _mb(rss), "traced_mb": _mb(traced)}
+                for name, rss, traced in self.checkpoints
+            },
+            "top_sites": self._top_sites(),
+        }
+
+
+def _wants_memory_profile(job_input):
+    """True if the job asks for profiling or falls in the MEMORY_PROFILE_SAMPLE_RATE sample."""
+    if isinstance(job_input, str):
+        try:
+            job_input = json.loads(job_input)
+        except json.JSONDecodeError:
+            job_input = None
+    if isinstance(job_input, dict) and job_input.get("memory_profile"):
+        return True
+    return MEMORY_PROFILE_SAMPLE_RATE > 0 and random.random() < MEMORY_PROFILE_SAMPLE_RATE
+
+
+# ---------------------------------------------------------------------------
+# Per-node execution timeline built from websocket events
+# ---------------------------------------------------------------------------
+
+
+class NodeTimeline:
+    """
+    Build a per-node timeline of one prompt from ComfyUI websocket events.
+
+    Consumes execution_start, executing, execution_cached, progress and executed
+    messages. Times are milliseconds relative to the first event of the prompt.
+    """
+
+    def __init__(self, prompt_id, workflow):
+        self.prompt_id = prompt_id
+        self.workflow = workflow if isinstance(workflow, dict) else {}
+        self.started = None
+        self.nodes = {}
+        self.order = []
+        self.current = None
+
+    def _now_ms(self):
+        now = time.perf_counter()
+        if self.started is None:
+            self.started = now
+        return round((now - self.started) * 1000, 2)
+
+    def _entry(self, node_id):
+        node_id = str(node_id)
+        if node_id not in self.nodes:
+            node_data = self.workflow.get(node_id)
+            self.nodes[node_id] = {
+                "node_id": node_id,
+                "class_type": node_data.get("class_type") if isinstance(node_data, dict) else None,
+                "start_ms": None,
+                "end_ms": None,
+                "cached": False,
+                "steps": None,
+            }
+            self.order.append(node_id)
+        return self.nodes[node_id]
+
+    def _close_current(self, now_ms):
+        if self.current is not None:
+            entry = self.nodes[self.current]
+            if entry["end_ms"] is None:
+                entry["end_ms"] = now_ms
+            self.current = None
+
+    def on_message(self, message):
+        """Feed one decoded websocket JSON message; messages for other prompts are ignored."""
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        if data.get("prompt_id") != self.prompt_id:
+            return
+        now_ms = self._now_ms()
+        if msg_type == "executing":
+            self._close_current(now_ms)
+            node_id = data.get("node")
+            if node_id is not None:
+                entry = self._entry(node_id)
+                entry["start_ms"] = now_ms
+                self.current = entry["node_id"]
+        elif msg_type == "execution_cached":
+            for node_id in data.get("nodes") or []:
+                entry = self._entry(node_id)
+                entry.update(cached=True, start_ms=now_ms, end_ms=now_ms)
+        elif msg_type == "progress" and data.get("node") is not None:
+            self._entry(data["node"])["steps"] = {
+                "value": data.get("value"),
+                "max": data.get("max"),
+            }
+        elif msg_type == "executed" and data.get("node") is not None:
+            entry = self._entry(data["node"])
+            entry["end_ms"] = now_ms
+            if self.current == entry["node_id"]:
+                self.current = None
+
+    def entries(self):
+        """Return the timeline in execution order with per-node durations."""
+        result = []
+        for node_id in self.order:
+            entry = dict(self.nodes[node_id])
+            if entry["start_ms"] is not None and entry["end_ms"] is not None:
+                entry["duration_ms"] = round(entry["end_ms"] - entry["start_ms"], 2)
+            else:
+                entry["duration_ms"] = None
+            result.append(entry)
+        return result
+
+
+# class_type -> {"runs", "cached", "total_ms", "max_ms"} aggregated over the worker's lifetime
+node_class_stats = {}
+
+
+def record_node_timeline(entries):
+    """Aggregate a prompt's timeline entries per class_type."""
+    for entry in entries:
+        stats = node_class_stats.setdefault(
+            entry.get("class_type") or "unknown",
+            {"runs": 0, "cached": 0, "total_ms": 0.0, "max_ms": 0.0},
+        )
+        if entry.get("cached"):
+            stats["cached"] += 1
+            continue
+        duration = entry.get("duration_ms")
+        if duration is None:
+            continue
+        stats["runs"] += 1
+        stats["total_ms"] = round(stats["total_ms"] + duration, 2)
+        stats["max_ms"] = max(stats["max_ms"], duration)
+
+
+# ---------------------------------------------------------------------------
+# Anonymized job trace recording
+# ---------------------------------------------------------------------------
+
+_trace_lock = threading.Lock()
+
+
+def _workflow_hashes(job_input):
+    """Return (workflow_hash, graph_hash) of a job's workflow, or (None, None)."""
+    try:
+        if isinstance(job_input, str):
+            job_input = json.loads(job_input)
+        workflow = job_input.get("workflow")
+        if not isinstance(workflow, dict):
+            return None, None
+        workflow_hash = hashlib.sha256(
+            json.dumps(workflow, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()[:16]
+        # Graph hash ignores input values (prompts, seeds, filenames): same template -> same hash
+        graph = sorted(
+            (str(node_id), node.get("class_type", ""))
+            for node_id, node in workflow.items()
+            if isinstance(node, dict)
+        )
+        graph_hash = hashlib.sha256(json.dumps(graph).encode("utf-8")).hexdigest()[:16]
+        return workflow_hash, graph_hash
+    except Exception:
+        return None, None
+
+
+def _input_sizes(job_input):
+    """Approximate decoded byte size of each input image (None for URLs)."""
+    if isinstance(job_input, str):
+        try:
+            job_input = json.loads(job_input)
+        except json.JSONDecodeError:
+            return []
+    sizes = []
+    for image in (job_input or {}).get("images") or []:
+        data = image.get("image", "") if isinstance(image, dict) else ""
+        if not isinstance(data, str) or data.startswith(("http://", "https://")):
+            sizes.append(None)
+            continue
+        data = data.split(",", 1)[1] if "," in data else data
+        sizes.append(len(data) * 3 // 4)
+    return sizes
+
+
+def record_job_trace(path, hashes, job_input, result, trace):
+    """
+    Append one anonymized job envelope as a JSON line.
+
+    The envelope holds no prompts, images, filenames or job IDs: only the workflow
+    hashes, input/output sizes, per-phase timings and the node timeline (class_type,
+    durations, cached flags), which is what tests/replay_trace.py needs.
+    """
+    timeline = [
+        {
+            "class_type": entry.get("class_type"),
+            "duration_ms": entry.get("duration_ms"),
+            "cached": entry.get("cached"),
+        }
+        for entry in trace.get("node_timeline") or []
+    ]
+    timings = dict(result.get("timings", {}))
+    # Per-output fetch times are keyed by filename; keep only the values
+    timings["per_output_fetch_ms"] = list(timings.get("per_output_fetch_ms", {}).values())
+    envelope = {
+        "recorded_at": round(time.time(), 3),
+        "workflow_hash": hashes[0],
+        "graph_hash": hashes[1],
+        "status": "error" if "error" in result else "success",
+        "input_bytes": _input_sizes(job_input),
+        "outputs": trace.get("outputs", []),
+        "timings": timings,
+        "node_timeline": timeline,
+    }
+    line = json.dumps(envelope, separators=(",", ":"))
+    try:
+        with _trace_lock, open(path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        logger.warning(f"Could not write job trace to {path}: {e}")
+
+
+_transcode_pool = None
+_transcode_pool_lock = threading.Lock()
+
+
+def _get_transcode_pool():
+    """Return the process pool used for transcoding, starting it on first use."""
+    global _transcode_pool
+    with _transcode_pool_lock:
+        if _transcode_pool is None:
+            # spawn: forking a process that runs an event loop and logging threads can
+            # leave locks held in the child
+            _transcode_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max(1, TRANSCODE_WORKERS),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            atexit.register(_transcode_pool.shutdown, cancel_futures=True)
+        return _transcode_pool
+
+
+def _reset_transcode_pool():
+    """Drop a broken pool (a worker died, e.g. OOM) so the next call starts a fresh one."""
+    global _transcode_pool
+    with _transcode_pool_lock:
+        _transcode_pool = None
+
+
+async def transcode_output_async(filename, file_bytes, options, timer=None):
+    """
+    Transcode one output in the process pool (see media_transcode.transcode_output).
+    Callers check media_transcode.needs_transcode() first to skip the round trip.
+
+    Returns:
+        tuple: (filename, bytes, list of error messages). If transcoding fails the
+        original file is kept and the failure is reported as an error.
+    """
+    timer = timer or PhaseTimer()
+    loop = asyncio.get_running_loop()
+    try:
+        with timer.phase("transcode"):
+            new_filename, new_bytes = await loop.run_in_executor(
+                _get_transcode_pool(), media_transcode.transcode_output, filename, file_bytes, options
+            )
+    except (media_transcode.TranscodeError, concurrent.futures.process.BrokenProcessPool) as e:
+        if isinstance(e, concurrent.futures.process.BrokenProcessPool):
+            _reset_transcode_pool()
+        error_msg = f"Could not transcode {filename}, returning it unchanged: {e}"
+        logger.warning(error_msg)
+        return filename, file_bytes, [error_msg]
+
+    metrics.inc("worker_transcode_input_bytes_total", len(file_bytes))
+    metrics.inc("worker_transcode_output_bytes_total", len(new_bytes))
+    logger.info(
+        f"Transcoded {filename} -> {new_filename} "
+        f"({len(file_bytes) / (1024 * 1024):.2f} MB -> {len(new_bytes) / (1024 * 1024):.2f} MB)"
+    )
+    return new_filename, new_bytes, []
+
+
+async def make_derivatives_async(filename, file_bytes, options, timer=None):
+    """
+    Build the inline previews of one output in the transcode process pool
+    (see media_transcode.make_derivatives).
+
+    Returns:
+        tuple: ({kind: {"filename", "type": "base64", "data": data URI}}, list of error messages)
+    """
+    timer = timer or PhaseTimer()
+    loop = asyncio.get_running_loop()
+    try:
+        with timer.phase("derivatives"):
+            derivatives, errors = await loop.run_in_executor(
+                _get_transcode_pool(), media_transcode.make_derivatives, filename, file_bytes, options
+            )
+    except concurrent.futures.process.BrokenProcessPool as e:
+        _reset_transcode_pool()
+        return {}, [f"Could not create previews for {filename}: {e}"]
+    for error_msg in errors:
+        logger.warning(error_msg)
+
+    entries = {}
+    for kind, (name, mime, payload) in derivatives.items():
+        metrics.inc("worker_derivative_bytes_total", len(payload))
+        entries[kind] = {
+            "filename": name,
+            "type": "base64",
+            "data": f"data:{mime};base64,{base64.b64encode(payload).decode('utf-8')}",
+        }
+    return entries, errors
+
+
+async def _deliver_output_async(
+    job_id, filename, file_bytes, in_memory=False, timer=None, transcode=None,
+    result_encoding=None, derivatives=None,
+):
+    """
+    Transcode one output if the job asks for it, then run _deliver_output() in a
+    worker thread (S3 uploads and base64 encoding block). Requested previews are
+    built from the original file at the same time and added to the entry.
+
+    Returns:
+        tuple: (output entry or None, list of error messages)
+    """
+    previews = None
+    if derivatives:
+        previews = asyncio.create_task(
+            make_derivatives_async(filename, file_bytes, derivatives, timer)
+        )
+    try:
+        errors = []
+        if transcode and media_transcode.needs_transcode(filename, transcode):
+            filename, file_bytes, errors = await transcode_output_async(
+                filename, file_bytes, transcode, timer
+            )
+        output_data = []
+        await asyncio.to_thread(
+            _deliver_output, job_id, filename, file_bytes, output_data, errors, in_memory, timer,
+            result_encoding,
+        )
+    except BaseException:
+        if previews is not None:
+            previews.cancel()
+        raise
+    entry = output_data[0] if output_data else None
+    if previews is not None:
+        preview_entries, preview_errors = await previews
+        errors.extend(preview_errors)
+        if entry:
+            entry.update(preview_entries)
+    return entry, errors
+
+
+async def _fetch_and_deliver_output(
+    job_id, filename, subfolder, img_type, timer, trace, transcode=None, result_encoding=None,
+    derivatives=None,
+):
+    """
+    Fetch one output file from /view and deliver it.
+
+    Returns:
+        tuple: (output entry or None, list of error messages)
+    """
+    # Check if this is a video file
+    is_video = is_video_file(filename)
+    media_type = "video" if is_video else "image"
+
+    # Fetch the file data (/view serves both images and videos)
+    fetch_started = time.perf_counter()
+    file_bytes = await get_image_data_async(filename, subfolder, img_type)
+    fetch_s = time.perf_counter() - fetch_started
+    metrics.inc("worker_output_fetch_bytes_total", len(file_bytes or b""))
+    timer.add("output_fetch", fetch_s)
+    timer.per_output[filename] = fetch_s
+    if not file_bytes:
+        return None, [f"Failed to fetch {media_type} data for {filename} from /view endpoint."]
+
+    trace["outputs"].append({"bytes": len(file_bytes), "video": is_video})
+    return await _deliver_output_async(
+        job_id, filename, file_bytes, timer=timer, transcode=transcode,
+        result_encoding=result_encoding, derivatives=derivatives,
+    )
+
+
+class PromptRun:
+    """
+    One prompt of a job.
+
+    A job queues one prompt per workflow on a single websocket client. Each prompt's
+    outputs are collected by its own task as soon as it finishes, while the job's
+    later prompts are still executing.
+    """
+
+    def __init__(self, index, workflow):
+        self.index = index
+        self.workflow = workflow
+        self.prompt_id = None
+        # SaveImage node ID -> filename prefix, for websocket output capture
+        self.capture_nodes = {}
+        # node_id -> list of (file_extension, bytes) received as binary frames
+        self.captured_images = {}
+        self.timeline = None
+        self.timeline_entries = None
+        # Node IDs ComfyUI ran, and those it served from its cache (execution_cached)
+        self.executed_nodes = []
+        self.cached_nodes = []
+        self.missing_checks = 0
+        self.finished = False
+        # /history response, when reconciliation already fetched it
+        self.history = None
+        self.history_missing = False
+        self.collector = None
+        self.output_data = []
+        self.errors = []
+        # Files to remove once the job is done: (subfolder, filename)
+        self.delivered_output_files = []
+
+
+async def _queue_prompt_async(workflow, client_id, validated_data, front, timer):
+    """
+    Queue one workflow and return its prompt ID.
+
+    Raises:
+        ValueError: If ComfyUI rejected the workflow or could not be reached.
+    """
+    try:
+        # Pass per-request API key if provided in input
+        with timer.phase("queue"):
+            queued_workflow = await queue_workflow_async(
+                workflow,
+                client_id,
+                comfy_org_api_key=validated_data.get("comfy_org_api_key"),
+                front=front,
+            )
+        prompt_id = queued_workflow.get("prompt_id")
+        if not prompt_id:
+            raise ValueError(
+                f"Missing 'prompt_id' in queue response: {queued_workflow}"
+            )
+        return prompt_id
+    except comfy_client.ComfyClientError as e:
+        logger.error(f"Error queuing workflow: {e}")
+        raise ValueError(f"Error queuing workflow: {e}")
+    except Exception as e:
+        logger.error(f"Unexpected error queuing workflow: {e}")
+        # For ValueError exceptions from queue_workflow, pass through the original message
+        if isinstance(e, ValueError):
+            raise e
+        else:
+            raise ValueError(f"Unexpected error queuing workflow: {e}")
+
+
+def _media_to_fetch(outputs, errors):
+    """
+    List the files a prompt's history outputs refer to.
+
+    Args:
+        outputs (dict): The "outputs" of the prompt's /history entry.
+        errors (list): Receives a warning for every malformed entry.
+
+    Returns:
+        list: (filename, subfolder, type) of every file to fetch, in history order.
+    """
+    media_to_fetch = []
+    for node_id, node_output in outputs.items():
+        # Process "images", "gifs", and "animated" outputs (all are media files)
+        media_files = []
+        if "images" in node_output:
+            media_files.extend(node_output["images"])
+        if "gifs" in node_output:
+            media_files.extend(node_output["gifs"])
+        if "animated" in node_output:
+            media_files.extend(node_output["animated"])
+
+        if media_files:
+            logger.debug(
+                f"Node {node_id} contains {len(media_files)} media file(s)"
+            )
+            for image_info in media_files:
+                # Skip non-dict items (e.g., bool values that might be in the list)
+                if not isinstance(image_info, dict):
+                    warn_msg = f"Skipping non-dict media file in node {node_id}: {type(image_info).__name__} = {image_info}"
+                    logger.warning(warn_msg)
+                    errors.append(warn_msg)
+                    continue
+
+                filename = image_info.get("filename")
+                subfolder = image_info.get("subfolder", "")
+                img_type = image_info.get("type")
+
+                # skip temp files
+                if img_type == "temp":
+                    logger.debug(
+                        f"Skipping {filename} because type is 'temp'"
+                    )
+                    continue
+
+                if not filename:
+                    warn_msg = f"Skipping media file in node {node_id} due to missing filename: {image_info}"
+                    logger.warning(warn_msg)
+                    errors.append(warn_msg)
+                    continue
+
+                media_to_fetch.append((filename, subfolder, img_type))
+
+        # Check for other output types (excluding images, gifs, and animated which we handle)
+        other_keys = [k for k in node_output.keys() if k not in ["images", "gifs", "animated"]]
+        if other_keys:
+            warn_msg = (
+                f"Node {node_id} produced unhandled output keys: {other_keys}."
+            )
+            logger.warning(warn_msg)
+            logger.warning(
+                f"--> If this output is useful, please consider opening an issue on GitHub to discuss adding support."
+            )
+    return media_to_fetch
+
+
+async def _collect_prompt_outputs(run, job_id, validated_data, timer, trace):
+    """
+    Deliver the outputs of a finished prompt into run.output_data.
+
+    Fetches the prompt's history (even after execution errors, some outputs might
+    exist) unless reconciliation already did, then delivers the images captured from
+    the websocket and the files listed in history.
+    """
+    prompt_id = run.prompt_id
+    history = run.history
+    run.history = None
+    if history is None:
+        logger.debug(f"Fetching history for prompt {prompt_id}...")
+        with timer.phase("history_fetch"):
+            history = await comfy().history(prompt_id)
+
+    if prompt_id not in history:
+        error_msg = f"Prompt ID {prompt_id} not found in history after execution."
+        logger.error(error_msg)
+        run.history_missing = True
+        run.errors.append(error_msg)
+        return
+
+    outputs = history.get(prompt_id, {}).get("outputs", {})
+    delivery_options = {
+        "transcode": validated_data["transcode"],
+        "result_encoding": validated_data["result_encoding"],
+        "derivatives": validated_data["derivatives"],
+    }
+
+    # Deliver images captured in-band from the websocket (never written to disk)
+    captured = []
+    for node_id, images in run.captured_images.items():
+        logger.info(
+            f"Node {node_id} streamed {len(images)} image(s) via websocket"
+        )
+        for index, (file_extension, image_bytes) in enumerate(images, start=1):
+            filename = f"{run.capture_nodes[node_id]}_{node_id}_{index:05d}_{file_extension}"
+            trace["outputs"].append({"bytes": len(image_bytes), "video": False})
+            captured.append((filename, image_bytes))
+    run.captured_images.clear()
+    delivered = await asyncio.gather(
+        *(
+            _deliver_output_async(
+                job_id, filename, image_bytes, in_memory=True, timer=timer, **delivery_options
+            )
+            for filename, image_bytes in captured
+        )
+    )
+    del captured
+    for entry, item_errors in delivered:
+        if entry:
+            run.output_data.append(entry)
+        run.errors.extend(item_errors)
+
+    if not outputs and not run.output_data:
+        warning_msg = f"No outputs found in history for prompt {prompt_id}."
+        logger.warning(warning_msg)
+        if not run.errors:
+            run.errors.append(warning_msg)
+
+    logger.info(f"Processing {len(outputs)} output nodes...")
+    media_to_fetch = _media_to_fetch(outputs, run.errors)
+
+    # Fetch and deliver all files concurrently (bounded by the client's request
+    # limit), then record the results in history order
+    results = await asyncio.gather(
+        *(
+            _fetch_and_deliver_output(
+                job_id, filename, subfolder, img_type, timer, trace, **delivery_options
+            )
+            for filename, subfolder, img_type in media_to_fetch
+        )
+    )
+    for (filename, subfolder, img_type), (entry, item_errors) in zip(media_to_fetch, results):
+        if entry:
+            run.output_data.append(entry)
+            if img_type == "output":
+                run.delivered_output_files.append((subfolder, filename))
+        run.errors.extend(item_errors)
+
+
+def _prompt_result(run, node_timeline=False):
+    """
+    Build the result of one prompt: the job result, or one entry of a multi-workflow
+    job's "workflows" list.
+    """
+    if run.history_missing:
+        if len(run.errors) == 1:
+            return {"error": run.errors[0]}
+        return {
+            "error": "Job processing failed, prompt ID not found in history.",
+            "details": run.errors,
+        }
+
+    output_data, errors = run.output_data, run.errors
+    result = {}
+
+    if output_data:
+        result["images"] = output_data
+
+    if node_timeline and run.timeline_entries is not None:
+        result["node_timeline"] = run.timeline_entries
+
+    if errors:
+        result["errors"] = errors
+        logger.warning(f"Job completed with errors/warnings: {errors}")
+
+    if not output_data and errors:
+        logger.error(f"Job failed with no output media files.")
+        return {
+            "error": "Job processing failed",
+            "details": errors,
+        }
+    elif not output_data and not errors:
+        logger.info(
+            f"Job completed successfully, but the workflow produced no media files."
+        )
+        result["status"] = "success_no_images"
+        result["images"] = []
+
+    # Count images and videos separately for logging
+    image_count = sum(1 for item in output_data if not is_video_file(item.get("filename", "")))
+    video_count = sum(1 for item in output_data if is_video_file(item.get("filename", "")))
+
+    if video_count > 0:
+        logger.info(f"Job completed. Returning {len(output_data)} media file(s): {image_count} image(s), {video_count} video(s).")
+    else:
+        logger.info(f"Job completed. Returning {len(output_data)} image(s).")
+
+    return result
+
+
+def handler(job):
+    """
+    Synchronous entry point: runs async_handler() on the comfy_client background loop.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Returns:
+        dict: The result of async_handler().
+    """
+    return comfy_client.run_sync(async_handler(job))
+
+
+async def async_handler(job):
+    """
+    Handles a job using ComfyUI via websockets for status and media file retrieval.
+    Supports both image and video outputs from ComfyUI workflows.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
 
     Returns:
         dict: A dictionary containing either an error message or a success status with generated images/videos.
         The output structure includes:
         - "images": Array of media files (images or videos) with filename, type (base64 or s3_url), and data
+        - "workflows": For input.workflows, one such result per workflow in input order
         - "status": "success_no_images" if workflow completed but produced no output
         - "errors": Array of error messages if any occurred
+        - "timings": Per-phase durations in milliseconds (also on error results)
+        - "memory": Memory profile of the job, when profiling is enabled for it
+    """
+    init_worker()
+    # The GPU and disk belong to the job now, not to a speculative preload
+    await model_preloader.cancel()
+    with log_context(job_id=job.get("id")):
+        profiler = MemoryProfiler().start() if _wants_memory_profile(job.get("input")) else None
+        timer = PhaseTimer(profiler)
+        # Facts collected for the trace recorder (output sizes, node timeline)
+        trace = {"outputs": [], "node_timeline": None}
+        recording = bool(TRACE_RECORD_PATH) and random.random() < TRACE_RECORD_SAMPLE_RATE
+        hashes = _workflow_hashes(job.get("input")) if recording else None
+
+        metrics.inc("worker_jobs_in_flight")
+        # _run_job binds the backend it picks to this context
+        backend_token = _job_backend.set(None)
+        try:
+            result = await _run_job(job, timer, trace)
+        finally:
+            metrics.inc("worker_jobs_in_flight", -1)
+            backend = _job_backend.get()
+            if backend is not None:
+                backend_pool.release(backend)
+                if MODEL_PRELOAD and backend.in_flight == 0 and backend.healthy:
+                    model_preloader.schedule(backend)
+            _job_backend.reset(backend_token)
+            if profiler is not None:
+                profiler.stop()
+        metrics.inc("worker_jobs_total", status="error" if "error" in result else "success")
+        timings = timer.report()
+        result["timings"] = timings
+        record_phase_timings(timings)
+        if trace.get("priority"):
+            metrics.observe("worker_lane_latency_ms", timings["total_ms"], trace["priority"])
+        logger.info("Job timings", extra={"fields": {"timings_ms": timings}})
+        if profiler is not None:
+            result["memory"] = profiler.report(
+                result.get("images")
+                or [image for item in result.get("workflows", []) for image in item.get("images", [])]
+            )
+            summary = {k: v for k, v in result["memory"].items() if k.endswith("_mb")}
+            logger.info("Job memory profile", extra={"fields": summary})
+        if recording:
+            record_job_trace(TRACE_RECORD_PATH, hashes, job.get("input"), result, trace)
+        return result
+
+
+async def _run_job(job, timer, trace=None):
     """
+    Run one job end to end.
+
+    A job with input.workflows queues one prompt per workflow back to back and
+    collects each prompt's outputs as soon as it finishes. Phases are recorded on the
+    given PhaseTimer; output sizes and the node timeline are added to the optional
+    trace dict for the trace recorder. If the coroutine is cancelled, the job's
+    unfinished prompts are removed from ComfyUI's queue or interrupted.
+    """
+    trace = trace if trace is not None else {"outputs": [], "node_timeline": None}
     job_input = job["input"]
     job_id = job["id"]
 
     # Make sure that the input is valid
-    validated_data, error_message = validate_input(job_input)
+    with timer.phase("validation"):
+        validated_data, error_message = validate_input(job_input)
     if error_message:
         return {"error": error_message}
 
-    # Extract validated data
-    workflow = validated_data["workflow"]
+    # Extract validated data; a multi-workflow job runs one prompt per workflow
+    multi = validated_data["workflows"] is not None
+    workflows = validated_data["workflows"] if multi else [validated_data["workflow"]]
     input_images = validated_data.get("images")
 
     # 标准化工作流中的路径（将 Windows 风格的路径转换为 Unix 风格）
-    workflow = normalize_workflow_paths(workflow)
-
-    # Make sure that the ComfyUI HTTP API is available before proceeding
-    if not check_server(
-        f"http://{COMFY_HOST}/",
-        COMFY_API_AVAILABLE_MAX_RETRIES,
-        COMFY_API_AVAILABLE_INTERVAL_MS,
-    ):
+    with timer.phase("path_normalization"):
+        workflows = [normalize_workflow_paths(workflow) for workflow in workflows]
+    output_mode = validated_data.get("output_mode", OUTPUT_MODE)
+
+    # Pick the ComfyUI backend for this job and make sure its HTTP API is available.
+    # From here on every ComfyUI call of the job goes to that backend; async_handler
+    # releases it when the job is done.
+    workflow_models = sorted(
+        {model for workflow in workflows for model in extract_model_references(workflow)}
+    )
+    if MODEL_PRELOAD:
+        model_preloader.record(workflow_models, workflows)
+    with timer.phase("server_check"):
+        backend = await _acquire_backend(workflow_models)
+    if backend is None:
         return {
-            "error": f"ComfyUI server ({COMFY_HOST}) not reachable after multiple retries."
+            "error": f"ComfyUI server ({', '.join(COMFY_HOSTS or [COMFY_HOST])}) not reachable after multiple retries."
         }
-
-    # 如果输入图片中包含 URL，先下载并转换为 base64
-    if input_images:
-        for image in input_images:
-            image_data = image.get("image", "")
-            # 检查是否是 URL
-            if isinstance(image_data, str) and (image_data.startswith("http://") or image_data.startswith("https://")):
-                print(f"worker-comfyui - Detected URL input for image '{image.get('name')}', converting to base64...")
-                base64_image = convert_url_to_base64(image_data)
-                if base64_image is None:
-                    return {
-                        "error": f"Failed to download and convert image from URL: {image_data}",
-                    }
-                # 将 URL 替换为 base64 编码
-                image["image"] = base64_image
-                print(f"worker-comfyui - Successfully converted URL to base64 for image '{image.get('name')}'")
-            # 如果已经是 base64，保持不变，正常处理
-
-    # Upload input images if they exist
+    _job_backend.set(backend)
+    if len(COMFY_HOSTS) > 1:
+        bind_log_context(backend=backend.host)
+
+    # 如果输入图片中包含 URL，先并行下载并转换为 base64
+    # 如果已经是 base64，保持不变，正常处理
+    url_images = [
+        image
+        for image in input_images or []
+        if isinstance(image.get("image"), str)
+        and image["image"].startswith(("http://", "https://"))
+    ]
+    if url_images:
+        for image in url_images:
+            logger.info(f"Detected URL input for image '{image.get('name')}', converting to base64...")
+        with timer.phase("url_download"):
+            converted = await asyncio.gather(
+                *(asyncio.to_thread(convert_url_to_base64, image["image"]) for image in url_images)
+            )
+        for image, base64_image in zip(url_images, converted):
+            if base64_image is None:
+                return {
+                    "error": f"Failed to download and convert image from URL: {image['image']}",
+                }
+            # 将 URL 替换为 base64 编码
+            image["image"] = base64_image
+            logger.info(f"Successfully converted URL to base64 for image '{image.get('name')}'")
+
+    # Per-job scratch subfolder for uploads and outputs
+    job_subfolder = job_subfolder_name(job_id) if JOB_SUBFOLDERS else None
+    if job_subfolder:
+        input_names = [image["name"] for image in input_images or []]
+        workflows = [
+            scope_workflow_to_subfolder(workflow, job_subfolder, input_names)
+            for workflow in workflows
+        ]
+
+    # Upload input images if they exist (once, shared by all workflows of the job)
     if input_images:
-        upload_result = upload_images(input_images)
+        with timer.phase("image_upload"):
+            upload_result = await upload_images_async(input_images, subfolder=job_subfolder)
         if upload_result["status"] == "error":
             # Return upload errors
             return {
@@ -817,376 +3876,376 @@ def handler(job):
                 "details": upload_result["details"],
             }
 
-    ws = None
+    runs = [PromptRun(index, workflow) for index, workflow in enumerate(workflows)]
+
+    # In-band output mode: SaveImage nodes stream their PNGs over the websocket
+    if output_mode == "websocket":
+        if await websocket_save_node_available():
+            for run in runs:
+                run.capture_nodes = prepare_websocket_outputs(run.workflow)
+        else:
+            logger.warning(
+                "SaveImageWebsocket node not available, falling back to disk outputs"
+            )
+
+    # Decide whether to keep or evict loaded models before this job runs
+    residency_report = None
+    if MODEL_RESIDENCY:
+        with timer.phase("residency"):
+            # before_job may call /system_stats and /free through the blocking facade
+            residency_report = await asyncio.to_thread(backend.residency.before_job, workflow_models)
+
+    events = None
     client_id = str(uuid.uuid4())
-    prompt_id = None
-    output_data = []
-    errors = []
+    uploaded_input_files = [
+        (job_subfolder or "", image["name"]) for image in input_images or []
+    ]
+    lane_ticket = None
 
     try:
+        # Wait for this job's turn in its priority lane; high prompts may jump the queue
+        trace["priority"] = validated_data["priority"]
+        with timer.phase("priority_hold"):
+            lane_ticket, queue_front = await priority_lanes.admit(
+                backend.host, validated_data["priority"], queue_depth=_comfy_queue_depth
+            )
+
         # Establish WebSocket connection
-        ws_url = f"ws://{COMFY_HOST}/ws?clientId={client_id}"
-        print(f"worker-comfyui - Connecting to websocket: {ws_url}")
-        ws = websocket.WebSocket()
-        ws.connect(ws_url, timeout=10)
-        print(f"worker-comfyui - Websocket connected")
+        events = comfy().events(client_id, trace=WEBSOCKET_TRACE)
+        logger.debug(f"Connecting to websocket: {events.url}")
+        with timer.phase("ws_connect"):
+            await events.connect()
+        logger.debug(f"Websocket connected")
+
+        # Queue all prompts back to back so ComfyUI goes from one to the next without
+        # idling. Front-of-queue prompts run in reverse submission order, so those are
+        # submitted last to first.
+        for run in reversed(runs) if queue_front else runs:
+            try:
+                run.prompt_id = await _queue_prompt_async(
+                    run.workflow, client_id, validated_data, queue_front, timer
+                )
+            except ValueError as e:
+                if not multi:
+                    raise
+                # One rejected workflow does not fail the others
+                run.errors.append(str(e))
+                run.finished = True
+                continue
+            if not multi:
+                bind_log_context(prompt_id=run.prompt_id)
+            logger.info(
+                f"Queued workflow with ID: {run.prompt_id} ({validated_data['priority']} priority"
+                f"{', front of queue' if queue_front else ''})"
+            )
 
-        # Queue the workflow
-        try:
-            # Pass per-request API key if provided in input
-            queued_workflow = queue_workflow(
-                workflow,
-                client_id,
-                comfy_org_api_key=validated_data.get("comfy_org_api_key"),
+        # prompt_id -> PromptRun of every prompt that has not finished yet
+        pending = {run.prompt_id: run for run in runs if not run.finished}
+        for run in pending.values():
+            run.timeline = NodeTimeline(run.prompt_id, run.workflow)
+
+        def finish(run):
+            # Outputs of a finished prompt are collected while the next ones execute
+            del pending[run.prompt_id]
+            run.finished = True
+            run.timeline_entries = run.timeline.entries()
+            record_node_timeline(run.timeline_entries)
+            run.collector = asyncio.create_task(
+                _collect_prompt_outputs(run, job_id, validated_data, timer, trace)
             )
-            prompt_id = queued_workflow.get("prompt_id")
-            if not prompt_id:
-                raise ValueError(
-                    f"Missing 'prompt_id' in queue response: {queued_workflow}"
-                )
-            print(f"worker-comfyui - Queued workflow with ID: {prompt_id}")
-        except requests.RequestException as e:
-            print(f"worker-comfyui - Error queuing workflow: {e}")
-            raise ValueError(f"Error queuing workflow: {e}")
-        except Exception as e:
-            print(f"worker-comfyui - Unexpected error queuing workflow: {e}")
-            # For ValueError exceptions from queue_workflow, pass through the original message
-            if isinstance(e, ValueError):
-                raise e
-            else:
-                raise ValueError(f"Unexpected error queuing workflow: {e}")
 
-        # Wait for execution completion via WebSocket
-        print(f"worker-comfyui - Waiting for workflow execution ({prompt_id})...")
-        execution_done = False
-        while True:
+        # Wait for execution completion via WebSocket, reconciling with /history and
+        # /queue after reconnects and during long silences (see _reconcile_prompt_status)
+        logger.info(f"Waiting for workflow execution ({', '.join(pending)})...")
+        last_reconcile = time.monotonic()
+        reconcile_now = False
+        executing_run = None
+        executing_node = None
+        wait_started = time.perf_counter()
+        while pending:
+            if reconcile_now or (
+                time.monotonic() - last_reconcile >= WEBSOCKET_RECONCILE_INTERVAL_S
+            ):
+                reconcile_now = False
+                last_reconcile = time.monotonic()
+                for run in list(pending.values()):
+                    reconciled = await _reconcile_prompt_status_async(run.prompt_id)
+                    if reconciled["status"] == "success":
+                        logger.info(
+                            f"Execution finished for prompt {run.prompt_id} (confirmed via history)"
+                        )
+                        run.history = reconciled["history"]
+                        finish(run)
+                    elif reconciled["status"] == "error":
+                        logger.error(
+                            f"Execution error found in history: {reconciled['error']}"
+                        )
+                        run.history = reconciled["history"]
+                        run.errors.append(f"Workflow execution error: {reconciled['error']}")
+                        finish(run)
+                    elif reconciled["status"] == "missing":
+                        run.missing_checks += 1
+                        if run.missing_checks >= PROMPT_MISSING_MAX_CHECKS:
+                            metrics.inc("comfy_restarts_total")
+                            raise ValueError(
+                                f"Prompt {run.prompt_id} is neither queued nor in history; ComfyUI may have restarted."
+                            )
+                    elif reconciled["status"] != "unknown":
+                        run.missing_checks = 0
+                if not pending:
+                    break
             try:
-                out = ws.recv()
-                if isinstance(out, str):
-                    message = json.loads(out)
+                out = await events.receive(WEBSOCKET_RECEIVE_TIMEOUT_S)
+                if out is None:
+                    logger.debug(f"Websocket receive timed out. Still waiting...")
+                    continue
+                if isinstance(out, dict):
+                    message = out
+                    data = message.get("data") or {}
+                    run = pending.get(data.get("prompt_id"))
+                    if run is not None:
+                        run.timeline.on_message(message)
                     if message.get("type") == "status":
-                        status_data = message.get("data", {}).get("status", {})
-                        print(
-                            f"worker-comfyui - Status update: {status_data.get('exec_info', {}).get('queue_remaining', 'N/A')} items remaining in queue"
+                        status_data = data.get("status", {})
+                        queue_remaining = status_data.get("exec_info", {}).get("queue_remaining")
+                        if isinstance(queue_remaining, int):
+                            metrics.set("comfy_queue_remaining", queue_remaining)
+                        logger.debug(
+                            f"Status update: {status_data.get('exec_info', {}).get('queue_remaining', 'N/A')} items remaining in queue"
                         )
+                    elif run is None:
+                        continue
+                    elif message.get("type") == "execution_start":
+                        priority_lanes.start(lane_ticket)
                     elif message.get("type") == "executing":
-                        data = message.get("data", {})
-                        if (
-                            data.get("node") is None
-                            and data.get("prompt_id") == prompt_id
-                        ):
-                            print(
-                                f"worker-comfyui - Execution finished for prompt {prompt_id}"
+                        priority_lanes.start(lane_ticket)
+                        executing_run, executing_node = run, data.get("node")
+                        if executing_node is not None:
+                            run.executed_nodes.append(str(executing_node))
+                            metrics.inc("comfy_nodes_executed_total")
+                        else:
+                            logger.info(
+                                f"Execution finished for prompt {run.prompt_id}"
                             )
-                            execution_done = True
-                            break
+                            finish(run)
+                    elif message.get("type") == "execution_cached":
+                        cached_nodes = [str(node_id) for node_id in data.get("nodes") or []]
+                        run.cached_nodes.extend(cached_nodes)
+                        metrics.inc("comfy_nodes_cached_total", len(cached_nodes))
                     elif message.get("type") == "execution_error":
-                        data = message.get("data", {})
-                        if data.get("prompt_id") == prompt_id:
-                            error_details = f"Node Type: {data.get('node_type')}, Node ID: {data.get('node_id')}, Message: {data.get('exception_message')}"
-                            print(
-                                f"worker-comfyui - Execution error received: {error_details}"
-                            )
-                            errors.append(f"Workflow execution error: {error_details}")
-                            break
+                        error_details = f"Node Type: {data.get('node_type')}, Node ID: {data.get('node_id')}, Message: {data.get('exception_message')}"
+                        logger.error(
+                            f"Execution error received: {error_details}"
+                        )
+                        run.errors.append(f"Workflow execution error: {error_details}")
+                        finish(run)
+                elif (
+                    isinstance(out, bytes)
+                    and executing_run is not None
+                    and str(executing_node) in executing_run.capture_nodes
+                ):
+                    # Binary frame from a SaveImageWebsocket node: keep the image bytes
+                    parsed = parse_binary_image_frame(out)
+                    if parsed:
+                        executing_run.captured_images.setdefault(str(executing_node), []).append(parsed)
                 else:
                     continue
-            except websocket.WebSocketTimeoutException:
-                print(f"worker-comfyui - Websocket receive timed out. Still waiting...")
-                continue
-            except websocket.WebSocketConnectionClosedException as closed_err:
-                try:
-                    # Attempt to reconnect
-                    ws = _attempt_websocket_reconnect(
-                        ws_url,
-                        WEBSOCKET_RECONNECT_ATTEMPTS,
-                        WEBSOCKET_RECONNECT_DELAY_S,
-                        closed_err,
-                    )
-
-                    print(
-                        "worker-comfyui - Resuming message listening after successful reconnect."
-                    )
-                    continue
-                except (
-                    websocket.WebSocketConnectionClosedException
-                ) as reconn_failed_err:
-                    # If _attempt_websocket_reconnect fails, it raises this exception
-                    # Let this exception propagate to the outer handler's except block
-                    raise reconn_failed_err
-
-            except json.JSONDecodeError:
-                print(f"worker-comfyui - Received invalid JSON message via websocket.")
-
-        if not execution_done and not errors:
-            raise ValueError(
-                "Workflow monitoring loop exited without confirmation of completion or error."
-            )
-
-        # Fetch history even if there were execution errors, some outputs might exist
-        print(f"worker-comfyui - Fetching history for prompt {prompt_id}...")
-        history = get_history(prompt_id)
-
-        if prompt_id not in history:
-            error_msg = f"Prompt ID {prompt_id} not found in history after execution."
-            print(f"worker-comfyui - {error_msg}")
-            if not errors:
-                return {"error": error_msg}
-            else:
-                errors.append(error_msg)
-                return {
-                    "error": "Job processing failed, prompt ID not found in history.",
-                    "details": errors,
-                }
-
-        prompt_history = history.get(prompt_id, {})
-        outputs = prompt_history.get("outputs", {})
-
-        if not outputs:
-            warning_msg = f"No outputs found in history for prompt {prompt_id}."
-            print(f"worker-comfyui - {warning_msg}")
-            if not errors:
-                errors.append(warning_msg)
-
-        print(f"worker-comfyui - Processing {len(outputs)} output nodes...")
-        for node_id, node_output in outputs.items():
-            # Process "images", "gifs", and "animated" outputs (all are media files)
-            media_files = []
-            if "images" in node_output:
-                media_files.extend(node_output["images"])
-            if "gifs" in node_output:
-                media_files.extend(node_output["gifs"])
-            if "animated" in node_output:
-                media_files.extend(node_output["animated"])
-            
-            if media_files:
-                print(
-                    f"worker-comfyui - Node {node_id} contains {len(media_files)} media file(s)"
+            except comfy_client.ComfyConnectionClosed as closed_err:
+                # Attempt to reconnect; if that fails, ComfyConnectionClosed propagates
+                # to the outer handler's except block
+                await _attempt_websocket_reconnect(
+                    events,
+                    WEBSOCKET_RECONNECT_ATTEMPTS,
+                    WEBSOCKET_RECONNECT_DELAY_S,
+                    closed_err,
                 )
-                for image_info in media_files:
-                    # Skip non-dict items (e.g., bool values that might be in the list)
-                    if not isinstance(image_info, dict):
-                        warn_msg = f"Skipping non-dict media file in node {node_id}: {type(image_info).__name__} = {image_info}"
-                        print(f"worker-comfyui - {warn_msg}")
-                        errors.append(warn_msg)
-                        continue
-                    
-                    filename = image_info.get("filename")
-                    subfolder = image_info.get("subfolder", "")
-                    img_type = image_info.get("type")
-
-                    # skip temp files
-                    if img_type == "temp":
-                        print(
-                            f"worker-comfyui - Skipping {filename} because type is 'temp'"
-                        )
-                        continue
-
-                    if not filename:
-                        warn_msg = f"Skipping media file in node {node_id} due to missing filename: {image_info}"
-                        print(f"worker-comfyui - {warn_msg}")
-                        errors.append(warn_msg)
-                        continue
 
-                    # Check if this is a video file
-                    is_video = is_video_file(filename)
-                    media_type = "video" if is_video else "image"
-                    
-                    # Fetch the file data (works for both images and videos)
-                    file_bytes = get_video_data(filename, subfolder, img_type) if is_video else get_image_data(filename, subfolder, img_type)
-
-                    if file_bytes:
-                        file_extension = os.path.splitext(filename)[1] or (".mp4" if is_video else ".png")
-
-                        if os.environ.get("BUCKET_ENDPOINT_URL"):
-                            try:
-                                with tempfile.NamedTemporaryFile(
-                                    suffix=file_extension, delete=False
-                                ) as temp_file:
-                                    temp_file.write(file_bytes)
-                                    temp_file_path = temp_file.name
-                                print(
-                                    f"worker-comfyui - Wrote {media_type} bytes to temporary file: {temp_file_path}"
-                                )
-
-                                print(f"worker-comfyui - Uploading {filename} to S3...")
-                                # Use upload_image to upload the file
-                                # Note: RunPod S3-compatible API does NOT support presigned URLs
-                                # The returned URL is the S3 path that requires S3 API Key authentication
-                                uploaded_url = rp_upload.upload_image(job_id, temp_file_path)
-                                os.remove(temp_file_path)  # Clean up temp file
-                                print(
-                                    f"worker-comfyui - Uploaded {filename} to S3: {uploaded_url}"
-                                )
-                                
-                                # Remove query parameters from URL for cleaner output
-                                # Query parameters are not needed since RunPod S3 doesn't support presigned URLs
-                                if "?" in uploaded_url:
-                                    s3_url = uploaded_url.split("?")[0]
-                                    print(
-                                        f"worker-comfyui - Removed query parameters from URL for cleaner output"
-                                    )
-                                else:
-                                    s3_url = uploaded_url
-                                
-                                print(
-                                    f"worker-comfyui - Note: Access this file using S3 API Key credentials"
-                                )
-                                
-                                # Append dictionary with filename and URL
-                                output_data.append(
-                                    {
-                                        "filename": filename,
-                                        "type": "s3_url",
-                                        "data": s3_url,
-                                    }
-                                )
-                            except Exception as e:
-                                error_msg = f"Error uploading {filename} to S3: {e}"
-                                print(f"worker-comfyui - {error_msg}")
-                                errors.append(error_msg)
-                                if "temp_file_path" in locals() and os.path.exists(
-                                    temp_file_path
-                                ):
-                                    try:
-                                        os.remove(temp_file_path)
-                                    except OSError as rm_err:
-                                        print(
-                                            f"worker-comfyui - Error removing temp file {temp_file_path}: {rm_err}"
-                                        )
-                        else:
-                            # Return as base64 string
-                            try:
-                                # Check file size before encoding (videos can be very large)
-                                file_size_mb = len(file_bytes) / (1024 * 1024)
-                                max_size_mb = 100  # 100MB limit for base64 encoding
-                                
-                                if is_video and file_size_mb > max_size_mb:
-                                    error_msg = (
-                                        f"Video file {filename} is too large ({file_size_mb:.2f} MB) "
-                                        f"for base64 encoding (max {max_size_mb} MB). "
-                                        f"Please configure S3 upload (BUCKET_ENDPOINT_URL) for large files."
-                                    )
-                                    print(f"worker-comfyui - {error_msg}")
-                                    errors.append(error_msg)
-                                    continue
-                                
-                                base64_data = base64.b64encode(file_bytes).decode("utf-8")
-                                # For videos, add data URI prefix similar to images
-                                if is_video:
-                                    # Determine MIME type based on extension
-                                    filename_lower = filename.lower()
-                                    if filename_lower.endswith('.mp4') or filename_lower.endswith('.m4v'):
-                                        mime_type = "video/mp4"
-                                    elif filename_lower.endswith('.webm'):
-                                        mime_type = "video/webm"
-                                    elif filename_lower.endswith('.mov'):
-                                        mime_type = "video/quicktime"
-                                    elif filename_lower.endswith('.avi'):
-                                        mime_type = "video/x-msvideo"
-                                    elif filename_lower.endswith('.mkv'):
-                                        mime_type = "video/x-matroska"
-                                    elif filename_lower.endswith('.flv'):
-                                        mime_type = "video/x-flv"
-                                    elif filename_lower.endswith('.wmv'):
-                                        mime_type = "video/x-ms-wmv"
-                                    else:
-                                        # Default fallback for unknown video formats
-                                        mime_type = "video/mp4"
-                                    base64_data = f"data:{mime_type};base64,{base64_data}"
-                                
-                                # Append dictionary with filename and base64 data
-                                output_data.append(
-                                    {
-                                        "filename": filename,
-                                        "type": "base64",
-                                        "data": base64_data,
-                                    }
-                                )
-                                print(f"worker-comfyui - Encoded {filename} as base64 ({media_type}, {file_size_mb:.2f} MB)")
-                            except MemoryError as e:
-                                error_msg = (
-                                    f"Out of memory while encoding {filename} to base64. "
-                                    f"File size: {len(file_bytes) / (1024 * 1024):.2f} MB. "
-                                    f"Please configure S3 upload (BUCKET_ENDPOINT_URL) for large files."
-                                )
-                                print(f"worker-comfyui - {error_msg}")
-                                errors.append(error_msg)
-                            except Exception as e:
-                                error_msg = f"Error encoding {filename} to base64: {e}"
-                                print(f"worker-comfyui - {error_msg}")
-                                print(traceback.format_exc())
-                                errors.append(error_msg)
-                    else:
-                        error_msg = f"Failed to fetch {media_type} data for {filename} from /view endpoint."
-                        errors.append(error_msg)
-
-            # Check for other output types (excluding images, gifs, and animated which we handle)
-            other_keys = [k for k in node_output.keys() if k not in ["images", "gifs", "animated"]]
-            if other_keys:
-                warn_msg = (
-                    f"Node {node_id} produced unhandled output keys: {other_keys}."
-                )
-                print(f"worker-comfyui - WARNING: {warn_msg}")
-                print(
-                    f"worker-comfyui - --> If this output is useful, please consider opening an issue on GitHub to discuss adding support."
+                logger.debug(
+                    "Resuming message listening after successful reconnect."
                 )
+                # Events sent while disconnected are lost – check history right away
+                reconcile_now = True
+                for run in pending.values():
+                    if run.capture_nodes:
+                        run.errors.append(
+                            "Websocket reconnected during in-band output capture; some outputs may be missing."
+                        )
+                continue
 
-    except websocket.WebSocketException as e:
-        print(f"worker-comfyui - WebSocket Error: {e}")
-        print(traceback.format_exc())
+            except json.JSONDecodeError:
+                logger.warning(f"Received invalid JSON message via websocket.")
+
+        timer.add("gpu_wait", time.perf_counter() - wait_started)
+        # The prompts have left ComfyUI's queue
+        priority_lanes.finish(lane_ticket)
+        trace["node_timeline"] = [
+            entry for run in runs for entry in run.timeline_entries or []
+        ]
+
+        # Wait for the outputs still being fetched and delivered
+        await asyncio.gather(*(run.collector for run in runs if run.collector is not None))
+
+    except asyncio.CancelledError:
+        logger.warning(f"Job cancelled")
+        for run in runs:
+            if not run.prompt_id or run.finished:
+                continue
+            # Shielded so a second cancellation cannot leave the prompt running
+            try:
+                await asyncio.shield(comfy().cancel_prompt(run.prompt_id))
+                logger.info(f"Removed prompt {run.prompt_id} from the ComfyUI queue")
+            except comfy_client.ComfyClientError as e:
+                logger.warning(f"Could not cancel prompt {run.prompt_id}: {e}")
+        raise
+    except comfy_client.ComfyConnectionClosed as e:
+        logger.exception(f"WebSocket Error: {e}")
+        backend_pool.mark_unhealthy(backend)
         return {"error": f"WebSocket communication error: {e}"}
-    except requests.RequestException as e:
-        print(f"worker-comfyui - HTTP Request Error: {e}")
-        print(traceback.format_exc())
+    except comfy_client.ComfyClientError as e:
+        logger.exception(f"HTTP Request Error: {e}")
+        if not isinstance(e, comfy_client.ComfyHTTPError):
+            backend_pool.mark_unhealthy(backend)
         return {"error": f"HTTP communication error with ComfyUI: {e}"}
     except ValueError as e:
-        print(f"worker-comfyui - Value Error: {e}")
-        print(traceback.format_exc())
+        logger.exception(f"Value Error: {e}")
         return {"error": str(e)}
     except Exception as e:
-        print(f"worker-comfyui - Unexpected Handler Error: {e}")
-        print(traceback.format_exc())
+        logger.exception(f"Unexpected Handler Error: {e}")
         return {"error": f"An unexpected error occurred: {e}"}
     finally:
-        if ws and ws.connected:
-            print(f"worker-comfyui - Closing websocket connection.")
-            ws.close()
+        # Collectors only remain unfinished if the job failed or was cancelled
+        collectors = [run.collector for run in runs if run.collector is not None]
+        for collector in collectors:
+            collector.cancel()
+        await asyncio.gather(*collectors, return_exceptions=True)
+        if lane_ticket is not None:
+            priority_lanes.finish(lane_ticket)
+        if events is not None and events.connected:
+            logger.debug(f"Closing websocket connection.")
+            await events.close()
+        prompt_ids = [run.prompt_id for run in runs if run.prompt_id]
+        if prompt_ids:
+            # Keeps the backend's loaded-model hints current even without MODEL_RESIDENCY
+            backend.residency.after_job(workflow_models)
+        if CLEANUP_AFTER_JOB:
+            with timer.phase("cleanup"):
+                await asyncio.to_thread(
+                    cleanup_job,
+                    prompt_ids or None,
+                    [path for run in runs for path in run.delivered_output_files],
+                    uploaded_input_files,
+                    job_subfolder=job_subfolder,
+                )
 
-    final_result = {}
+    node_timeline = validated_data.get("node_timeline")
+    if not multi:
+        final_result = _prompt_result(runs[0], node_timeline)
+        if residency_report and "error" not in final_result:
+            final_result["residency"] = residency_report
+        return final_result
+
+    # Multi-workflow job: one result per workflow or sweep variant, in order, with the
+    # nodes ComfyUI served from its cache
+    sweep_parameters = validated_data.get("sweep")
+    workflow_results = []
+    for run in runs:
+        result = _prompt_result(run, node_timeline)
+        if sweep_parameters:
+            result["parameters"] = sweep_parameters[run.index]
+        result["cached_nodes"] = run.cached_nodes
+        workflow_results.append(result)
+    failed = sum(1 for result in workflow_results if "error" in result)
+    logger.info(f"Multi-workflow job completed: {len(runs) - failed} of {len(runs)} workflow(s) succeeded.")
+    if failed == len(runs):
+        return {"error": "All workflows failed", "workflows": workflow_results}
+    final_result = {"workflows": workflow_results}
+    if sweep_parameters:
+        final_result["sweep"] = {
+            "variants": len(runs),
+            "executed_nodes": sum(len(run.executed_nodes) for run in runs),
+            "cached_nodes": sum(len(run.cached_nodes) for run in runs),
+        }
+    if residency_report:
+        final_result["residency"] = residency_report
+    return final_result
 
-    if output_data:
-        final_result["images"] = output_data
 
-    if errors:
-        final_result["errors"] = errors
-        print(f"worker-comfyui - Job completed with errors/warnings: {errors}")
+# ---------------------------------------------------------------------------
+# Worker startup
+# ---------------------------------------------------------------------------
+# Startup work runs as named, timed steps in init_worker(): once before the worker loop
+# starts, or lazily on the first job when handler.py is imported as a library. Nothing
+# that can wait until after the worker registers runs on this path.
+# STARTUP_REPORT=true logs the module import time and the duration of every step.
+STARTUP_REPORT = os.environ.get("STARTUP_REPORT", "false").lower() == "true"
 
-    if not output_data and errors:
-        print(f"worker-comfyui - Job failed with no output media files.")
-        return {
-            "error": "Job processing failed",
-            "details": errors,
-        }
-    elif not output_data and not errors:
-        print(
-            f"worker-comfyui - Job completed successfully, but the workflow produced no media files."
+_init_lock = threading.Lock()
+_initialized = False
+# step name -> duration in ms
+startup_timings = {}
+
+
+@contextmanager
+def _startup_step(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = round((time.perf_counter() - started) * 1000, 2)
+
+
+def _verify_blip_cache_in_background(blip_cache_dir, cache_source):
+    def run():
+        with _startup_step("blip_cache_verify"):
+            verify_blip_cache(blip_cache_dir, cache_source)
+
+    threading.Thread(target=run, name="blip-cache-verify", daemon=True).start()
+
+
+def init_worker(import_runpod=False):
+    """
+    Run the startup steps once.
+
+    Args:
+        import_runpod (bool): Also import runpod (and boto3) now. Only the worker
+            entry point needs it up front; library users import it on first S3 upload.
+    """
+    global _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if _initialized:
+            return
+        with _startup_step("s3_region"):
+            detect_s3_region()
+        with _startup_step("blip_cache"):
+            blip_cache_dir, cache_source = configure_blip_cache()
+        if blip_cache_dir:
+            # Globbing the network volume only produces log lines; keep it off the critical path
+            _verify_blip_cache_in_background(blip_cache_dir, cache_source)
+        if METRICS_PORT:
+            with _startup_step("metrics_server"):
+                start_metrics_server(METRICS_PORT)
+        if import_runpod:
+            with _startup_step("import_runpod"):
+                runpod._load()
+                rp_upload._load()
+        _initialized = True
+
+    if STARTUP_REPORT:
+        logger.info(
+            "Startup report",
+            extra={"fields": {"module_import_ms": module_import_ms, "steps_ms": dict(startup_timings)}},
         )
-        final_result["status"] = "success_no_images"
-        final_result["images"] = []
 
-    # Count images and videos separately for logging
-    image_count = sum(1 for item in output_data if not is_video_file(item.get("filename", "")))
-    video_count = sum(1 for item in output_data if is_video_file(item.get("filename", "")))
-    
-    if video_count > 0:
-        print(f"worker-comfyui - Job completed. Returning {len(output_data)} media file(s): {image_count} image(s), {video_count} video(s).")
-    else:
-        print(f"worker-comfyui - Job completed. Returning {len(output_data)} image(s).")
-    
-    return final_result
+
+# Time spent importing this module, including its eager imports
+module_import_ms = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 2)
 
 
 if __name__ == "__main__":
-    print("worker-comfyui - Starting handler...")
-    runpod.serverless.start({"handler": handler})
+    logger.info("Starting handler...")
+    init_worker(import_runpod=True)
+    runpod.serverless.start(
+        {"handler": async_handler, "concurrency_modifier": concurrency_modifier}
+    )
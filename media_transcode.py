@@ -0,0 +1,329 @@
+"""
+Output transcoding for worker-comfyui.
+
+ComfyUI runs with --disable-metadata and saves plain PNGs, often several MB per
+image. transcode_output() re-encodes an output before it is returned:
+    • images with Pillow to PNG, WebP, JPEG or AVIF (quality / lossless)
+    • videos with the ffmpeg binary: a container remux (streams copied) or a
+      re-encode with the container's usual codecs (quality mapped to CRF)
+
+make_derivatives() builds the small previews returned inline next to an output: a
+thumbnail per image, and a poster frame plus a short low-bitrate clip per video.
+
+The functions take and return bytes and import nothing heavy at module level, so
+the handler can run them in a process pool:
+
+    pool.submit(media_transcode.transcode_output, "ComfyUI_00001_.png", data, {"image_format": "webp"})
+"""
+
+import io
+import os
+import subprocess
+import tempfile
+
+# format -> (file extension, Pillow format name, MIME type)
+IMAGE_FORMATS = {
+    "png": (".png", "PNG", "image/png"),
+    "webp": (".webp", "WEBP", "image/webp"),
+    "jpeg": (".jpg", "JPEG", "image/jpeg"),
+    "avif": (".avif", "AVIF", "image/avif"),
+}
+# container -> (file extension, ffmpeg video codec, ffmpeg audio codec, CRF range)
+VIDEO_FORMATS = {
+    "mp4": (".mp4", "libx264", "aac", 51),
+    "mov": (".mov", "libx264", "aac", 51),
+    "mkv": (".mkv", "libx264", "aac", 51),
+    "webm": (".webm", "libvpx-vp9", "libopus", 63),
+}
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".avif", ".bmp", ".tif", ".tiff")
+VIDEO_EXTENSIONS = (".mp4", ".webm", ".mov", ".avi", ".mkv", ".flv", ".wmv", ".m4v")
+DEFAULT_QUALITY = 90
+FFMPEG_TIMEOUT_S = 300
+# Low-bitrate video previews: H.264 at this CRF, without audio
+PREVIEW_CRF = 32
+
+
+class TranscodeError(Exception):
+    """An output could not be transcoded; the caller keeps the original."""
+
+
+def _replace_extension(filename, extension):
+    return os.path.splitext(filename)[0] + extension
+
+
+def _pil():
+    try:
+        from PIL import Image
+    except ImportError as e:
+        raise TranscodeError("Pillow is not installed") from e
+    return Image
+
+
+def _encode_image(image, image_format, quality, lossless=False):
+    """Encode a loaded Pillow image; returns (extension, bytes)."""
+    Image = _pil()
+    extension, pil_format, _ = IMAGE_FORMATS[image_format]
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+    if pil_format == "JPEG":
+        if has_alpha:
+            # JPEG has no alpha channel: flatten onto white
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        elif image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+    params = {}
+    if pil_format == "PNG":
+        params = {"optimize": False, "compress_level": 6}
+    elif pil_format == "JPEG":
+        params = {"quality": quality, "optimize": True, "progressive": True}
+    elif pil_format == "WEBP":
+        params = {"quality": 100 if lossless else quality, "lossless": lossless, "method": 4}
+    elif pil_format == "AVIF":
+        params = {"quality": 100 if lossless else quality, "speed": 6}
+        if lossless:
+            params["subsampling"] = "4:4:4"
+
+    out = io.BytesIO()
+    try:
+        image.save(out, format=pil_format, **params)
+    except (OSError, ValueError, KeyError) as e:
+        # Pillow raises KeyError / OSError for formats it was built without (e.g. AVIF)
+        raise TranscodeError(f"{image_format} encoding failed: {e!r}") from e
+    return extension, out.getvalue()
+
+
+def _open_image(data):
+    Image = _pil()
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (OSError, ValueError) as e:
+        raise TranscodeError(f"could not decode image: {e!r}") from e
+    return image
+
+
+def transcode_image(data, image_format, quality=DEFAULT_QUALITY, lossless=False):
+    """
+    Re-encode an image.
+
+    Args:
+        data (bytes): The encoded source image (any format Pillow reads).
+        image_format (str): A key of IMAGE_FORMATS.
+        quality (int): 1-100, used by the lossy formats.
+        lossless (bool): Lossless WebP / AVIF. PNG is always lossless; JPEG never is.
+
+    Returns:
+        tuple: (extension, bytes)
+    """
+    with _open_image(data) as image:
+        return _encode_image(image, image_format, quality, lossless)
+
+
+def image_thumbnail(data, max_size, image_format="webp", quality=80):
+    """
+    Downscale an image so that its longer side is at most max_size pixels.
+
+    Returns:
+        tuple: (extension, bytes)
+    """
+    Image = _pil()
+    try:
+        image = Image.open(io.BytesIO(data))
+        # JPEG sources decode at a reduced scale directly
+        image.draft("RGB", (max_size, max_size))
+        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    except (OSError, ValueError) as e:
+        raise TranscodeError(f"could not decode image: {e!r}") from e
+    with image:
+        return _encode_image(image, image_format, quality)
+
+
+def _ffmpeg(data, source_extension, args, target_extension, timeout_s=FFMPEG_TIMEOUT_S):
+    """Run ffmpeg on data with the given output arguments; returns the output bytes."""
+    with tempfile.TemporaryDirectory(prefix="transcode-") as tmp:
+        source = os.path.join(tmp, "source" + source_extension)
+        target = os.path.join(tmp, "target" + target_extension)
+        with open(source, "wb") as f:
+            f.write(data)
+        command = ["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+                   "-i", source, *args, target]
+        try:
+            result = subprocess.run(command, capture_output=True, timeout=timeout_s)
+        except FileNotFoundError as e:
+            raise TranscodeError("ffmpeg is not installed") from e
+        except subprocess.TimeoutExpired as e:
+            raise TranscodeError(f"ffmpeg timed out after {timeout_s}s") from e
+        if result.returncode != 0:
+            stderr = result.stderr.decode("utf-8", "replace").strip()
+            raise TranscodeError(f"ffmpeg failed ({result.returncode}): {stderr[-500:]}")
+        with open(target, "rb") as f:
+            return f.read()
+
+
+def transcode_video(data, source_extension, video_format, reencode=False,
+                    quality=DEFAULT_QUALITY, timeout_s=FFMPEG_TIMEOUT_S):
+    """
+    Remux or re-encode a video with ffmpeg.
+
+    Args:
+        data (bytes): The source video.
+        source_extension (str): Extension of the source file, e.g. ".mp4".
+        video_format (str): A key of VIDEO_FORMATS.
+        reencode (bool): Re-encode the streams instead of copying them. A remux only
+            succeeds if the target container supports the source codecs.
+        quality (int): 1-100, mapped onto the codec's CRF scale.
+        timeout_s (float): Limit for the ffmpeg run.
+
+    Returns:
+        tuple: (extension, bytes)
+    """
+    extension, video_codec, audio_codec, crf_max = VIDEO_FORMATS[video_format]
+    if not reencode and source_extension.lower() == extension:
+        return extension, data
+
+    if reencode:
+        # quality 100 -> CRF 15 (visually lossless), quality 0 -> the codec's worst CRF
+        crf = round(15 + (crf_max - 15) * (1 - quality / 100))
+        codec_args = ["-c:v", video_codec, "-crf", str(crf), "-pix_fmt", "yuv420p", "-c:a", audio_codec]
+        if video_codec == "libx264":
+            codec_args += ["-preset", "veryfast"]
+        else:
+            codec_args += ["-b:v", "0", "-row-mt", "1", "-deadline", "realtime", "-cpu-used", "8"]
+    else:
+        codec_args = ["-c", "copy"]
+    if extension in (".mp4", ".mov"):
+        # Put the index first so clients can start playback before the download ends
+        codec_args += ["-movflags", "+faststart"]
+    return extension, _ffmpeg(data, source_extension, codec_args, extension, timeout_s)
+
+
+def _scale_filter(max_size):
+    # Fit into max_size x max_size, keep the aspect ratio, even dimensions for yuv420p
+    return (
+        f"scale=w={max_size}:h={max_size}:force_original_aspect_ratio=decrease,"
+        f"scale=trunc(iw/2)*2:trunc(ih/2)*2"
+    )
+
+
+def video_poster(data, source_extension, max_size, image_format="webp", quality=80,
+                 timeout_s=FFMPEG_TIMEOUT_S):
+    """Extract the first frame of a video as a thumbnail; returns (extension, bytes)."""
+    frame = _ffmpeg(
+        data, source_extension, ["-frames:v", "1", "-vf", _scale_filter(max_size)], ".png", timeout_s
+    )
+    with _open_image(frame) as image:
+        return _encode_image(image, image_format, quality)
+
+
+def video_preview(data, source_extension, max_size, seconds, timeout_s=FFMPEG_TIMEOUT_S):
+    """Encode the first seconds of a video as a small silent H.264 mp4; returns (extension, bytes)."""
+    args = [
+        "-t", str(seconds), "-an", "-vf", _scale_filter(max_size),
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", str(PREVIEW_CRF),
+        "-pix_fmt", "yuv420p", "-movflags", "+faststart",
+    ]
+    return ".mp4", _ffmpeg(data, source_extension, args, ".mp4", timeout_s)
+
+
+def make_derivatives(filename, data, options):
+    """
+    Build the inline previews of one output file.
+
+    Args:
+        filename (str): The output filename; its extension selects image or video.
+        data (bytes): The file content.
+        options (dict): "size" (longest side in pixels), "image_format", "quality",
+            "preview_seconds" (0 skips the video clip) and "ffmpeg_timeout_s".
+
+    Returns:
+        tuple: ({kind: (filename, MIME type, bytes)}, [error message, ...]) with kinds
+        "thumbnail" for images and "poster" / "preview" for videos. A failed kind is
+        reported in the errors and left out.
+    """
+    stem, source_extension = os.path.splitext(filename)
+    source_extension = source_extension.lower()
+    size = options.get("size", 256)
+    image_format = options.get("image_format", "webp")
+    quality = options.get("quality", 80)
+    timeout_s = options.get("ffmpeg_timeout_s", FFMPEG_TIMEOUT_S)
+    mime = IMAGE_FORMATS[image_format][2]
+
+    if source_extension in IMAGE_EXTENSIONS:
+        jobs = {"thumbnail": lambda: image_thumbnail(data, size, image_format, quality)}
+    elif source_extension in VIDEO_EXTENSIONS:
+        jobs = {
+            "poster": lambda: video_poster(data, source_extension, size, image_format, quality, timeout_s)
+        }
+        if options.get("preview_seconds"):
+            jobs["preview"] = lambda: video_preview(
+                data, source_extension, size, options["preview_seconds"], timeout_s
+            )
+    else:
+        return {}, []
+
+    derivatives, errors = {}, []
+    for kind, build in jobs.items():
+        try:
+            extension, payload = build()
+        except TranscodeError as e:
+            errors.append(f"Could not create {kind} for {filename}: {e}")
+            continue
+        kind_mime = "video/mp4" if kind == "preview" else mime
+        derivatives[kind] = (f"{stem}_{kind}{extension}", kind_mime, payload)
+    return derivatives, errors
+
+
+def needs_transcode(filename, options):
+    """Return True if transcode_output() would change the file (cheap, no decoding)."""
+    source_extension = os.path.splitext(filename)[1].lower()
+    if source_extension in VIDEO_EXTENSIONS:
+        video_format = options.get("video_format")
+        return bool(video_format) and (
+            options.get("video_reencode", False)
+            or VIDEO_FORMATS[video_format][0] != source_extension
+        )
+    if source_extension in IMAGE_EXTENSIONS:
+        image_format = options.get("image_format")
+        return bool(image_format) and not (image_format == "png" and source_extension == ".png")
+    return False
+
+
+def transcode_output(filename, data, options):
+    """
+    Transcode one output file according to the job's options.
+
+    Args:
+        filename (str): The output filename; its extension selects image or video.
+        data (bytes): The file content.
+        options (dict): "image_format", "quality", "lossless", "video_format",
+            "video_reencode" and "ffmpeg_timeout_s"; missing keys leave that kind of
+            output unchanged.
+
+    Returns:
+        tuple: (filename, bytes), unchanged if nothing applies.
+
+    Raises:
+        TranscodeError: If encoding failed.
+    """
+    if not needs_transcode(filename, options):
+        return filename, data
+    source_extension = os.path.splitext(filename)[1].lower()
+    quality = options.get("quality", DEFAULT_QUALITY)
+    if source_extension in VIDEO_EXTENSIONS:
+        extension, data = transcode_video(
+            data,
+            source_extension,
+            options["video_format"],
+            reencode=options.get("video_reencode", False),
+            quality=quality,
+            timeout_s=options.get("ffmpeg_timeout_s", FFMPEG_TIMEOUT_S),
+        )
+    else:
+        extension, data = transcode_image(
+            data, options["image_format"], quality=quality, lossless=options.get("lossless", False)
+        )
+    return _replace_extension(filename, extension), data
@@ -58,17 +58,6 @@ mkdir -p "$MODELS_DIR/sams"
 echo "✓ 目录结构创建完成"
 echo ""
 
-# 简单的下载函数：使用 wget -nc 自动跳过已存在的文件
-download_file() {
-    local url=$1
-    local output_path=$2
-    local description=$3
-    
-    mkdir -p "$(dirname "$output_path")"
-    echo "下载: $description"
-    wget -q --show-progress -nc -O "$output_path" "$url" || true
-}
-
 # ============================================
 # InsightFace AntelopeV2 模型
 # ============================================
@@ -92,68 +81,29 @@ fi
 echo ""
 
 # ============================================
-# Checkpoint 模型
-# ============================================
-echo "=========================================="
-echo "下载 Checkpoint 模型"
-echo "=========================================="
-
-download_file \
-    "https://huggingface.co/datasets/Robin9527/LoRA/resolve/main/SDXL/ultraRealisticByStable_v20FP16.safetensors" \
-    "$MODELS_DIR/checkpoints/SDXL/ultraRealisticByStable_v20FP16.safetensors" \
-    "SDXL Checkpoint"
-
-download_file \
-    "https://huggingface.co/Phr00t/WAN2.2-14B-Rapid-AllInOne/resolve/main/v10/wan2.2-i2v-rapid-aio-v10-nsfw.safetensors" \
-    "$MODELS_DIR/checkpoints/Wan2.2/wan2.2-i2v-rapid-aio-v10-nsfw.safetensors" \
-    "WAN2.2 Checkpoint"
-
-echo ""
-
-# ============================================
-# CLIP Vision 和 PuLID 模型
-# ============================================
-echo "=========================================="
-echo "下载 CLIP Vision 和 PuLID 模型"
-echo "=========================================="
-
-download_file \
-    "https://huggingface.co/Comfy-Org/Wan_2.1_ComfyUI_repackaged/resolve/main/split_files/clip_vision/clip_vision_h.safetensors" \
-    "$MODELS_DIR/clip_vision/wan/clip_vision_h.safetensors" \
-    "CLIP Vision (WAN)"
-
-download_file \
-    "https://huggingface.co/huchenlei/ipadapter_pulid/resolve/main/ip-adapter_pulid_sdxl_fp16.safetensors" \
-    "$MODELS_DIR/pulid/ip-adapter_pulid_sdxl_fp16.safetensors" \
-    "PuLID IP-Adapter"
-
-echo ""
-
-# ============================================
-# ReActor 和 HyperSwap 模型
+# 单文件模型（Checkpoint、CLIP Vision、PuLID、ReActor、HyperSwap、超分、面部修复、LoRA）
 # ============================================
 echo "=========================================="
-echo "下载 ReActor 和 HyperSwap 模型"
+echo "下载单文件模型（清单: scripts/models-manifest.json）"
 echo "=========================================="
 
-# 根据 ComfyUI-ReActor 官方文档 (https://github.com/Gourieff/ComfyUI-ReActor)：
-# - swap_model 参数的值是 "inswapper_128.onnx"
-# - inswapper_128.onnx 必须放在 ComfyUI/models/insightface/ 根目录
-# - ReActor 节点使用 folder_paths.get_folder_paths("insightface") 来查找 .onnx 文件
+# 模型列表在 models-manifest.json 中维护（url、path、可选的 size 和 sha256）
+# download_models.py 并行下载，支持断点续传（.part 文件）和大文件分段（HTTP Range）下载，
+# 校验大小和 sha256 后才重命名为目标文件。下载中断后重新运行本脚本即可继续。
+# 可通过环境变量调整：DOWNLOAD_JOBS（并行文件数）、DOWNLOAD_LIMIT_MBPS（总带宽上限，MB/s）、
+# DOWNLOAD_REQUIRE_HASH（非空时拒绝清单中未列出 sha256 的文件；否则仅对未校验文件输出警告）
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+python3 "$SCRIPT_DIR/download_models.py" \
+    --manifest "$SCRIPT_DIR/models-manifest.json" \
+    --root "$MODELS_DIR" \
+    --jobs "${DOWNLOAD_JOBS:-4}" \
+    --limit-mbps "${DOWNLOAD_LIMIT_MBPS:-0}" \
+    ${DOWNLOAD_REQUIRE_HASH:+--require-hash} \
+    || echo "⚠ 部分模型下载失败，重新运行本脚本将从中断处继续"
+
+# ReActor 说明（https://github.com/Gourieff/ComfyUI-ReActor）：
+# - swap_model 参数的值是 "inswapper_128.onnx"，必须放在 ComfyUI/models/insightface/ 根目录
 # - reswapper_128.onnx 放在 ComfyUI/models/reswapper/ 目录（用于其他功能）
-
-# 下载 inswapper_128.onnx 到 insightface 目录（swap_model 参数使用此文件）
-download_file \
-    "https://huggingface.co/datasets/Gourieff/ReActor/resolve/main/models/inswapper_128.onnx" \
-    "$MODELS_DIR/insightface/inswapper_128.onnx" \
-    "ReActor inswapper (insightface根目录 - swap_model参数使用此文件)"
-
-# 下载 reswapper_128.onnx 到 reswapper 目录（用于其他功能）
-download_file \
-    "https://huggingface.co/datasets/Gourieff/ReActor/resolve/main/models/reswapper_128.onnx" \
-    "$MODELS_DIR/reswapper/reswapper_128.onnx" \
-    "ReActor reswapper (reswapper目录)"
-
 # 验证文件是否下载成功
 echo "验证 ReActor 模型文件..."
 if [ -f "$MODELS_DIR/insightface/inswapper_128.onnx" ]; then
@@ -174,108 +124,8 @@ fi
 echo "  insightface 目录中的 .onnx 文件（ReActor swap_model 从此目录读取）："
 find "$MODELS_DIR/insightface" -maxdepth 1 -name "*.onnx" -type f 2>/dev/null | head -10 || echo "    (未找到 .onnx 文件)"
 
-download_file \
-    "https://huggingface.co/facefusion/models-3.3.0/resolve/main/hyperswap_1a_256.onnx" \
-    "$MODELS_DIR/hyperswap/hyperswap_1a_256.onnx" \
-    "HyperSwap 1a"
-
-download_file \
-    "https://huggingface.co/facefusion/models-3.3.0/resolve/main/hyperswap_1b_256.onnx" \
-    "$MODELS_DIR/hyperswap/hyperswap_1b_256.onnx" \
-    "HyperSwap 1b"
-
-download_file \
-    "https://huggingface.co/facefusion/models-3.3.0/resolve/main/hyperswap_1c_256.onnx" \
-    "$MODELS_DIR/hyperswap/hyperswap_1c_256.onnx" \
-    "HyperSwap 1c"
-
 echo ""
 
-# ============================================
-# 面部修复和超分辨率模型
-# ============================================
-echo "=========================================="
-echo "下载面部修复和超分辨率模型"
-echo "=========================================="
-
-download_file \
-    "https://huggingface.co/ai-forever/Real-ESRGAN/resolve/main/RealESRGAN_x2.pth" \
-    "$MODELS_DIR/upscale_models/RealESRGAN_x2.pth" \
-    "RealESRGAN x2"
-
-download_file \
-    "https://huggingface.co/datasets/Gourieff/ReActor/resolve/main/models/facerestore_models/GFPGANv1.4.pth" \
-    "$MODELS_DIR/facerestore_models/GFPGANv1.4.pth" \
-    "GFPGAN v1.4"
-
-download_file \
-    "https://huggingface.co/datasets/Gourieff/ReActor/resolve/main/models/facerestore_models/GPEN-BFR-512.onnx" \
-    "$MODELS_DIR/facerestore_models/GPEN-BFR-512.onnx" \
-    "GPEN-BFR-512"
-
-echo ""
-
-# ============================================
-# LoRA 模型 (SDXL)
-# ============================================
-echo "=========================================="
-echo "下载 LoRA 模型 (SDXL)"
-echo "=========================================="
-
-download_file \
-    "https://huggingface.co/datasets/Robin9527/LoRA/resolve/main/SDXL/subtle-analsex-xl3.safetensors" \
-    "$MODELS_DIR/loras/SDXL/subtle-analsex-xl3.safetensors" \
-    "SDXL LoRA: subtle-analsex-xl3"
-
-download_file \
-    "https://huggingface.co/datasets/Robin9527/LoRA/resolve/main/SDXL/LCMV2-PONYplus-PAseer.safetensors" \
-    "$MODELS_DIR/loras/SDXL/LCMV2-PONYplus-PAseer.safetensors" \
-    "SDXL LoRA: LCMV2-PONYplus-PAseer"
-
-echo ""
-
-# ============================================
-# LoRA 模型 (Wan2.2)
-# ============================================
-echo "=========================================="
-echo "下载 LoRA 模型 (Wan2.2)"
-echo "=========================================="
-
-# 定义 Wan2.2 LoRA 列表（与 Dockerfile 保持一致）
-declare -a wan22_loras=(
-    "DR34MJOB_I2V_14b_HighNoise.safetensors"
-    "DR34MJOB_I2V_14b_LowNoise.safetensors"
-    "W22_NSFW_Posing_Nude_i2v_HN_v1.safetensors"
-    "W22_NSFW_Posing_Nude_i2v_LN_v1.safetensors"
-    "huge-titfuck-high.safetensors"
-    "huge-titfuck-low.safetensors"
-    "mql_massage_tits_wan22_i2v_v1_high_noise.safetensors"
-    "mql_massage_tits_wan22_i2v_v1_low_noise.safetensors"
-    "nsfw_wan_14b_spooning_leg_lifted_sex_position.safetensors"
-    "pworship_high_noise.safetensors"
-    "pworship_low_noise.safetensors"
-    "spanking_for_wan_v1_e128.safetensors"
-    "sockjob_wan_v1.safetensors"
-    "wan-thiccum-v3.safetensors"
-    "wan2.2-i2v-high-oral-insertion-v1.0.safetensors"
-    "wan2.2-i2v-low-oral-insertion-v1.0.safetensors"
-    "wan22-jellyhips-i2v-13epoc-high-k3nk.safetensors"
-    "wan22-jellyhips-i2v-23epoc-low-k3nk.safetensors"
-    "wan_shoejob_footjob_14B_v10_e15.safetensors"
-    "zurimix-high-i2v.safetensors"
-    "zurimix-low-i2v.safetensors"
-)
-
-for lora in "${wan22_loras[@]}"; do
-    download_file \
-        "https://huggingface.co/datasets/Robin9527/LoRA/resolve/main/Wan22/$lora" \
-        "$MODELS_DIR/loras/Wan2.2/$lora" \
-        "Wan2.2 LoRA: $lora"
-done
-
-echo ""
-
-
 # ============================================
 # MiniCPM-V-2_6-int4 模型（使用 huggingface_hub 下载整个目录）
 # ============================================
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Download model files to the Network Volume from a declarative manifest.
+
+Files are downloaded in parallel under a global connection cap and an optional global
+bandwidth cap. Large files on servers that support HTTP Range requests are split into
+segments fetched concurrently. Every download goes to "<target>.part", with its
+progress recorded in "<target>.part.json", so an interrupted run resumes where it
+stopped. Once complete, the file's size and sha256 (when listed) are verified, and
+only then is it renamed onto the target path.
+
+Manifest (JSON):
+    {
+      "files": [
+        {"url": "https://...", "path": "checkpoints/SDXL/model.safetensors",
+         "size": 6938041144, "sha256": "..."}
+      ]
+    }
+"path" is relative to --root. "size" and "sha256" are optional; a listed sha256 is
+always verified before the file is put in place. Entries without a sha256 are logged
+as unverified, and rejected outright with --require-hash.
+
+Usage:
+    python3 scripts/download_models.py --root /workspace/models
+    python3 scripts/download_models.py --root /workspace/models --jobs 8 --limit-mbps 200
+    python3 scripts/download_models.py --root /workspace/models --require-hash
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models-manifest.json")
+CHUNK_SIZE = 1024 * 1024
+# Progress of a file is persisted after at least this many new bytes
+STATE_SAVE_INTERVAL = 16 * 1024 * 1024
+USER_AGENT = "worker-comfyui-model-downloader"
+
+
+class DownloadError(Exception):
+    """A file could not be downloaded or failed verification."""
+
+
+class RateLimiter:
+    """Token bucket shared by all connections; a rate of 0 disables limiting."""
+
+    def __init__(self, bytes_per_s):
+        self.rate = bytes_per_s
+        self.allowance = bytes_per_s
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, num_bytes):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= num_bytes
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE * 8), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def plan_segments(size, segments, segment_min_bytes):
+    """Split [0, size) into up to `segments` [start, end, done] ranges of at least segment_min_bytes."""
+    count = max(1, min(segments, size // max(1, segment_min_bytes)))
+    step = -(-size // count)
+    return [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]
+
+
+class Downloader:
+    """Downloads manifest entries under shared connection and bandwidth caps."""
+
+    def __init__(
+        self,
+        root,
+        max_connections=16,
+        segments=4,
+        segment_min_bytes=64 * 1024 * 1024,
+        limit_bytes_per_s=0,
+        retries=3,
+        retry_delay_s=2.0,
+        timeout=60,
+        verify_existing=False,
+        require_hash=False,
+        log=print,
+    ):
+        self.root = root
+        self.connections = threading.BoundedSemaphore(max(1, max_connections))
+        self.segments = max(1, segments)
+        self.segment_min_bytes = segment_min_bytes
+        self.limiter = RateLimiter(limit_bytes_per_s)
+        self.retries = max(1, retries)
+        self.retry_delay_s = retry_delay_s
+        self.timeout = timeout
+        self.verify_existing = verify_existing
+        self.require_hash = require_hash
+        self.log = log
+
+    # -- HTTP --------------------------------------------------------------
+
+    def _open(self, url, byte_range=None):
+        headers = {"User-Agent": USER_AGENT}
+        if byte_range is not None:
+            headers["Range"] = f"bytes={byte_range[0]}-{byte_range[1]}"
+        return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout)
+
+    def probe(self, url):
+        """
+        Resolve redirects and find the size and Range support of a URL.
+
+        Returns:
+            tuple: (final_url, size or None, supports_range)
+        """
+        with self.connections, self._open(url, (0, 0)) as resp:
+            final_url = resp.geturl()
+            if resp.status == 206:
+                match = re.search(r"/(\d+)$", resp.headers.get("Content-Range", ""))
+                if match:
+                    return final_url, int(match.group(1)), True
+            length = resp.headers.get("Content-Length")
+            return final_url, int(length) if length and resp.status == 200 else None, False
+
+    def _fetch_segment(self, url, fd, segment, on_progress):
+        """Fetch the remaining bytes of one [start, end, done] segment into fd, with retries."""
+        for attempt in range(1, self.retries + 1):
+            start, end, done = segment
+            pos = start + done
+            if pos > end:
+                return
+            try:
+                with self.connections, self._open(url, (pos, end)) as resp:
+                    if resp.status != 206:
+                        raise DownloadError(f"server ignored Range request (HTTP {resp.status})")
+                    while pos <= end:
+                        chunk = resp.read(min(CHUNK_SIZE, end - pos + 1))
+                        if not chunk:
+                            raise DownloadError(f"connection closed at byte {pos}")
+                        self.limiter.consume(len(chunk))
+                        os.pwrite(fd, chunk, pos)
+                        pos += len(chunk)
+                        segment[2] = pos - start
+                        on_progress(len(chunk))
+                return
+            except (OSError, DownloadError) as e:
+                if attempt == self.retries:
+                    raise DownloadError(f"bytes {pos}-{end}: {e}") from e
+                time.sleep(min(self.retry_delay_s * 2 ** (attempt - 1), 30))
+
+    def _fetch_stream(self, url, part_path):
+        """Plain sequential download for servers without Range support (no resume)."""
+        for attempt in range(1, self.retries + 1):
+            try:
+                with self.connections, self._open(url) as resp, open(part_path, "wb") as f:
+                    for chunk in iter(lambda: resp.read(CHUNK_SIZE), b""):
+                        self.limiter.consume(len(chunk))
+                        f.write(chunk)
+                return
+            except OSError as e:
+                if attempt == self.retries:
+                    raise DownloadError(str(e)) from e
+                time.sleep(min(self.retry_delay_s * 2 ** (attempt - 1), 30))
+
+    # -- Files -------------------------------------------------------------
+
+    def _is_complete(self, target, entry):
+        if not os.path.isfile(target):
+            return False
+        if entry.get("size") is not None and os.path.getsize(target) != entry["size"]:
+            return False
+        if self.verify_existing and entry.get("sha256"):
+            return sha256_file(target) == entry["sha256"].lower()
+        return True
+
+    def download(self, entry):
+        """
+        Download one manifest entry.
+
+        Returns:
+            dict: path, status ("skipped", "downloaded" or "failed"), bytes fetched in
+            this run, seconds, and the error for failures.
+        """
+        target = os.path.join(self.root, entry["path"])
+        result = {"path": entry["path"], "status": "downloaded", "bytes": 0, "seconds": 0.0}
+        started = time.perf_counter()
+        if not entry.get("sha256"):
+            if self.require_hash:
+                result.update(status="failed", error="no sha256 listed in the manifest")
+                self.log(f"✗ {entry['path']}: {result['error']}")
+                return result
+            self.log(f"⚠ {entry['path']}: no sha256 listed in the manifest, file is not verified")
+        if self._is_complete(target, entry):
+            result["status"] = "skipped"
+            return result
+        try:
+            result["bytes"] = self._download(entry, target)
+        except (OSError, DownloadError) as e:
+            result.update(status="failed", error=str(e))
+            self.log(f"✗ {entry['path']}: {e}")
+        result["seconds"] = round(time.perf_counter() - started, 2)
+        if result["status"] == "downloaded":
+            rate = result["bytes"] / result["seconds"] / 1e6 if result["seconds"] else 0
+            self.log(f"✓ {entry['path']} ({result['bytes'] / 1e6:.1f} MB, {rate:.1f} MB/s)")
+        return result
+
+    def _download(self, entry, target):
+        os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+        part_path, state_path = f"{target}.part", f"{target}.part.json"
+        url, size, ranged = self.probe(entry["url"])
+        if entry.get("size") is not None and size is not None and size != entry["size"]:
+            raise DownloadError(f"server reports {size} bytes, manifest lists {entry['size']}")
+
+        if not ranged or not size:
+            self._fetch_stream(url, part_path)
+            fetched = os.path.getsize(part_path)
+        else:
+            fetched = self._fetch_ranged(entry, url, size, part_path, state_path)
+
+        self._verify_and_commit(entry, part_path, state_path, target, size)
+        return fetched
+
+    def _fetch_ranged(self, entry, url, size, part_path, state_path):
+        state = None
+        if os.path.exists(part_path) and os.path.exists(state_path):
+            try:
+                with open(state_path, encoding="utf-8") as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = None
+        # The recorded progress is only trusted for the same source and size
+        if not state or state.get("url") != entry["url"] or state.get("size") != size:
+            state = {
+                "url": entry["url"],
+                "size": size,
+                "segments": plan_segments(size, self.segments, self.segment_min_bytes),
+            }
+            with open(part_path, "wb") as f:
+                f.truncate(size)
+        else:
+            self.log(f"… resuming {entry['path']} ({sum(s[2] for s in state['segments']) / 1e6:.1f} MB done)")
+
+        lock = threading.Lock()
+        progress = {"fetched": 0, "unsaved": 0}
+
+        def save_state():
+            tmp = f"{state_path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp, state_path)
+
+        def on_progress(num_bytes):
+            with lock:
+                progress["fetched"] += num_bytes
+                progress["unsaved"] += num_bytes
+                if progress["unsaved"] >= STATE_SAVE_INTERVAL:
+                    progress["unsaved"] = 0
+                    save_state()
+
+        save_state()
+        fd = os.open(part_path, os.O_WRONLY)
+        try:
+            segments = state["segments"]
+            with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+                futures = [pool.submit(self._fetch_segment, url, fd, s, on_progress) for s in segments]
+                errors = [e for e in (f.exception() for f in futures) if e is not None]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+            with lock:
+                save_state()
+        if errors:
+            raise errors[0]
+        return progress["fetched"]
+
+    def _verify_and_commit(self, entry, part_path, state_path, target, size):
+        actual_size = os.path.getsize(part_path)
+        expected_size = entry.get("size") if entry.get("size") is not None else size
+        if expected_size is not None and actual_size != expected_size:
+            raise DownloadError(f"size mismatch: got {actual_size} bytes, expected {expected_size}")
+        if entry.get("sha256"):
+            digest = sha256_file(part_path)
+            if digest != entry["sha256"].lower():
+                # A corrupt file cannot be repaired by resuming; start over next time
+                for path in (part_path, state_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                raise DownloadError(f"sha256 mismatch: got {digest}")
+        os.replace(part_path, target)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+
+
+def load_manifest(path):
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    files = manifest.get("files") if isinstance(manifest, dict) else manifest
+    for entry in files:
+        if not entry.get("url") or not entry.get("path"):
+            raise ValueError(f"manifest entry needs 'url' and 'path': {entry}")
+    return files
+
+
+def download_all(entries, downloader, jobs=4):
+    """Download entries with up to `jobs` files in flight; returns the per-file results."""
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        return list(pool.map(downloader.download, entries))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST)
+    parser.add_argument("--root", required=True, help="Models directory, e.g. /workspace/models")
+    parser.add_argument("--jobs", type=int, default=4, help="Files downloaded in parallel")
+    parser.add_argument("--max-connections", type=int, default=16, help="Global cap on HTTP connections")
+    parser.add_argument("--segments", type=int, default=4, help="Max concurrent Range segments per file")
+    parser.add_argument("--segment-min-mb", type=int, default=64, help="Minimum segment size in MB")
+    parser.add_argument("--limit-mbps", type=float, default=0, help="Global bandwidth cap in MB/s (0 = none)")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--verify-existing", action="store_true",
+                        help="Hash files that already exist instead of trusting their size")
+    parser.add_argument("--require-hash", action="store_true",
+                        help="Fail every manifest entry that does not list a sha256")
+    parser.add_argument("--json", action="store_true", help="Print per-file results as JSON")
+    args = parser.parse_args(argv)
+
+    entries = load_manifest(args.manifest)
+    downloader = Downloader(
+        args.root,
+        max_connections=args.max_connections,
+        segments=args.segments,
+        segment_min_bytes=args.segment_min_mb * 1024 * 1024,
+        limit_bytes_per_s=int(args.limit_mbps * 1e6),
+        retries=args.retries,
+        verify_existing=args.verify_existing,
+        require_hash=args.require_hash,
+    )
+    started = time.perf_counter()
+    results = download_all(entries, downloader, jobs=args.jobs)
+    elapsed = time.perf_counter() - started
+
+    counts = {status: sum(r["status"] == status for r in results) for status in ("downloaded", "skipped", "failed")}
+    total_bytes = sum(r["bytes"] for r in results)
+    if args.json:
+        print(json.dumps({"results": results, **counts, "bytes": total_bytes, "seconds": round(elapsed, 2)}))
+    else:
+        print(
+            f"{counts['downloaded']} downloaded, {counts['skipped']} skipped, {counts['failed']} failed; "
+            f"{total_bytes / 1e9:.2f} GB in {elapsed:.0f} s"
+        )
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+"""
+Link ComfyUI's model directories to the Network Volume.
+
+Replaces the per-directory create_model_symlink calls of start.sh. The directory list
+comes from the runpod_worker_comfy section of extra_model_paths.yaml, so it lives in
+one place. For every entry with a source directory on the volume,
+/comfyui/<path> becomes a symlink to /runpod-volume/<path>.
+
+Work on the network mount is kept to one os.scandir() per parent directory. That
+result is cached in a state file and reused while the parents' mtimes are unchanged.
+Links are then reconciled in parallel:
+    • a correct link is left alone
+    • a wrong or broken link is replaced
+    • an existing directory is moved to /comfyui/models/.backup/<name>.<timestamp>
+    • a file is removed
+
+Usage:
+    python /setup_model_symlinks.py
+    python src/setup_model_symlinks.py --config src/extra_model_paths.yaml --json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Section of extra_model_paths.yaml that lists the Network Volume directories
+VOLUME_SECTION = "runpod_worker_comfy"
+DEFAULT_CONFIG_PATHS = (
+    "/extra_model_paths.yaml",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "extra_model_paths.yaml"),
+)
+DEFAULT_COMFY_ROOT = "/comfyui"
+DEFAULT_STATE_FILE = "/comfyui/.model_symlinks_state.json"
+DEFAULT_WORKERS = 16
+
+
+def log(message):
+    print(f"worker-comfyui: {message}", flush=True)
+
+
+def _parse_simple_yaml(text):
+    """Parse the two-level "section: / key: value" layout of extra_model_paths.yaml."""
+    config, section = {}, None
+    for raw in text.splitlines():
+        line = raw.split("#", 1)[0].rstrip()
+        if not line.strip():
+            continue
+        key, _, value = line.strip().partition(":")
+        if not raw.startswith((" ", "\t")):
+            section = config.setdefault(key.strip(), {})
+        elif section is not None:
+            section[key.strip()] = value.strip()
+    return config
+
+
+def load_model_dirs(config_path, section=VOLUME_SECTION):
+    """
+    Read the model directories of one section of extra_model_paths.yaml.
+
+    Returns:
+        tuple: (base_path, [relative directory, ...]) in file order.
+    """
+    with open(config_path, encoding="utf-8") as f:
+        text = f.read()
+    try:
+        import yaml
+
+        config = yaml.safe_load(text) or {}
+    except ImportError:
+        config = _parse_simple_yaml(text)
+    entries = config.get(section) or {}
+    base_path = str(entries.get("base_path", "/runpod-volume"))
+    rel_dirs = [
+        str(value).strip().rstrip("/")
+        for key, value in entries.items()
+        if key not in ("base_path", "is_default") and isinstance(value, str) and value.strip()
+    ]
+    return base_path, rel_dirs
+
+
+def _config_hash(base_path, rel_dirs):
+    return hashlib.sha256(json.dumps([base_path, rel_dirs]).encode("utf-8")).hexdigest()[:16]
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def scan_sources(volume_root, rel_dirs):
+    """Return the relative dirs that exist on the volume (one scandir per parent directory)."""
+    by_parent = {}
+    for rel in rel_dirs:
+        parent, _, name = rel.rpartition("/")
+        by_parent.setdefault(parent, set()).add(name)
+    present = set()
+    for parent, names in by_parent.items():
+        try:
+            with os.scandir(os.path.join(volume_root, parent)) as it:
+                for entry in it:
+                    if entry.name in names and entry.is_dir():
+                        present.add(f"{parent}/{entry.name}" if parent else entry.name)
+        except OSError:
+            continue
+    return [rel for rel in rel_dirs if rel in present]
+
+
+def load_state(state_file):
+    try:
+        with open(state_file, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state_file, state):
+    tmp = f"{state_file}.tmp"
+    try:
+        os.makedirs(os.path.dirname(state_file) or ".", exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, state_file)
+    except OSError as e:
+        log(f"WARNING: Could not write symlink state file {state_file}: {e}")
+
+
+def reconcile_link(source, target, backup_dir):
+    """
+    Make target a symlink to source.
+
+    Returns:
+        str: "ok" (already correct), "created", "backed_up" (an existing directory
+        was moved away first) or "failed".
+    """
+    backed_up = False
+    try:
+        if os.path.islink(target):
+            if os.readlink(target) == source:
+                return "ok"
+            os.unlink(target)
+        elif os.path.isdir(target):
+            os.makedirs(backup_dir, exist_ok=True)
+            backup_path = os.path.join(backup_dir, f"{os.path.basename(target)}.{int(time.time())}")
+            if os.path.exists(backup_path):
+                backup_path = f"{backup_path}.{os.getpid()}"
+            try:
+                shutil.move(target, backup_path)
+                log(f"Backed up existing directory {target} to {backup_path}")
+                backed_up = True
+            except OSError as e:
+                log(f"WARNING: Failed to backup existing directory {target} ({e}), attempting to remove it")
+                shutil.rmtree(target)
+        elif os.path.lexists(target):
+            os.unlink(target)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.symlink(source, target)
+    except OSError as e:
+        log(f"ERROR: Failed to create symlink {target} -> {source}: {e}")
+        return "failed"
+    return "backed_up" if backed_up else "created"
+
+
+def setup_symlinks(
+    config_path,
+    comfy_root=DEFAULT_COMFY_ROOT,
+    volume_root=None,
+    state_file=DEFAULT_STATE_FILE,
+    workers=DEFAULT_WORKERS,
+):
+    """
+    Reconcile all model directory symlinks.
+
+    Args:
+        config_path (str): extra_model_paths.yaml to read the directory list from.
+        comfy_root (str): ComfyUI root; links are created at comfy_root/<dir>.
+        volume_root (str, optional): Network Volume root. Defaults to the section's base_path.
+        state_file (str, optional): Cache of the last volume scan. None disables it.
+        workers (int): Threads used to reconcile links.
+
+    Returns:
+        dict: Counts per outcome, the number of sources, whether the cached scan was
+        used, and durations in milliseconds.
+    """
+    started = time.perf_counter()
+    base_path, rel_dirs = load_model_dirs(config_path)
+    volume_root = volume_root or base_path
+    configured = time.perf_counter()
+
+    # The scan is reused while the config and every scanned parent's mtime are unchanged:
+    # creating or removing a model directory on the volume changes its parent's mtime
+    parents = sorted({rel.rpartition("/")[0] for rel in rel_dirs})
+    fingerprint = {
+        "config": _config_hash(volume_root, rel_dirs),
+        "mtimes": [_mtime(os.path.join(volume_root, p)) for p in parents],
+    }
+    state = load_state(state_file) if state_file else {}
+    cache_hit = state.get("fingerprint") == fingerprint and isinstance(state.get("sources"), list)
+    sources = state["sources"] if cache_hit else scan_sources(volume_root, rel_dirs)
+    scanned = time.perf_counter()
+
+    backup_dir = os.path.join(comfy_root, "models", ".backup")
+    counts = {"ok": 0, "created": 0, "backed_up": 0, "failed": 0}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = pool.map(
+            lambda rel: reconcile_link(
+                os.path.join(volume_root, rel), os.path.join(comfy_root, rel), backup_dir
+            ),
+            sources,
+        )
+        for outcome in results:
+            counts[outcome] += 1
+
+    if state_file and not cache_hit:
+        save_state(state_file, {"fingerprint": fingerprint, "sources": sources})
+
+    finished = time.perf_counter()
+    return {
+        **counts,
+        "sources": len(sources),
+        "configured": len(rel_dirs),
+        "scan_cached": cache_hit,
+        "config_ms": round((configured - started) * 1000, 2),
+        "scan_ms": round((scanned - configured) * 1000, 2),
+        "total_ms": round((finished - started) * 1000, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--config", help="extra_model_paths.yaml (default: /extra_model_paths.yaml)")
+    parser.add_argument("--comfy-root", default=DEFAULT_COMFY_ROOT)
+    parser.add_argument("--volume-root", help="Network Volume root (default: base_path from the config)")
+    parser.add_argument("--state-file", default=DEFAULT_STATE_FILE,
+                        help="Cache of the last volume scan ('' disables it)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    config_path = args.config or next((p for p in DEFAULT_CONFIG_PATHS if os.path.isfile(p)), None)
+    if not config_path:
+        log("ERROR: extra_model_paths.yaml not found, model symlinks not set up")
+        return 1
+
+    report = setup_symlinks(
+        config_path,
+        comfy_root=args.comfy_root,
+        volume_root=args.volume_root,
+        state_file=args.state_file or None,
+        workers=args.workers,
+    )
+    if args.json:
+        print(json.dumps(report))
+    else:
+        log(
+            f"Model directory symlinks setup complete in {report['total_ms']} ms "
+            f"({report['sources']}/{report['configured']} directories on the volume, "
+            f"{report['ok']} unchanged, {report['created']} created, "
+            f"{report['backed_up']} backed up, {report['failed']} failed, "
+            f"scan {'cached' if report['scan_cached'] else 'fresh'} in {report['scan_ms']} ms)"
+        )
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
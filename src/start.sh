@@ -76,141 +76,15 @@ if [ -d "/runpod-volume/models" ]; then
     echo "worker-comfyui: /runpod-volume/models exists, setting up symlinks"
     echo "worker-comfyui: Setting up model directory symlinks from Network Volume"
     
-    # Function to create symlink for a model directory
-    # Maps: /comfyui/models/{dir} -> /runpod-volume/models/{dir}
+    # Maps: /comfyui/models/{dir} -> /runpod-volume/models/{dir} for every directory listed
+    # in the runpod_worker_comfy section of extra_model_paths.yaml (the single source of
+    # the directory list). Links are reconciled in parallel; the volume scan is cached in
+    # /comfyui/.model_symlinks_state.json and reused while the volume is unchanged.
     # Note: In Temporary Pod, Network Volume mounts at /workspace
     #       In Endpoint, Network Volume mounts at /runpod-volume
     #       Both point to the same Volume, so files are accessible regardless of mount point
-    create_model_symlink() {
-        local model_dir="$1"
-        local source_path="/runpod-volume/models/${model_dir}"  # Endpoint mount point
-        local target_path="/comfyui/models/${model_dir}"         # ComfyUI default path
-        
-        # Only create symlink if source exists in Network Volume
-        if [ -d "$source_path" ]; then
-            # Check if target already exists
-            if [ -e "$target_path" ]; then
-                # If it's already a symlink pointing to the correct location, skip
-                if [ -L "$target_path" ]; then
-                    # Check if symlink points to the correct location
-                    # We create absolute symlinks, so we can directly compare
-                    local current_target=$(readlink "$target_path" 2>/dev/null)
-                    if [ "$current_target" = "$source_path" ]; then
-                        # Symlink already points to correct location, skip
-                        return 0
-                    fi
-                    # Symlink points to wrong location or is broken, remove it
-                    rm -f "$target_path"
-                elif [ -d "$target_path" ]; then
-                    # Target is a directory (may be non-empty), need to backup and remove
-                    # Create backup directory if it doesn't exist
-                    local backup_dir="/comfyui/models/.backup"
-                    mkdir -p "$backup_dir"
-                    
-                    # Move existing directory to backup location with timestamp
-                    local backup_path="${backup_dir}/${model_dir}.$(date +%s)"
-                    if [ -d "$backup_path" ]; then
-                        # If backup already exists (unlikely), append random suffix
-                        backup_path="${backup_path}.$$"
-                    fi
-                    mv "$target_path" "$backup_path" 2>/dev/null || {
-                        echo "worker-comfyui: WARNING: Failed to backup existing directory ${target_path}, attempting to remove it"
-                        # If move fails, try to remove (this will fail if directory is not empty and in use)
-                        rm -rf "$target_path" 2>/dev/null || {
-                            echo "worker-comfyui: ERROR: Cannot remove existing directory ${target_path}, symlink creation skipped"
-                            return 1
-                        }
-                    }
-                    echo "worker-comfyui: Backed up existing directory ${target_path} to ${backup_path}"
-                else
-                    # Target exists but is not a directory or symlink (file?), remove it
-                    rm -f "$target_path"
-                fi
-            fi
-            
-            # Create parent directory if it doesn't exist
-            mkdir -p "$(dirname "$target_path")"
-            
-            # Create symlink
-            if ln -sf "$source_path" "$target_path" 2>/dev/null; then
-                echo "worker-comfyui: Created symlink ${target_path} -> ${source_path}"
-            else
-                echo "worker-comfyui: ERROR: Failed to create symlink ${target_path} -> ${source_path}"
-                return 1
-            fi
-        fi
-    }
-    
-    # Core ComfyUI model directories
-    create_model_symlink "checkpoints"
-    create_model_symlink "clip"
-    create_model_symlink "clip_vision"
-    create_model_symlink "configs"
-    create_model_symlink "controlnet"
-    create_model_symlink "diffusers"
-    create_model_symlink "embeddings"
-    create_model_symlink "gligen"
-    create_model_symlink "hypernetworks"
-    create_model_symlink "loras"
-    create_model_symlink "style_models"
-    create_model_symlink "unet"
-    create_model_symlink "upscale_models"
-    create_model_symlink "vae"
-    create_model_symlink "vae_approx"
-    
-    # AnimateDiff model directories
-    create_model_symlink "animatediff_models"
-    create_model_symlink "animatediff_motion_lora"
-    
-    # IP-Adapter and related
-    create_model_symlink "ipadapter"
-    create_model_symlink "pulid"
-    
-    # Face-related models
-    create_model_symlink "insightface"
-    create_model_symlink "facerestore_models"
-    create_model_symlink "facedetection"
-    create_model_symlink "facexlib"
-    create_model_symlink "instantid"
-    
-    # ReActor and HyperSwap models
-    create_model_symlink "reswapper"
-    create_model_symlink "hyperswap"
-    
-    # Vision and detection models
-    create_model_symlink "photomaker"
-    create_model_symlink "sams"
-    create_model_symlink "mmdets"
-    create_model_symlink "ultralytics"
-    create_model_symlink "grounding-dino"
-    create_model_symlink "depthanything"
-    create_model_symlink "florence2"
-    create_model_symlink "BiRefNet"
-    
-    # Video models
-    create_model_symlink "CogVideo"
-    
-    # Audio models
-    create_model_symlink "audio_encoders"
-    
-    # BLIP models (for image captioning)
-    create_model_symlink "blip"
-    
-    # Inpainting models
-    create_model_symlink "inpaint"
-    
-    # Diffusion models (alternative location)
-    create_model_symlink "diffusion_models"
-    
-    # Custom model directories (project-specific)
-    create_model_symlink "bagel"
-    create_model_symlink "Ben"
-    create_model_symlink "CatVTON"
-    create_model_symlink "Janus-Pro"
-    create_model_symlink "Flux-version-LayerDiffuse"
-    create_model_symlink "prompt_generator"
-    
-    echo "worker-comfyui: Model directory symlinks setup complete"
+    python /setup_model_symlinks.py --config /extra_model_paths.yaml \
+        || echo "worker-comfyui: WARNING: Some model directory symlinks could not be created" >&2
     
     # Verify antelopev2 subdirectory for PuLID_ComfyUI
     if [ -d "/runpod-volume/models/insightface/models/antelopev2" ]; then
@@ -0,0 +1,184 @@
+"""
+End-to-end benchmarks of handler.py against the fake ComfyUI server.
+
+Runs offline and without a GPU: ComfyUI is replaced by tests/fake_comfyui.py, so the
+numbers measure the handler's own overhead (HTTP, websocket, base64/S3 handling,
+copies) plus the configured simulated execution delay.
+
+Usage:
+    python tests/benchmark_handler.py                      # all scenarios
+    python tests/benchmark_handler.py --scenario large_video --jobs 5
+    python tests/benchmark_handler.py --exec-delay 0 --json
+
+Reported per scenario: latency p50/p95/p99/max, throughput (jobs/s), peak RSS and
+the bytes moved per job (URL downloads, uploads, /view fetches, base64, S3).
+"""
+
+import argparse
+import base64
+import json
+import os
+import resource
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import handler  # noqa: E402
+from fake_comfyui import FakeComfyUI  # noqa: E402
+
+# Counters from handler.metrics that represent bytes copied by the handler
+BYTE_COUNTERS = (
+    "worker_url_download_bytes_total",
+    "worker_input_upload_bytes_total",
+    "worker_output_fetch_bytes_total",
+    "worker_base64_bytes_total",
+    "worker_s3_upload_bytes_total",
+)
+
+SCENARIOS = {
+    "image_batch": {"inputs": 1, "input_bytes": 512 * 1024, "output_nodes": 1,
+                    "outputs_per_node": 4, "output_bytes": 2 * 1024 * 1024, "video": False},
+    "large_video": {"inputs": 1, "input_bytes": 512 * 1024, "output_nodes": 1,
+                    "outputs_per_node": 1, "output_bytes": 64 * 1024 * 1024, "video": True},
+    "many_inputs": {"inputs": 16, "input_bytes": 256 * 1024, "output_nodes": 1,
+                    "outputs_per_node": 1, "output_bytes": 1024 * 1024, "video": False},
+}
+
+
+def build_workflow(inputs, output_nodes, video):
+    """A minimal API-format workflow: LoadImage nodes -> KSampler -> output nodes."""
+    workflow = {
+        "1": {"class_type": "CheckpointLoaderSimple",
+              "inputs": {"ckpt_name": "SDXL/model.safetensors"}},
+        "3": {"class_type": "KSampler", "inputs": {"model": ["1", 0], "seed": 1}},
+    }
+    for i in range(inputs):
+        workflow[str(100 + i)] = {"class_type": "LoadImage", "inputs": {"image": f"input_{i}.png"}}
+    for i in range(output_nodes):
+        if video:
+            workflow[str(200 + i)] = {"class_type": "VHS_VideoCombine",
+                                      "inputs": {"images": ["3", 0], "filename_prefix": "video"}}
+        else:
+            workflow[str(200 + i)] = {"class_type": "SaveImage",
+                                      "inputs": {"images": ["3", 0], "filename_prefix": "ComfyUI"}}
+    return workflow
+
+
+def build_job(index, scenario):
+    image = base64.b64encode(os.urandom(scenario["input_bytes"])).decode("utf-8")
+    return {
+        "id": f"bench-{index}",
+        "input": {
+            "workflow": build_workflow(scenario["inputs"], scenario["output_nodes"], scenario["video"]),
+            "images": [{"name": f"input_{i}.png", "image": image} for i in range(scenario["inputs"])],
+        },
+    }
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def run_scenario(name, scenario, jobs, concurrency, exec_delay_s):
+    server = FakeComfyUI(
+        exec_delay_s=exec_delay_s,
+        outputs_per_node=scenario["outputs_per_node"],
+        output_bytes=scenario["output_bytes"],
+    ).start()
+    previous_host = handler.COMFY_HOST
+    handler.COMFY_HOST = server.host
+    try:
+        job_list = [build_job(i, scenario) for i in range(jobs)]
+        bytes_before = {c: handler.metrics.value(c) for c in BYTE_COUNTERS}
+        latencies = []
+        failures = 0
+        lock = threading.Lock()
+
+        def run(job):
+            nonlocal failures
+            started = time.perf_counter()
+            result = handler.handler(job)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed * 1000)
+                if "error" in result:
+                    failures += 1
+
+        wall_started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(run, job_list))
+        wall_s = time.perf_counter() - wall_started
+
+        bytes_per_job = {
+            c.replace("worker_", "").replace("_total", ""):
+                int((handler.metrics.value(c) - bytes_before[c]) / jobs)
+            for c in BYTE_COUNTERS
+        }
+        return {
+            "scenario": name,
+            "jobs": jobs,
+            "concurrency": concurrency,
+            "failures": failures,
+            "latency_ms": {
+                "p50": round(percentile(latencies, 50), 1),
+                "p95": round(percentile(latencies, 95), 1),
+                "p99": round(percentile(latencies, 99), 1),
+                "max": round(max(latencies), 1),
+                "mean": round(statistics.mean(latencies), 1),
+            },
+            "throughput_jobs_s": round(jobs / wall_s, 2),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "bytes_per_job": bytes_per_job,
+        }
+    finally:
+        handler.COMFY_HOST = previous_host
+        server.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenario", choices=[*SCENARIOS, "all"], default="all")
+    parser.add_argument("--jobs", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--exec-delay", type=float, default=0.05,
+                        help="Simulated ComfyUI execution time per prompt (seconds)")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args(argv)
+
+    names = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    results = [
+        run_scenario(name, SCENARIOS[name], args.jobs, args.concurrency, args.exec_delay)
+        for name in names
+    ]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return results
+    for r in results:
+        lat = r["latency_ms"]
+        print(
+            f"{r['scenario']:<12} jobs={r['jobs']} conc={r['concurrency']} fail={r['failures']} "
+            f"p50={lat['p50']}ms p95={lat['p95']}ms p99={lat['p99']}ms "
+            f"thr={r['throughput_jobs_s']}/s rss={r['peak_rss_mb']}MB"
+        )
+        print(f"{'':<12} bytes/job: {r['bytes_per_job']}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,507 @@
+"""
+A small in-process fake of the ComfyUI HTTP + websocket API.
+
+Implements just enough of ComfyUI for handler.py to run end to end without a GPU:
+`/`, `/prompt`, `/queue`, `/history`, `/history/{id}`, `/view`, `/upload/image`,
+`/object_info`, `/system_stats`, `/free`, `/interrupt` and the `/ws` event stream
+(including binary image frames for SaveImageWebsocket nodes).
+
+Execution is simulated: every queued prompt "runs" for `exec_delay_s` seconds, split
+evenly over its nodes, and each output node produces `outputs_per_node` files of
+`output_bytes` bytes. A node's `_meta` block (ignored by real ComfyUI) can override
+this per node: `fake_delay_s`, `fake_output_bytes` and `fake_cached` (reported via
+execution_cached and not run). tests/replay_trace.py uses these to replay recorded
+execution durations.
+
+With `cache=True` the fake also mimics ComfyUI's node cache: a node whose class and
+inputs (including everything upstream of it) are unchanged since the previous prompt
+is reported via execution_cached and not run. Output nodes always run.
+
+Setting `prompt_node_errors` (node ID -> error dict) makes `/prompt` reject every
+workflow with a 400 validation error carrying those node errors, like ComfyUI does.
+
+Usage:
+    server = FakeComfyUI(exec_delay_s=0.2, outputs_per_node=2).start()
+    handler.COMFY_HOST = server.host
+    ...
+    server.stop()
+"""
+
+import base64
+import hashlib
+import http.server
+import json
+import os
+import queue
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# class_type -> history output key for nodes that write files
+OUTPUT_NODE_KEYS = {
+    "SaveImage": "images",
+    "SaveAnimatedWEBP": "images",
+    "VHS_VideoCombine": "gifs",
+}
+VIDEO_EXTENSION_NODES = ("VHS_VideoCombine",)
+
+
+class _WebSocketClient:
+    """Server side of one websocket connection (server frames are unmasked)."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send(self, payload, binary=False):
+        opcode = 0x2 if binary else 0x1
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        length = len(payload)
+        if length < 126:
+            header = struct.pack(">BB", 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, length)
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.sock.sendall(header + payload)
+            except OSError:
+                self.closed = True
+
+    def send_json(self, message):
+        self.send(json.dumps(message))
+
+    def _recv_exact(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("websocket closed")
+            data += chunk
+        return data
+
+    def serve(self):
+        """Read (and discard) client frames until the client closes the connection."""
+        try:
+            while True:
+                first, second = self._recv_exact(2)
+                opcode = first & 0x0F
+                length = second & 0x7F
+                if length == 126:
+                    length = struct.unpack(">H", self._recv_exact(2))[0]
+                elif length == 127:
+                    length = struct.unpack(">Q", self._recv_exact(8))[0]
+                mask = self._recv_exact(4) if second & 0x80 else None
+                payload = self._recv_exact(length)
+                if mask:
+                    payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+                if opcode == 0x8:  # close
+                    with self.lock:
+                        self.sock.sendall(struct.pack(">BB", 0x88, 0))
+                    break
+                if opcode == 0x9:  # ping -> pong
+                    with self.lock:
+                        self.sock.sendall(struct.pack(">BB", 0x8A, len(payload)) + payload)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+
+
+class FakeComfyUI:
+    """Simulated ComfyUI server; see the module docstring."""
+
+    def __init__(
+        self,
+        exec_delay_s=0.1,
+        outputs_per_node=1,
+        output_bytes=256 * 1024,
+        host="127.0.0.1",
+        port=0,
+        cache=False,
+    ):
+        self.exec_delay_s = exec_delay_s
+        self.cache = cache
+        # Node signatures of the previous prompt, for cache=True
+        self._signatures = set()
+        self.outputs_per_node = outputs_per_node
+        self.output_bytes = output_bytes
+        self.bind = (host, port)
+        # node_errors returned with a 400 from /prompt while set
+        self.prompt_node_errors = None
+        self.clients = {}
+        self.history = {}
+        self.files = {}
+        self.uploaded_bytes = 0
+        self.lock = threading.Lock()
+        self.pending = []
+        self.running = None
+        # prompt IDs passed to /interrupt while they were running
+        self.interrupts = []
+        self._interrupt = threading.Event()
+        self.work = queue.Queue()
+        self._payload = None
+        self._counter = 0
+        self.httpd = None
+
+    # -- lifecycle ---------------------------------------------------------
+
+    @property
+    def host(self):
+        return f"{self.httpd.server_address[0]}:{self.httpd.server_address[1]}"
+
+    def start(self):
+        fake = self
+
+        class RequestHandler(_FakeComfyHandler):
+            server_fake = fake
+
+        self.httpd = _FakeHTTPServer(self.bind, RequestHandler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        threading.Thread(target=self._executor, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.work.put(None)
+        for client in list(self.clients.values()):
+            client.closed = True
+            try:
+                client.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    # -- simulated execution -------------------------------------------------
+
+    def payload(self, size=None):
+        size = self.output_bytes if size is None else size
+        if self._payload is None or len(self._payload) < size:
+            self._payload = os.urandom(size)
+        return self._payload[:size]
+
+    def queue_remaining(self):
+        with self.lock:
+            return len(self.pending) + (1 if self.running else 0)
+
+    def broadcast_status(self):
+        message = {
+            "type": "status",
+            "data": {"status": {"exec_info": {"queue_remaining": self.queue_remaining()}}},
+        }
+        for client in list(self.clients.values()):
+            client.send_json(message)
+
+    def submit(self, workflow, client_id, front=False):
+        prompt_id = str(uuid.uuid4())
+        with self.lock:
+            self._counter += 1
+            entry = (-self._counter if front else self._counter, prompt_id, workflow, client_id)
+            if front:
+                self.pending.insert(0, entry)
+            else:
+                self.pending.append(entry)
+        self.work.put(prompt_id)
+        self.broadcast_status()
+        return prompt_id, entry[0]
+
+    def _executor(self):
+        while True:
+            if self.work.get() is None:
+                return
+            with self.lock:
+                if not self.pending:
+                    continue
+                entry = self.pending.pop(0)
+                self.running = entry
+            self._execute(*entry)
+            with self.lock:
+                self.running = None
+            self.broadcast_status()
+
+    def _execute(self, number, prompt_id, workflow, client_id):
+        client = self.clients.get(client_id)
+
+        def send(msg_type, **data):
+            if client:
+                client.send_json({"type": msg_type, "data": dict(data, prompt_id=prompt_id)})
+
+        def meta(node_id):
+            return workflow[node_id].get("_meta") or {}
+
+        send("execution_start", timestamp=int(time.time() * 1000))
+        node_ids = [n for n, d in workflow.items() if isinstance(d, dict)]
+        signatures = self._node_signatures(workflow) if self.cache else {}
+        cached = [
+            n for n in node_ids
+            if meta(n).get("fake_cached")
+            or (
+                signatures.get(n) in self._signatures
+                and workflow[n].get("class_type") not in OUTPUT_NODE_KEYS
+            )
+        ]
+        if self.cache:
+            self._signatures = set(signatures.values())
+        send("execution_cached", nodes=cached)
+        node_ids = [n for n in node_ids if n not in cached]
+        per_node = self.exec_delay_s / max(len(node_ids), 1)
+        outputs = {}
+        for node_id in node_ids:
+            if self._interrupt.is_set():
+                self._interrupt.clear()
+                send("execution_interrupted", node_id=node_id)
+                with self.lock:
+                    self.history[prompt_id] = {
+                        "prompt": [number, prompt_id, workflow, {}, []],
+                        "outputs": {},
+                        "status": {"status_str": "error", "completed": False, "messages": []},
+                    }
+                return
+            node = workflow[node_id]
+            class_type = node.get("class_type")
+            delay = meta(node_id).get("fake_delay_s", per_node)
+            send("executing", node=node_id)
+            if class_type == "KSampler":
+                for step in (1, 2):
+                    time.sleep(delay / 2)
+                    send("progress", node=node_id, value=step, max=2)
+            else:
+                time.sleep(delay)
+            if class_type == "SaveImageWebsocket" and client:
+                size = meta(node_id).get("fake_output_bytes")
+                for _ in range(self.outputs_per_node):
+                    client.send(struct.pack(">II", 1, 2) + self.payload(size), binary=True)
+            elif class_type in OUTPUT_NODE_KEYS:
+                outputs[node_id] = {OUTPUT_NODE_KEYS[class_type]: self._write_outputs(node)}
+                send("executed", node=node_id, output=outputs[node_id])
+        # Like ComfyUI, history is written before the final "executing" message
+        with self.lock:
+            self.history[prompt_id] = {
+                "prompt": [number, prompt_id, workflow, {}, list(outputs)],
+                "outputs": outputs,
+                "status": {"status_str": "success", "completed": True, "messages": []},
+            }
+        send("execution_success")
+        send("executing", node=None)
+
+    @staticmethod
+    def _node_signatures(workflow):
+        signatures = {}
+
+        def signature(node_id):
+            if node_id not in signatures:
+                signatures[node_id] = None  # breaks cycles
+                node = workflow[node_id]
+                inputs = {
+                    key: signature(str(value[0])) if isinstance(value, list) and len(value) == 2
+                    and str(value[0]) in workflow else value
+                    for key, value in sorted((node.get("inputs") or {}).items())
+                }
+                signatures[node_id] = json.dumps(
+                    [node.get("class_type"), inputs], sort_keys=True, default=str
+                )
+            return signatures[node_id]
+
+        for node_id, node in workflow.items():
+            if isinstance(node, dict):
+                signature(node_id)
+        return signatures
+
+    def _write_outputs(self, node):
+        inputs = node.get("inputs", {})
+        prefix = str(inputs.get("filename_prefix", "ComfyUI"))
+        subfolder, _, base = prefix.rpartition("/")
+        extension = ".mp4" if node.get("class_type") in VIDEO_EXTENSION_NODES else ".png"
+        size = (node.get("_meta") or {}).get("fake_output_bytes")
+        files = []
+        for _ in range(self.outputs_per_node):
+            with self.lock:
+                self._counter += 1
+                filename = f"{base}_{self._counter:05d}_{extension}"
+                self.files[(subfolder, filename)] = self.payload(size)
+            files.append({"filename": filename, "subfolder": subfolder, "type": "output"})
+        return files
+
+
+class _FakeHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping idle keep-alive connections is not an error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _FakeComfyHandler(http.server.BaseHTTPRequestHandler):
+    server_fake = None
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Like ComfyUI's aiohttp server: without this, a response written as headers
+        # + body stalls ~40 ms on delayed ACKs when the client keeps connections alive
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        fake = self.server_fake
+        parsed = urllib.parse.urlparse(self.path)
+        path = parsed.path
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        if path == "/ws":
+            return self._websocket(params.get("clientId") or str(uuid.uuid4()))
+        if path == "/":
+            body = b"<html>fake comfyui</html>"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path.startswith("/history/"):
+            prompt_id = path[len("/history/"):]
+            with fake.lock:
+                entry = fake.history.get(prompt_id)
+            self._json({prompt_id: entry} if entry else {})
+        elif path == "/history":
+            with fake.lock:
+                self._json(dict(fake.history))
+        elif path == "/queue":
+            with fake.lock:
+                running = [list(fake.running)] if fake.running else []
+                pending = [list(entry) for entry in fake.pending]
+            self._json({"queue_running": running, "queue_pending": pending})
+        elif path == "/view":
+            key = (params.get("subfolder", ""), params.get("filename", ""))
+            with fake.lock:
+                data = fake.files.get(key)
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif path.startswith("/object_info"):
+            known = {"CheckpointLoaderSimple": {"input": {"required": {"ckpt_name": [[]]}}},
+                     "SaveImageWebsocket": {"input": {"required": {"images": ["IMAGE"]}}},
+                     "PreviewAny": {"input": {"required": {"source": ["*", {}]}}}}
+            name = path[len("/object_info/"):] if path.startswith("/object_info/") else None
+            self._json({name: known[name]} if name in known else ({} if name else known))
+        elif path == "/system_stats":
+            self._json({"system": {}, "devices": [{"name": "fake", "vram_total": 24 << 30, "vram_free": 24 << 30}]})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        fake = self.server_fake
+        path = urllib.parse.urlparse(self.path).path
+        body = self._body()
+        if path == "/prompt":
+            if fake.prompt_node_errors is not None:
+                self._json(
+                    {
+                        "error": {
+                            "type": "prompt_outputs_failed_validation",
+                            "message": "Prompt outputs failed validation",
+                            "details": "",
+                            "extra_info": {},
+                        },
+                        "node_errors": fake.prompt_node_errors,
+                    },
+                    status=400,
+                )
+                return
+            payload = json.loads(body or b"{}")
+            prompt_id, number = fake.submit(
+                payload.get("prompt", {}), payload.get("client_id"), bool(payload.get("front"))
+            )
+            self._json({"prompt_id": prompt_id, "number": number, "node_errors": {}})
+        elif path == "/upload/image":
+            name = re.search(rb'name="image"; filename="([^"]+)"', body)
+            subfolder = re.search(rb'name="subfolder"\r\n\r\n([^\r]*)', body)
+            with fake.lock:
+                fake.uploaded_bytes += len(body)
+            self._json({
+                "name": name.group(1).decode() if name else "upload.png",
+                "subfolder": subfolder.group(1).decode() if subfolder else "",
+                "type": "input",
+            })
+        elif path == "/history":
+            payload = json.loads(body or b"{}")
+            with fake.lock:
+                for prompt_id in payload.get("delete", []):
+                    fake.history.pop(prompt_id, None)
+                if payload.get("clear"):
+                    fake.history.clear()
+            self._json({})
+        elif path == "/queue":
+            payload = json.loads(body or b"{}")
+            with fake.lock:
+                delete = set(payload.get("delete", []))
+                fake.pending = [
+                    entry for entry in fake.pending
+                    if entry[1] not in delete and not payload.get("clear")
+                ]
+            self._json({})
+        elif path == "/interrupt":
+            payload = json.loads(body or b"{}")
+            with fake.lock:
+                running_id = fake.running[1] if fake.running else None
+                if running_id and payload.get("prompt_id") in (None, running_id):
+                    fake.interrupts.append(running_id)
+                    fake._interrupt.set()
+            self._json({})
+        elif path == "/free":
+            self._json({})
+        else:
+            self.send_error(404)
+
+    def _websocket(self, client_id):
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+
+        client = _WebSocketClient(self.connection)
+        self.server_fake.clients[client_id] = client
+        client.send_json({
+            "type": "status",
+            "data": {
+                "status": {"exec_info": {"queue_remaining": self.server_fake.queue_remaining()}},
+                "sid": client_id,
+            },
+        })
+        client.serve()
+        if self.server_fake.clients.get(client_id) is client:
+            del self.server_fake.clients[client_id]
+        self.close_connection = True
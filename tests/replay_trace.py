@@ -0,0 +1,155 @@
+"""
+Replay a recorded production trace against handler.py and the fake ComfyUI server.
+
+The trace is the JSON-lines file written by the handler when TRACE_RECORD_PATH is set.
+Each envelope becomes a synthetic job with the recorded input sizes, output sizes and
+per-node execution durations (replayed by tests/fake_comfyui.py), submitted at the
+recorded inter-arrival times. --speed scales both arrival gaps and execution time,
+so --speed 10 replays an hour of traffic in six minutes.
+
+Usage:
+    python tests/replay_trace.py trace.jsonl
+    python tests/replay_trace.py trace.jsonl --speed 20 --concurrency 4 --json
+
+Combine with handler environment variables (OUTPUT_MODE, JOB_SUBFOLDERS,
+MODEL_RESIDENCY, ...) to compare settings against the same load shape.
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import handler  # noqa: E402
+from benchmark_handler import BYTE_COUNTERS, peak_rss_mb, percentile  # noqa: E402
+from fake_comfyui import FakeComfyUI  # noqa: E402
+
+
+def load_trace(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def build_replay_job(index, envelope, speed):
+    """Turn one recorded envelope into a job whose fake execution matches the recording."""
+    workflow = {}
+    for i, node in enumerate(envelope.get("node_timeline") or []):
+        duration_s = (node.get("duration_ms") or 0) / 1000 / speed
+        # Recorded output nodes are replaced by the explicit output nodes below
+        workflow[str(i + 1)] = {
+            "class_type": f"Replay{node.get('class_type') or 'Node'}",
+            "inputs": {},
+            "_meta": {"fake_delay_s": duration_s, "fake_cached": bool(node.get("cached"))},
+        }
+    if not workflow:
+        gpu_wait_ms = envelope.get("timings", {}).get("gpu_wait_ms", 0)
+        workflow["1"] = {"class_type": "ReplayNode", "inputs": {},
+                         "_meta": {"fake_delay_s": gpu_wait_ms / 1000 / speed}}
+    for i, output in enumerate(envelope.get("outputs") or []):
+        workflow[str(1000 + i)] = {
+            "class_type": "VHS_VideoCombine" if output.get("video") else "SaveImage",
+            "inputs": {"filename_prefix": "replay"},
+            "_meta": {"fake_delay_s": 0, "fake_output_bytes": output.get("bytes", 0)},
+        }
+    images = [
+        {"name": f"replay_{i}.png",
+         "image": base64.b64encode(os.urandom(size or 1024)).decode("utf-8")}
+        for i, size in enumerate(envelope.get("input_bytes") or [])
+    ]
+    job_input = {"workflow": workflow}
+    if images:
+        job_input["images"] = images
+    return {"id": f"replay-{index}", "input": job_input}
+
+
+def replay(envelopes, speed=1.0, concurrency=1):
+    server = FakeComfyUI(exec_delay_s=0, outputs_per_node=1).start()
+    previous_host = handler.COMFY_HOST
+    handler.COMFY_HOST = server.host
+    try:
+        jobs = [build_replay_job(i, e, speed) for i, e in enumerate(envelopes)]
+        first = envelopes[0].get("recorded_at", 0) if envelopes else 0
+        offsets = [max(0.0, (e.get("recorded_at", first) - first) / speed) for e in envelopes]
+        bytes_before = {c: handler.metrics.value(c) for c in BYTE_COUNTERS}
+        latencies, failures = [], 0
+        lock = threading.Lock()
+        started = time.perf_counter()
+
+        def run(item):
+            nonlocal failures
+            offset, job = item
+            # Honour the recorded arrival time (jobs may start late if all workers are busy)
+            delay = offset - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+            job_started = time.perf_counter()
+            result = handler.handler(job)
+            with lock:
+                latencies.append((time.perf_counter() - job_started) * 1000)
+                failures += "error" in result
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(run, zip(offsets, jobs)))
+        wall_s = time.perf_counter() - started
+
+        count = max(len(jobs), 1)
+        return {
+            "jobs": len(jobs),
+            "speed": speed,
+            "concurrency": concurrency,
+            "failures": failures,
+            "latency_ms": {
+                "p50": round(percentile(latencies, 50) or 0, 1),
+                "p95": round(percentile(latencies, 95) or 0, 1),
+                "p99": round(percentile(latencies, 99) or 0, 1),
+                "max": round(max(latencies, default=0), 1),
+            },
+            "throughput_jobs_s": round(len(jobs) / wall_s, 2) if wall_s else None,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "bytes_per_job": {
+                c.replace("worker_", "").replace("_total", ""):
+                    int((handler.metrics.value(c) - bytes_before[c]) / count)
+                for c in BYTE_COUNTERS
+            },
+        }
+    finally:
+        handler.COMFY_HOST = previous_host
+        server.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("trace", help="JSON-lines trace written via TRACE_RECORD_PATH")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay speed factor (1 = real time, 10 = ten times faster)")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--limit", type=int, default=0, help="Replay only the first N jobs")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+
+    envelopes = load_trace(args.trace)
+    if args.limit:
+        envelopes = envelopes[: args.limit]
+    result = replay(envelopes, speed=args.speed, concurrency=args.concurrency)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        lat = result["latency_ms"]
+        print(
+            f"replayed {result['jobs']} job(s) at {result['speed']}x, conc={result['concurrency']}, "
+            f"fail={result['failures']}: p50={lat['p50']}ms p95={lat['p95']}ms p99={lat['p99']}ms "
+            f"thr={result['throughput_jobs_s']}/s rss={result['peak_rss_mb']}MB"
+        )
+        print(f"bytes/job: {result['bytes_per_job']}")
+    return result
+
+
+if __name__ == "__main__":
+    main()
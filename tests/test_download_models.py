@@ -0,0 +1,174 @@
+import unittest
+import hashlib
+import http.server
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "scripts")))
+import download_models
+
+PAYLOAD = os.urandom(300 * 1024)
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves PAYLOAD at /model.bin with Range support; /norange.bin ignores Range."""
+
+    protocol_version = "HTTP/1.1"
+    requests = []
+    # Close the connection after this many body bytes of the next ranged request
+    cut_next_after = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        cls = type(self)
+        range_header = self.headers.get("Range")
+        cls.requests.append((self.path, range_header))
+        if self.path == "/model.bin" and range_header:
+            start, end = map(int, re.match(r"bytes=(\d+)-(\d+)", range_header).groups())
+            end = min(end, len(PAYLOAD) - 1)
+            body = PAYLOAD[start : end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(PAYLOAD)}")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if cls.cut_next_after is not None and len(body) > 1:
+                cut, cls.cut_next_after = cls.cut_next_after, None
+                self.wfile.write(body[:cut])
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+        elif self.path in ("/model.bin", "/norange.bin"):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(PAYLOAD)))
+            self.end_headers()
+            self.wfile.write(PAYLOAD)
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+
+class TestDownloadModels(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+        cls.base = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        _RangeHandler.requests = []
+        _RangeHandler.cut_next_after = None
+        self.sha = hashlib.sha256(PAYLOAD).hexdigest()
+        self.downloader = download_models.Downloader(
+            self.tmp.name, segments=4, segment_min_bytes=64 * 1024, retries=2,
+            retry_delay_s=0, log=lambda message: None,
+        )
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def entry(self, name="model.bin", **kwargs):
+        return {"url": f"{self.base}/{name}", "path": f"checkpoints/{name}", **kwargs}
+
+    def target(self, name="model.bin"):
+        return os.path.join(self.tmp.name, "checkpoints", name)
+
+    def test_segmented_download_verifies_and_renames(self):
+        result = self.downloader.download(self.entry(size=len(PAYLOAD), sha256=self.sha))
+
+        self.assertEqual(result["status"], "downloaded")
+        with open(self.target(), "rb") as f:
+            self.assertEqual(f.read(), PAYLOAD)
+        self.assertFalse(os.path.exists(self.target() + ".part"))
+        self.assertFalse(os.path.exists(self.target() + ".part.json"))
+        ranged = [r for p, r in _RangeHandler.requests if r and r != "bytes=0-0"]
+        self.assertEqual(len(ranged), 4)
+
+    def test_interrupted_segment_is_retried_from_where_it_stopped(self):
+        _RangeHandler.cut_next_after = 1000
+        result = self.downloader.download(self.entry(sha256=self.sha))
+
+        self.assertEqual(result["status"], "downloaded")
+        with open(self.target(), "rb") as f:
+            self.assertEqual(f.read(), PAYLOAD)
+        # Exactly one retry, starting 1000 bytes into the interrupted segment
+        starts = [int(re.match(r"bytes=(\d+)", r).group(1)) for _, r in _RangeHandler.requests[1:]]
+        self.assertEqual(len(starts), 5)
+        self.assertTrue(any(start % (len(PAYLOAD) // 4) == 1000 for start in starts))
+
+    def test_resumes_from_partial_file_and_state(self):
+        os.makedirs(os.path.dirname(self.target()))
+        half = len(PAYLOAD) // 2
+        with open(self.target() + ".part", "wb") as f:
+            f.write(PAYLOAD[:half] + b"\0" * (len(PAYLOAD) - half))
+        with open(self.target() + ".part.json", "w") as f:
+            json.dump({"url": self.entry()["url"], "size": len(PAYLOAD),
+                       "segments": [[0, len(PAYLOAD) - 1, half]]}, f)
+
+        result = self.downloader.download(self.entry(sha256=self.sha))
+
+        self.assertEqual(result["status"], "downloaded")
+        self.assertEqual(result["bytes"], len(PAYLOAD) - half)
+        self.assertIn(("/model.bin", f"bytes={half}-{len(PAYLOAD) - 1}"), _RangeHandler.requests)
+        with open(self.target(), "rb") as f:
+            self.assertEqual(f.read(), PAYLOAD)
+
+    def test_hash_mismatch_leaves_no_target(self):
+        result = self.downloader.download(self.entry(sha256="0" * 64))
+
+        self.assertEqual(result["status"], "failed")
+        self.assertIn("sha256 mismatch", result["error"])
+        self.assertFalse(os.path.exists(self.target()))
+        self.assertFalse(os.path.exists(self.target() + ".part"))
+
+    def test_server_without_range_and_existing_files(self):
+        results = download_models.download_all(
+            [self.entry("norange.bin", sha256=self.sha), self.entry("norange.bin", sha256=self.sha)],
+            self.downloader,
+            jobs=1,
+        )
+        self.assertEqual([r["status"] for r in results], ["downloaded", "skipped"])
+        with open(self.target("norange.bin"), "rb") as f:
+            self.assertEqual(f.read(), PAYLOAD)
+
+    def test_missing_hash_warns_or_fails_with_require_hash(self):
+        messages = []
+        self.downloader.log = messages.append
+        result = self.downloader.download(self.entry())
+
+        self.assertEqual(result["status"], "downloaded")
+        self.assertTrue(any("not verified" in m for m in messages))
+
+        strict = download_models.Downloader(
+            self.tmp.name, require_hash=True, log=lambda message: None
+        )
+        requests_before = len(_RangeHandler.requests)
+        result = strict.download(self.entry("other.bin"))
+
+        self.assertEqual(result["status"], "failed")
+        self.assertIn("no sha256", result["error"])
+        self.assertEqual(len(_RangeHandler.requests), requests_before)
+        self.assertFalse(os.path.exists(self.target("other.bin")))
+
+    def test_plan_segments_covers_file(self):
+        segments = download_models.plan_segments(1000, 4, 100)
+        self.assertEqual(segments[0][0], 0)
+        self.assertEqual(segments[-1][1], 999)
+        self.assertEqual(sum(end - start + 1 for start, end, _ in segments), 1000)
+        self.assertEqual(download_models.plan_segments(1000, 4, 600), [[0, 999, 0]])
+
+
+if __name__ == "__main__":
+    unittest.main()
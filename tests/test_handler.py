@@ -1,13 +1,26 @@
 import unittest
-from unittest.mock import patch, MagicMock, mock_open, Mock
+import asyncio
+from unittest.mock import patch, MagicMock, mock_open, Mock, AsyncMock
 import sys
 import os
 import json
 import base64
+import io
+import shutil
 
 # Make sure that "src" is known and can be used to import handler.py
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
 from src import handler
+import comfy_client
+import media_transcode
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+sys.path.append(os.path.dirname(__file__))
+from fake_comfyui import FakeComfyUI
 
 # Local folder for test resources
 RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES = "./test_resources/images"
@@ -205,12 +218,9 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIn("simulated_uploaded", result["message"])
         self.assertEqual(result["status"], "success")
 
-    @patch("handler.requests.post")
-    def test_upload_images_successful(self, mock_post):
-        mock_response = unittest.mock.Mock()
-        mock_response.status_code = 200
-        mock_response.text = "Successfully uploaded"
-        mock_post.return_value = mock_response
+    @patch("comfy_client.AsyncComfyClient.upload_image", new_callable=AsyncMock)
+    def test_upload_images_successful(self, mock_upload):
+        mock_upload.return_value = {"name": "test_image.png", "subfolder": "", "type": "input"}
 
         test_image_data = base64.b64encode(b"Test Image Data").decode("utf-8")
 
@@ -221,12 +231,11 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "success")
 
-    @patch("handler.requests.post")
-    def test_upload_images_failed(self, mock_post):
-        mock_response = unittest.mock.Mock()
-        mock_response.status_code = 400
-        mock_response.text = "Error uploading"
-        mock_post.return_value = mock_response
+    @patch("comfy_client.AsyncComfyClient.upload_image", new_callable=AsyncMock)
+    def test_upload_images_failed(self, mock_upload):
+        mock_upload.side_effect = comfy_client.ComfyHTTPError(
+            "POST", "/upload/image", 400, "Error uploading"
+        )
 
         test_image_data = base64.b64encode(b"Test Image Data").decode("utf-8")
 
@@ -236,3 +245,1196 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "error")
+
+    @patch("handler.get_queue")
+    @patch("handler.get_history")
+    def test_reconcile_prompt_status_success_from_history(
+        self, mock_get_history, mock_get_queue
+    ):
+        mock_get_history.return_value = {
+            "123": {"status": {"status_str": "success", "completed": True}, "outputs": {}}
+        }
+
+        result = handler._reconcile_prompt_status("123")
+
+        self.assertEqual(result["status"], "success")
+        self.assertIn("123", result["history"])
+        mock_get_queue.assert_not_called()
+
+    @patch("handler.get_queue")
+    @patch("handler.get_history")
+    def test_reconcile_prompt_status_error_from_history(
+        self, mock_get_history, mock_get_queue
+    ):
+        mock_get_history.return_value = {
+            "123": {
+                "status": {
+                    "status_str": "error",
+                    "completed": False,
+                    "messages": [
+                        [
+                            "execution_error",
+                            {
+                                "node_id": "4",
+                                "node_type": "KSampler",
+                                "exception_message": "boom",
+                            },
+                        ]
+                    ],
+                }
+            }
+        }
+
+        result = handler._reconcile_prompt_status("123")
+
+        self.assertEqual(result["status"], "error")
+        self.assertIn("KSampler", result["error"])
+        self.assertIn("boom", result["error"])
+
+    @patch("handler.get_queue")
+    @patch("handler.get_history")
+    def test_reconcile_prompt_status_running_and_missing(
+        self, mock_get_history, mock_get_queue
+    ):
+        mock_get_history.return_value = {}
+        mock_get_queue.return_value = {
+            "queue_running": [[0, "123", {}, {}, []]],
+            "queue_pending": [],
+        }
+        self.assertEqual(handler._reconcile_prompt_status("123")["status"], "running")
+
+        mock_get_queue.return_value = {"queue_running": [], "queue_pending": []}
+        self.assertEqual(handler._reconcile_prompt_status("123")["status"], "missing")
+
+    def test_validate_input_rejects_unknown_output_mode(self):
+        input_data = {"workflow": {"key": "value"}, "output_mode": "carrier-pigeon"}
+        validated_data, error = handler.validate_input(input_data)
+        self.assertIsNone(validated_data)
+        self.assertIn("output_mode", error)
+
+    def test_prepare_websocket_outputs_swaps_save_image(self):
+        workflow = {
+            "9": {
+                "class_type": "SaveImage",
+                "inputs": {"images": ["8", 0], "filename_prefix": "portraits/face"},
+            },
+            "10": {"class_type": "PreviewImage", "inputs": {"images": ["8", 0]}},
+        }
+
+        capture_nodes = handler.prepare_websocket_outputs(workflow)
+
+        self.assertEqual(capture_nodes, {"9": "face"})
+        self.assertEqual(workflow["9"]["class_type"], "SaveImageWebsocket")
+        self.assertEqual(workflow["9"]["inputs"], {"images": ["8", 0]})
+        self.assertEqual(workflow["10"]["class_type"], "PreviewImage")
+
+    def test_parse_binary_image_frame(self):
+        frame = (1).to_bytes(4, "big") + (2).to_bytes(4, "big") + b"PNGDATA"
+        self.assertEqual(handler.parse_binary_image_frame(frame), (".png", b"PNGDATA"))
+
+        other_event = (3).to_bytes(4, "big") + (2).to_bytes(4, "big") + b"x"
+        self.assertIsNone(handler.parse_binary_image_frame(other_event))
+        self.assertIsNone(handler.parse_binary_image_frame(b"\x00"))
+
+    @patch("handler.delete_history")
+    @patch("handler._maybe_start_sweep")
+    def test_cleanup_job_removes_history_outputs_and_inputs(
+        self, mock_sweep, mock_delete_history
+    ):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            output_dir = os.path.join(tmp, "output")
+            input_dir = os.path.join(tmp, "input")
+            os.makedirs(os.path.join(output_dir, "sub"))
+            os.makedirs(input_dir)
+            open(os.path.join(output_dir, "sub", "out.png"), "wb").close()
+            open(os.path.join(input_dir, "in.png"), "wb").close()
+
+            with patch.dict(
+                os.environ,
+                {"COMFY_OUTPUT_PATH": output_dir, "COMFY_INPUT_PATH": input_dir},
+            ):
+                removed = handler.cleanup_job(
+                    "123",
+                    [("sub", "out.png"), ("", "../escape.png")],
+                    [("", "in.png")],
+                )
+
+            self.assertEqual(removed, {"history": 1, "outputs": 1, "inputs": 1})
+            self.assertFalse(os.path.exists(os.path.join(output_dir, "sub", "out.png")))
+            mock_delete_history.assert_called_once_with("123")
+
+    def test_sweep_comfy_directories_age_size_and_exemptions(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            output_dir = os.path.join(tmp, "output")
+            job_dir = os.path.join(output_dir, "job-1")
+            os.makedirs(os.path.join(job_dir, "cache"))
+            os.makedirs(os.path.join(output_dir, "assets"))
+            now = 1_000_000.0
+
+            def make(path, size, age):
+                with open(path, "wb") as f:
+                    f.write(b"x" * size)
+                os.utime(path, (now - age, now - age))
+
+            make(os.path.join(job_dir, "old.png"), 10, 7200)
+            make(os.path.join(job_dir, "mid.png"), 10, 60)
+            make(os.path.join(job_dir, "new.png"), 10, 10)
+            make(os.path.join(job_dir, "cache", "asset.png"), 10, 7200)
+            # Files outside per-job subfolders (static assets) are never swept
+            make(os.path.join(output_dir, "static.png"), 10, 7200)
+            make(os.path.join(output_dir, "assets", "mask.png"), 10, 7200)
+
+            with patch.dict(
+                os.environ,
+                {
+                    "COMFY_OUTPUT_PATH": output_dir,
+                    "COMFY_INPUT_PATH": os.path.join(tmp, "missing"),
+                },
+            ):
+                stats = handler.sweep_comfy_directories(3600, 10, now=now)
+
+            self.assertEqual(stats["output"], {"files": 2, "bytes": 20})
+            self.assertEqual(sorted(os.listdir(job_dir)), ["cache", "new.png"])
+            self.assertTrue(os.path.exists(os.path.join(job_dir, "cache", "asset.png")))
+            self.assertTrue(os.path.exists(os.path.join(output_dir, "static.png")))
+            self.assertTrue(os.path.exists(os.path.join(output_dir, "assets", "mask.png")))
+
+    def test_scope_workflow_to_subfolder(self):
+        workflow = {
+            "1": {"class_type": "LoadImage", "inputs": {"image": "face.png"}},
+            "2": {"class_type": "LoadImage", "inputs": {"image": "not_uploaded.png"}},
+            "3": {
+                "class_type": "SaveImage",
+                "inputs": {"images": ["1", 0], "filename_prefix": "ComfyUI"},
+            },
+        }
+
+        handler.scope_workflow_to_subfolder(workflow, "job-abc", ["face.png"])
+
+        self.assertEqual(workflow["1"]["inputs"]["image"], "job-abc/face.png")
+        self.assertEqual(workflow["2"]["inputs"]["image"], "not_uploaded.png")
+        self.assertEqual(workflow["3"]["inputs"]["filename_prefix"], "job-abc/ComfyUI")
+        self.assertEqual(handler.job_subfolder_name("sync-1/../x"), "job-sync-1____x")
+
+    @patch("comfy_client.AsyncComfyClient.upload_image", new_callable=AsyncMock)
+    def test_upload_images_into_subfolder(self, mock_upload):
+        test_image_data = base64.b64encode(b"Test Image Data").decode("utf-8")
+        images = [{"name": "test_image.png", "image": test_image_data}]
+
+        responses = handler.upload_images(images, subfolder="job-123")
+
+        self.assertEqual(responses["status"], "success")
+        self.assertEqual(mock_upload.call_args.args, ("test_image.png", b"Test Image Data"))
+        self.assertEqual(mock_upload.call_args.kwargs["subfolder"], "job-123")
+
+    def test_extract_model_references(self):
+        workflow = {
+            "1": {
+                "class_type": "CheckpointLoaderSimple",
+                "inputs": {"ckpt_name": "SDXL\\model.safetensors"},
+            },
+            "2": {
+                "class_type": "LoraLoader",
+                "inputs": {"lora_name": "style.safetensors", "model": ["1", 0]},
+            },
+            "3": {"class_type": "LoadImage", "inputs": {"image": "face.png"}},
+        }
+
+        self.assertEqual(
+            handler.extract_model_references(workflow),
+            ["SDXL/model.safetensors", "style.safetensors"],
+        )
+
+    @patch("handler.free_comfy_memory")
+    def test_residency_manager_evicts_only_when_cold_and_over_budget(self, mock_free):
+        manager = handler.ModelResidencyManager(
+            vram_budget_bytes=100, decay=0.5, cold_score=0.3
+        )
+        manager.size_cache = {"a": 60, "b": 60}
+
+        self.assertEqual(manager.before_job(["a"])["decision"], "keep")
+        manager.after_job(["a"])
+        self.assertEqual(manager.before_job(["a"])["decision"], "hit")
+        manager.after_job(["a"])
+
+        # "a" is still hot, so the overflow is left to ComfyUI
+        self.assertEqual(manager.before_job(["b"])["decision"], "keep")
+        mock_free.assert_not_called()
+        for _ in range(3):
+            manager.after_job(["b"])
+
+        # "a" has decayed below the cold score -> unload everything
+        manager.resident = {"a"}
+        report = manager.before_job(["b"])
+        self.assertEqual(report["decision"], "evict")
+        self.assertEqual(report["evicted_cold"], ["a"])
+        mock_free.assert_called_once_with(unload_models=True, free_memory=True)
+
+    def test_handler_returns_timings_on_error(self):
+        result = handler.handler({"id": "123", "input": None})
+
+        self.assertEqual(result["error"], "Please provide input")
+        self.assertIn("validation_ms", result["timings"])
+        self.assertIn("total_ms", result["timings"])
+
+    def test_record_phase_timings_fills_histograms(self):
+        handler.phase_histograms.clear()
+
+        handler.record_phase_timings({"queue_ms": 7.0, "total_ms": 2000.0})
+        handler.record_phase_timings({"queue_ms": 400.0, "per_output_fetch_ms": {}})
+
+        queue = handler.phase_histograms["queue"].snapshot()
+        self.assertEqual(queue["count"], 2)
+        self.assertEqual(queue["buckets"]["10"], 1)
+        self.assertEqual(queue["buckets"]["500"], 1)
+        self.assertNotIn("per_output_fetch", handler.phase_histograms)
+
+    def test_node_timeline_from_websocket_events(self):
+        workflow = {
+            "1": {"class_type": "CheckpointLoaderSimple", "inputs": {}},
+            "3": {"class_type": "KSampler", "inputs": {}},
+            "9": {"class_type": "SaveImage", "inputs": {}},
+        }
+        timeline = handler.NodeTimeline("p1", workflow)
+
+        for message in [
+            {"type": "execution_start", "data": {"prompt_id": "p1"}},
+            {"type": "execution_cached", "data": {"prompt_id": "p1", "nodes": ["1"]}},
+            {"type": "executing", "data": {"prompt_id": "p1", "node": "3"}},
+            {"type": "progress", "data": {"prompt_id": "p1", "node": "3", "value": 20, "max": 20}},
+            {"type": "executing", "data": {"prompt_id": "other", "node": "5"}},
+            {"type": "executing", "data": {"prompt_id": "p1", "node": "9"}},
+            {"type": "executed", "data": {"prompt_id": "p1", "node": "9", "output": {}}},
+            {"type": "executing", "data": {"prompt_id": "p1", "node": None}},
+        ]:
+            timeline.on_message(message)
+
+        entries = timeline.entries()
+        self.assertEqual([e["node_id"] for e in entries], ["1", "3", "9"])
+        self.assertTrue(entries[0]["cached"])
+        self.assertEqual(entries[1]["class_type"], "KSampler")
+        self.assertEqual(entries[1]["steps"], {"value": 20, "max": 20})
+        self.assertIsNotNone(entries[1]["duration_ms"])
+        self.assertIsNotNone(entries[2]["end_ms"])
+
+        handler.node_class_stats.clear()
+        handler.record_node_timeline(entries)
+        self.assertEqual(handler.node_class_stats["CheckpointLoaderSimple"]["cached"], 1)
+        self.assertEqual(handler.node_class_stats["KSampler"]["runs"], 1)
+
+    def test_metrics_registry_renders_prometheus_text(self):
+        registry = handler.MetricsRegistry()
+        registry.counter("jobs_total", "Jobs")
+        registry.gauge("queue_remaining", "Queue")
+        registry.histogram("phase_ms", "Phases", (10, 100), label="phase")
+
+        registry.inc("jobs_total", status="success")
+        registry.inc("jobs_total", status="success")
+        registry.set("queue_remaining", 3)
+        registry.observe("phase_ms", 5, "queue")
+        registry.observe("phase_ms", 50, "queue")
+
+        text = registry.render()
+        self.assertIn("# TYPE jobs_total counter", text)
+        self.assertIn('jobs_total{status="success"} 2', text)
+        self.assertIn("queue_remaining 3", text)
+        self.assertIn('phase_ms_bucket{phase="queue",le="10"} 1', text)
+        self.assertIn('phase_ms_bucket{phase="queue",le="+Inf"} 2', text)
+        self.assertIn('phase_ms_count{phase="queue"} 2', text)
+
+    def test_handler_end_to_end_against_fake_comfyui(self):
+        server = FakeComfyUI(exec_delay_s=0.01, outputs_per_node=2, output_bytes=64).start()
+        try:
+            with patch.object(handler, "COMFY_HOST", server.host):
+                result = handler.handler(
+                    {
+                        "id": "e2e",
+                        "input": {
+                            "workflow": {
+                                "3": {"class_type": "KSampler", "inputs": {}},
+                                "9": {
+                                    "class_type": "SaveImage",
+                                    "inputs": {"images": ["3", 0], "filename_prefix": "ComfyUI"},
+                                },
+                            }
+                        },
+                    }
+                )
+        finally:
+            server.stop()
+
+        self.assertNotIn("error", result)
+        self.assertEqual(len(result["images"]), 2)
+        self.assertEqual(result["images"][0]["type"], "base64")
+        self.assertIn("gpu_wait_ms", result["timings"])
+        # Post-job cleanup removed the prompt from the fake's history
+        self.assertEqual(server.history, {})
+
+    def test_multi_workflow_job_shares_inputs_and_queues_back_to_back(self):
+        server = FakeComfyUI(exec_delay_s=0.2, output_bytes=64).start()
+        queue_depths = []
+        submit = server.submit
+
+        def recording_submit(*args, **kwargs):
+            queue_depths.append(server.queue_remaining())
+            return submit(*args, **kwargs)
+
+        server.submit = recording_submit
+        workflows = [
+            {
+                "1": {"class_type": "LoadImage", "inputs": {"image": "face.png"}},
+                "3": {"class_type": "KSampler", "inputs": {"style": style}},
+                "9": {
+                    "class_type": "SaveImage",
+                    "inputs": {"images": ["3", 0], "filename_prefix": style},
+                },
+            }
+            for style in ("ink", "oil", "pixel")
+        ]
+        job = {
+            "id": "multi",
+            "input": {
+                "workflows": workflows,
+                "images": [{"name": "face.png", "image": base64.b64encode(b"face").decode()}],
+            },
+        }
+        try:
+            with patch.object(handler, "COMFY_HOST", server.host), patch.object(
+                handler, "upload_images_async", wraps=handler.upload_images_async
+            ) as upload:
+                result = handler.handler(job)
+        finally:
+            server.stop()
+
+        self.assertNotIn("error", result)
+        self.assertEqual(
+            [[image["filename"].split("_")[0] for image in item["images"]] for item in result["workflows"]],
+            [["ink"], ["oil"], ["pixel"]],
+        )
+        upload.assert_called_once()
+        # Every prompt was queued while the first one was still running
+        self.assertEqual(queue_depths, [0, 1, 2])
+        self.assertEqual(server.history, {})
+
+        self.assertIn("not both", handler.validate_input({"workflow": {}, "workflows": [{}]})[1])
+        self.assertIn("non-empty list", handler.validate_input({"workflows": []})[1])
+
+    def test_sweep_runs_variants_upstream_first_and_reports_cached_nodes(self):
+        server = FakeComfyUI(exec_delay_s=0.02, output_bytes=64, cache=True).start()
+        workflow = {
+            "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sdxl.safetensors"}},
+            "2": {"class_type": "LoraLoader", "inputs": {"model": ["1", 0], "strength_model": 1.0}},
+            "3": {"class_type": "KSampler", "inputs": {"model": ["2", 0], "seed": 0}},
+            "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}},
+        }
+        job = {
+            "id": "sweep",
+            "input": {
+                "workflow": workflow,
+                "sweep": {"3.seed": {"start": 1, "count": 2}, "2.strength_model": [0.5, 1.0]},
+            },
+        }
+        try:
+            with patch.object(handler, "COMFY_HOST", server.host):
+                result = handler.handler(job)
+        finally:
+            server.stop()
+
+        self.assertNotIn("error", result)
+        # The LoRA strength (upstream) varies slowest, the seed fastest
+        self.assertEqual(
+            [item["parameters"] for item in result["workflows"]],
+            [
+                {"3.seed": 1, "2.strength_model": 0.5},
+                {"3.seed": 2, "2.strength_model": 0.5},
+                {"3.seed": 1, "2.strength_model": 1.0},
+                {"3.seed": 2, "2.strength_model": 1.0},
+            ],
+        )
+        self.assertEqual(
+            [item["cached_nodes"] for item in result["workflows"]],
+            [[], ["1", "2"], ["1"], ["1", "2"]],
+        )
+        self.assertEqual(result["sweep"], {"variants": 4, "executed_nodes": 11, "cached_nodes": 5})
+        self.assertTrue(all(len(item["images"]) == 1 for item in result["workflows"]))
+
+        zipped, error = handler.expand_sweep(workflow, {"3.seed": [1, 2], "2.strength_model": [0.5, 1.0]}, "zip")
+        self.assertIsNone(error)
+        self.assertEqual([parameters for parameters, _ in zipped],
+                         [{"3.seed": 1, "2.strength_model": 0.5}, {"3.seed": 2, "2.strength_model": 1.0}])
+        self.assertEqual(workflow["3"]["inputs"]["seed"], 0)
+        self.assertIn("does not name an input", handler.validate_input(
+            {"workflow": workflow, "sweep": {"3.sead": [1]}})[1])
+        self.assertIn("at most", handler.validate_input(
+            {"workflow": workflow, "sweep": {"3.seed": {"count": 1000}}})[1])
+
+    def test_oversized_sweep_is_rejected_before_expanding(self):
+        import tracemalloc
+
+        workflow = {"3": {"class_type": "KSampler", "inputs": {"seed": 0}}}
+        tracemalloc.start()
+        try:
+            _, error = handler.validate_input(
+                {"workflow": workflow, "sweep": {"3.seed": {"start": 1, "count": 20_000_000}}}
+            )
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertIn("20000000 values; at most", error)
+        self.assertLess(peak, 1024 * 1024)
+
+        _, error = handler.expand_sweep(
+            workflow, {"3.seed": list(range(handler.MAX_JOB_WORKFLOWS + 1))}, "zip"
+        )
+        self.assertIn("at most", error)
+
+    def test_model_transition_history_predicts_most_frequent_successor(self):
+        history = handler.ModelTransitionHistory(max_sets=2)
+        for models in (["a"], ["b"], ["a"], ["c"], ["a"], ["b"], []):
+            history.record(models)
+        # "b" followed "a" twice, "c" once; "b" itself was the least recently updated set
+        self.assertEqual(list(history.transitions), [("c",), ("a",)])
+        self.assertIsNone(history.predict())
+        history.last = ("a",)
+        self.assertEqual(history.predict(), ("b",))
+
+    def test_idle_preload_warms_predicted_models_and_yields_to_jobs(self):
+        server = FakeComfyUI(exec_delay_s=0.01, output_bytes=64).start()
+        submitted = []
+        submit = server.submit
+
+        def recording_submit(workflow, *args, **kwargs):
+            prompt_id, number = submit(workflow, *args, **kwargs)
+            submitted.append((prompt_id, workflow))
+            return prompt_id, number
+
+        server.submit = recording_submit
+        preloader = handler.ModelPreloader(idle_s=0.01, use_prompt=True)
+
+        def job(ckpt):
+            return {
+                "id": f"job-{ckpt}",
+                "input": {"workflow": {
+                    "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": ckpt}},
+                    "3": {"class_type": "KSampler", "inputs": {"model": ["1", 0]}},
+                    "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}},
+                }},
+            }
+
+        def is_preload(workflow):
+            return any(node["class_type"] == "PreviewAny" for node in workflow.values())
+
+        async def scenario():
+            for ckpt in ("a.safetensors", "b.safetensors", "a.safetensors"):
+                self.assertNotIn("error", await handler.async_handler(job(ckpt)))
+            # Idle after "a": "b" is expected next, read into the page cache and loaded
+            await preloader.tasks[server.host][0]
+            self.assertEqual(preloader.preloaded, {"b.safetensors"})
+            preload_id, preload_workflow = submitted[-1]
+            self.assertTrue(is_preload(preload_workflow))
+            self.assertEqual(
+                [node["inputs"] for node in preload_workflow.values() if not is_preload({"n": node})],
+                [{"ckpt_name": "b.safetensors"}],
+            )
+
+            # A job arriving while a preload prompt runs interrupts it first
+            self.assertNotIn("error", await handler.async_handler(job("b.safetensors")))
+            server.exec_delay_s = 1.0
+            while not (server.running and is_preload(server.running[2])):
+                await asyncio.sleep(0.01)
+            server.exec_delay_s = 0.01
+            preload_id = server.running[1]
+            self.assertNotIn("error", await handler.async_handler(job("a.safetensors")))
+            self.assertIn(preload_id, server.interrupts)
+            await preloader.cancel()
+            await comfy_client.close_clients()
+
+        with handler.tempfile.TemporaryDirectory() as models_root:
+            os.makedirs(os.path.join(models_root, "checkpoints"))
+            for name in ("a.safetensors", "b.safetensors"):
+                with open(os.path.join(models_root, "checkpoints", name), "wb") as f:
+                    f.write(os.urandom(64 * 1024))
+            try:
+                with patch.object(handler, "COMFY_HOST", server.host), patch.object(
+                    handler, "MODEL_PRELOAD", True
+                ), patch.object(handler, "model_preloader", preloader), patch.object(
+                    handler, "_preview_any_node_available", None
+                ), patch.dict(os.environ, {"COMFY_MODELS_PATH": models_root}):
+                    asyncio.run(scenario())
+            finally:
+                server.stop()
+
+    def test_rejected_preload_prompt_is_logged_not_raised(self):
+        server = FakeComfyUI().start()
+        server.prompt_node_errors = {
+            "preload_0": {
+                "errors": [{"message": "Value not in list", "details": "ckpt_name: 'b.safetensors'"}],
+                "class_type": "CheckpointLoaderSimple",
+            }
+        }
+        preloader = handler.ModelPreloader(idle_s=0, use_prompt=True)
+        backend = handler.ComfyBackend(server.host)
+
+        def workflow(ckpt):
+            return {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": ckpt}}}
+
+        for ckpt in ("a.safetensors", "b.safetensors", "a.safetensors"):
+            preloader.record([ckpt], [workflow(ckpt)])
+
+        async def scenario():
+            preloader.schedule(backend)
+            task = preloader.tasks[server.host][0]
+            await asyncio.wait([task])
+            await comfy_client.close_clients()
+            return task
+
+        try:
+            with patch.object(handler, "COMFY_HOST", server.host), patch.object(
+                handler, "_preview_any_node_available", None
+            ), self.assertLogs("worker-comfyui", level="WARNING") as logs:
+                task = asyncio.run(scenario())
+        finally:
+            server.stop()
+
+        self.assertIsNone(task.exception())
+        self.assertTrue(any("Preload prompt failed" in line for line in logs.output))
+        self.assertEqual(backend.residency.resident, set())
+
+    def test_lost_or_slow_preload_prompt_ends_without_marking_models(self):
+        def workflow(ckpt):
+            return {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": ckpt}}}
+
+        def run_preload(server, prompt_timeout_s):
+            preloader = handler.ModelPreloader(idle_s=0, use_prompt=True, prompt_timeout_s=prompt_timeout_s)
+            backend = handler.ComfyBackend(server.host)
+            for ckpt in ("a.safetensors", "b.safetensors", "a.safetensors"):
+                preloader.record([ckpt], [workflow(ckpt)])
+
+            async def scenario():
+                preloader.schedule(backend)
+                task = preloader.tasks[server.host][0]
+                await asyncio.wait_for(asyncio.shield(task), 5)
+                await comfy_client.close_clients()
+
+            with patch.object(handler, "COMFY_HOST", server.host), patch.object(
+                handler, "_preview_any_node_available", None
+            ), self.assertLogs("worker-comfyui", level="WARNING") as logs:
+                asyncio.run(scenario())
+            self.assertEqual(backend.residency.resident, set())
+            return "\n".join(logs.output)
+
+        # The prompt is accepted but vanishes from the queue (e.g. ComfyUI restarted)
+        lost = FakeComfyUI().start()
+        lost.submit = lambda workflow, client_id, front=False: ("lost-prompt", 1)
+        try:
+            self.assertIn("did not finish (missing)", run_preload(lost, prompt_timeout_s=60))
+        finally:
+            lost.stop()
+
+        slow = FakeComfyUI(exec_delay_s=3).start()
+        try:
+            self.assertIn("did not finish (timed out)", run_preload(slow, prompt_timeout_s=0.2))
+        finally:
+            slow.stop()
+
+    def test_cancelled_job_interrupts_its_prompt(self):
+        server = FakeComfyUI(exec_delay_s=5).start()
+        job = {
+            "id": "cancel-me",
+            "input": {"workflow": {"3": {"class_type": "KSampler", "inputs": {}}}},
+        }
+
+        async def run_and_cancel():
+            task = asyncio.create_task(handler.async_handler(job))
+            while server.running is None:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await comfy_client.close_clients()
+
+        try:
+            with patch.object(handler, "COMFY_HOST", server.host):
+                asyncio.run(run_and_cancel())
+            self.assertEqual(len(server.interrupts), 1)
+        finally:
+            server.stop()
+
+    def test_backend_pool_prefers_idle_and_model_affine_backends(self):
+        pool = handler.BackendPool(affinity_weight=1.0, retry_s=30)
+        hosts = ["a:8188", "b:8188", "c:8188"]
+        pool._backend("b:8188").residency.resident = {"sdxl.safetensors"}
+
+        # b has the model loaded and wins while it is at most one job busier
+        first = pool.acquire(hosts, ["sdxl.safetensors"])
+        self.assertEqual(first.host, "b:8188")
+        second = pool.acquire(hosts, ["sdxl.safetensors"])
+        self.assertEqual(second.host, "a:8188")
+        self.assertEqual(pool.acquire(hosts, []).host, "c:8188")
+
+        # Unreachable backends are skipped until every candidate is unreachable
+        pool.release(first)
+        pool.mark_unhealthy(first)
+        self.assertEqual(pool.acquire(hosts, ["sdxl.safetensors"], exclude={"c:8188"}).host, "a:8188")
+        self.assertEqual(pool.acquire(["b:8188"], []).host, "b:8188")
+        self.assertIsNone(pool.acquire(hosts, [], exclude=set(hosts)))
+
+    def test_job_runs_on_the_backend_it_was_routed_to(self):
+        busy = FakeComfyUI().start()
+        affine = FakeComfyUI(exec_delay_s=0.01).start()
+        pool = handler.BackendPool()
+        for host in ("127.0.0.1:1", affine.host):
+            pool._backend(host).residency.resident = {"sdxl.safetensors"}
+        job = {
+            "id": "routed",
+            "input": {
+                "workflow": {
+                    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sdxl.safetensors"}},
+                    "9": {"class_type": "SaveImage", "inputs": {"images": ["4", 0]}},
+                }
+            },
+        }
+        try:
+            # The first host ties with the affine one but is unreachable, so the job fails over
+            hosts = ["127.0.0.1:1", busy.host, affine.host]
+            with patch.object(handler, "COMFY_HOSTS", hosts), patch.object(handler, "backend_pool", pool):
+                result = handler.handler(job)
+        finally:
+            busy.stop()
+            affine.stop()
+
+        self.assertNotIn("error", result)
+        self.assertEqual(len(result["images"]), 1)
+        # Queueing, the websocket, /view and cleanup all went to the chosen backend
+        self.assertEqual(busy._counter, 0)
+        self.assertEqual(affine.history, {})
+        self.assertFalse(pool.backends["127.0.0.1:1"].healthy)
+        self.assertEqual(pool.backends[affine.host].in_flight, 0)
+        self.assertEqual(pool.backends[affine.host].jobs_total, 1)
+
+    def test_duplicate_unreachable_backend_reports_not_reachable(self):
+        pool = handler.BackendPool()
+        job = {"id": "down", "input": {"workflow": {"3": {"class_type": "KSampler", "inputs": {}}}}}
+        with patch.object(handler, "COMFY_HOSTS", ["127.0.0.1:1", "127.0.0.1:1"]), patch.object(
+            handler, "backend_pool", pool
+        ), patch.object(handler, "COMFY_API_AVAILABLE_MAX_RETRIES", 1):
+            result = handler.handler(job)
+
+        self.assertIn("not reachable", result["error"])
+        self.assertEqual(pool.backends["127.0.0.1:1"].jobs_total, 1)
+        self.assertEqual(pool.backends["127.0.0.1:1"].in_flight, 0)
+
+    def test_concurrent_jobs_are_spread_over_backends(self):
+        servers = [FakeComfyUI(exec_delay_s=0.2).start() for _ in range(2)]
+        hosts = [server.host for server in servers]
+        pool = handler.BackendPool()
+        submitted = {host: [] for host in hosts}
+        for server in servers:
+            def submit(workflow, client_id, front=False, _server=server, _submit=server.submit):
+                submitted[_server.host].append(client_id)
+                return _submit(workflow, client_id, front)
+            server.submit = submit
+
+        def job(name):
+            return {
+                "id": name,
+                "input": {"workflow": {
+                    "3": {"class_type": "KSampler", "inputs": {}},
+                    "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}},
+                }},
+            }
+
+        async def scenario():
+            results = await asyncio.gather(
+                handler.async_handler(job("first")), handler.async_handler(job("second"))
+            )
+            await comfy_client.close_clients()
+            return results
+
+        try:
+            with patch.object(handler, "COMFY_HOSTS", hosts), patch.object(
+                handler, "backend_pool", pool
+            ), patch.object(handler, "WORKER_CONCURRENCY", len(hosts)):
+                # RunPod asks the modifier how many jobs to hand this worker at once
+                self.assertEqual(handler.concurrency_modifier(1), 2)
+                results = asyncio.run(scenario())
+        finally:
+            for server in servers:
+                server.stop()
+
+        for result in results:
+            self.assertNotIn("error", result)
+        # The jobs ran side by side, one per backend
+        self.assertEqual([len(submitted[host]) for host in hosts], [1, 1])
+        self.assertEqual([pool.backends[host].jobs_total for host in hosts], [1, 1])
+
+    def test_priority_lanes_hold_low_jobs_and_prevent_starvation(self):
+        lanes = handler.PriorityLanes(low_queue_depth=1, max_hold_s=0.3, poll_interval_s=0.01)
+
+        async def scenario():
+            busy, front = await lanes.admit("h", "normal")
+            self.assertFalse(front)
+            held = asyncio.create_task(lanes.admit("h", "low"))
+            await asyncio.sleep(0.05)
+            self.assertFalse(held.done())
+            lanes.finish(busy)
+            waiting, _ = await asyncio.wait_for(held, 1)
+
+            high, front = await lanes.admit("h", "high")
+            self.assertTrue(front)
+            lanes.finish(high)
+            # The low prompt has not started for longer than max_hold_s
+            await asyncio.sleep(0.35)
+            high, front = await lanes.admit("h", "high")
+            self.assertFalse(front)
+            lanes.finish(high)
+
+            # A held low job is admitted once max_hold_s has passed
+            started = asyncio.get_running_loop().time()
+            await lanes.admit("h", "low")
+            self.assertGreaterEqual(asyncio.get_running_loop().time() - started, 0.3)
+            self.assertEqual(lanes.depth("h"), 2)
+
+        asyncio.run(scenario())
+
+    def test_high_priority_job_overtakes_queued_jobs(self):
+        server = FakeComfyUI(exec_delay_s=0.3).start()
+        finished = []
+
+        async def run(name, priority, delay_s):
+            await asyncio.sleep(delay_s)
+            job = {
+                "id": name,
+                "input": {
+                    "workflow": {
+                        "3": {"class_type": "KSampler", "inputs": {}},
+                        "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}},
+                    },
+                    "priority": priority,
+                },
+            }
+            result = await handler.async_handler(job)
+            self.assertNotIn("error", result)
+            finished.append(name)
+
+        async def scenario():
+            await asyncio.gather(
+                run("render-1", "normal", 0),
+                run("render-2", "normal", 0.05),
+                run("preview", "high", 0.15),
+            )
+            await comfy_client.close_clients()
+
+        try:
+            with patch.object(handler, "COMFY_HOST", server.host):
+                asyncio.run(scenario())
+        finally:
+            server.stop()
+
+        self.assertEqual(finished, ["render-1", "preview", "render-2"])
+        self.assertIn("'priority' must be one of", handler.validate_input(
+            {"workflow": {}, "priority": "urgent"})[1])
+
+    def test_priority_lanes_follow_comfyui_queue_of_other_clients(self):
+        server = FakeComfyUI(exec_delay_s=0.3).start()
+        lanes = handler.PriorityLanes(low_queue_depth=2, max_hold_s=10, poll_interval_s=0.02)
+        submitted = []
+        executed = []
+        original_submit, original_execute = server.submit, server._execute
+
+        def name(workflow):
+            return workflow["3"]["_meta"]["title"]
+
+        def submit(workflow, client_id, front=False):
+            # (job, front, prompts queued or running at submission)
+            submitted.append((name(workflow), front, server.queue_remaining()))
+            return original_submit(workflow, client_id, front)
+
+        def execute(number, prompt_id, workflow, client_id):
+            executed.append(name(workflow))
+            return original_execute(number, prompt_id, workflow, client_id)
+
+        server.submit, server._execute = submit, execute
+
+        def workflow(title):
+            return {
+                "3": {"class_type": "KSampler", "inputs": {}, "_meta": {"title": title}},
+                "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}},
+            }
+
+        async def run(title, priority, delay_s):
+            await asyncio.sleep(delay_s)
+            job = {"id": title, "input": {"workflow": workflow(title), "priority": priority}}
+            self.assertNotIn("error", await handler.async_handler(job))
+
+        async def scenario():
+            # Another client already has one prompt running and one pending
+            for title in ("other-1", "other-2"):
+                server.submit(workflow(title), title)
+            await asyncio.gather(run("bulk", "low", 0.05), run("preview", "high", 0.1))
+            await comfy_client.close_clients()
+
+        try:
+            with patch.object(handler, "COMFY_HOST", server.host), patch.object(
+                handler, "priority_lanes", lanes
+            ):
+                asyncio.run(scenario())
+        finally:
+            server.stop()
+
+        # The high job jumped ahead of the other client's pending prompt, while the
+        # low job was held until ComfyUI's queue dropped below the limit
+        self.assertEqual(
+            submitted,
+            [("other-1", False, 0), ("other-2", False, 1), ("preview", True, 2), ("bulk", False, 1)],
+        )
+        self.assertEqual(executed, ["other-1", "preview", "other-2", "bulk"])
+
+    @unittest.skipIf(Image is None, "Pillow not installed")
+    def test_transcode_output_image_formats(self):
+        source = io.BytesIO()
+        Image.new("RGBA", (64, 48), (200, 30, 30, 128)).save(source, "PNG")
+        png = source.getvalue()
+
+        name, webp = media_transcode.transcode_output("ComfyUI_00001_.png", png, {"image_format": "webp", "lossless": True})
+        self.assertEqual(name, "ComfyUI_00001_.webp")
+        self.assertEqual(webp[8:12], b"WEBP")
+        self.assertEqual(Image.open(io.BytesIO(webp)).convert("RGBA").tobytes(), Image.open(io.BytesIO(png)).tobytes())
+
+        # JPEG has no alpha: the image is flattened
+        name, jpeg = media_transcode.transcode_output("out.png", png, {"image_format": "jpeg", "quality": 80})
+        self.assertEqual(name, "out.jpg")
+        self.assertEqual(Image.open(io.BytesIO(jpeg)).mode, "RGB")
+
+        if features.check("avif"):
+            name, avif = media_transcode.transcode_output("out.png", png, {"image_format": "avif"})
+            self.assertEqual((name, avif[4:12]), ("out.avif", b"ftypavif"))
+
+        # Nothing to do: same format, or a video without video_format
+        self.assertFalse(media_transcode.needs_transcode("out.png", {"image_format": "png"}))
+        self.assertFalse(media_transcode.needs_transcode("clip.mp4", {"image_format": "webp"}))
+        self.assertTrue(media_transcode.needs_transcode("clip.mp4", {"video_format": "webm"}))
+        with self.assertRaises(media_transcode.TranscodeError):
+            media_transcode.transcode_output("broken.png", b"not a png", {"image_format": "webp"})
+
+    @unittest.skipIf(shutil.which("ffmpeg") is None, "ffmpeg not installed")
+    def test_transcode_output_video_remux_and_reencode(self):
+        with media_transcode.tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "clip.mp4")
+            media_transcode.subprocess.run(
+                ["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", "testsrc=size=64x64:rate=8",
+                 "-t", "1", "-c:v", "libx264", "-pix_fmt", "yuv420p", path],
+                check=True,
+            )
+            with open(path, "rb") as f:
+                mp4 = f.read()
+
+        name, mkv = media_transcode.transcode_output("clip.mp4", mp4, {"video_format": "mkv"})
+        self.assertEqual(name, "clip.mkv")
+        self.assertEqual(mkv[:4], b"\x1a\x45\xdf\xa3")
+        name, webm = media_transcode.transcode_output(
+            "clip.mp4", mp4, {"video_format": "webm", "video_reencode": True, "quality": 50}
+        )
+        self.assertEqual(name, "clip.webm")
+        self.assertEqual(handler.get_video_mime_type(name), "video/webm")
+
+    @unittest.skipIf(Image is None, "Pillow not installed")
+    def test_job_outputs_are_transcoded_before_delivery(self):
+        source = io.BytesIO()
+        Image.new("RGB", (256, 256), (10, 120, 200)).save(source, "PNG")
+        png = source.getvalue()
+        server = FakeComfyUI(outputs_per_node=2, output_bytes=len(png)).start()
+        server._payload = png
+        job = {
+            "id": "transcode",
+            "input": {
+                "workflow": {
+                    "3": {"class_type": "KSampler", "inputs": {}},
+                    "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}},
+                },
+                "output_format": "jpeg",
+                "output_quality": 70,
+            },
+        }
+        try:
+            with patch.object(handler, "COMFY_HOST", server.host):
+                result = handler.handler(job)
+                server._payload = b"not a png" * 100
+                fallback = handler.handler({**job, "id": "broken"})
+        finally:
+            server.stop()
+
+        self.assertNotIn("errors", result)
+        self.assertEqual([image["filename"][-4:] for image in result["images"]], [".jpg", ".jpg"])
+        self.assertEqual(base64.b64decode(result["images"][0]["data"])[:3], b"\xff\xd8\xff")
+        self.assertIn("transcode_ms", result["timings"])
+        # A failed transcode returns the original file and reports why
+        self.assertTrue(fallback["images"][0]["filename"].endswith(".png"))
+        self.assertIn("Could not transcode", fallback["errors"][0])
+        self.assertIn("'output_format' must be one of", handler.validate_input(
+            {"workflow": {}, "output_format": "gif"})[1])
+
+    @unittest.skipIf(Image is None, "Pillow not installed")
+    def test_thumbnails_are_returned_inline_next_to_s3_outputs(self):
+        source = io.BytesIO()
+        Image.new("RGB", (640, 320), (10, 120, 200)).save(source, "PNG")
+        png = source.getvalue()
+        server = FakeComfyUI(output_bytes=len(png)).start()
+        server._payload = png
+        job = {
+            "id": "thumbs",
+            "input": {
+                "workflow": {
+                    "3": {"class_type": "KSampler", "inputs": {}},
+                    "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}},
+                },
+                "thumbnails": True,
+                "thumbnail_size": 64,
+            },
+        }
+        try:
+            with patch.object(handler, "COMFY_HOST", server.host), patch.dict(
+                os.environ, {"BUCKET_ENDPOINT_URL": "http://bucket.example"}
+            ), patch.object(
+                handler, "_upload_output_to_s3", return_value="http://bucket.example/thumbs/a.png"
+            ):
+                result = handler.handler(job)
+        finally:
+            server.stop()
+
+        self.assertNotIn("errors", result)
+        image = result["images"][0]
+        self.assertEqual(image["type"], "s3_url")
+        self.assertTrue(image["thumbnail"]["filename"].endswith("_thumbnail.webp"))
+        prefix, _, data = image["thumbnail"]["data"].partition(",")
+        self.assertEqual(prefix, "data:image/webp;base64")
+        self.assertEqual(Image.open(io.BytesIO(base64.b64decode(data))).size, (64, 32))
+        self.assertIn("derivatives_ms", result["timings"])
+
+    @unittest.skipIf(shutil.which("ffmpeg") is None, "ffmpeg not installed")
+    def test_video_poster_and_preview(self):
+        with media_transcode.tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "clip.mp4")
+            media_transcode.subprocess.run(
+                ["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", "testsrc=size=320x240:rate=8",
+                 "-t", "4", "-c:v", "libx264", "-pix_fmt", "yuv420p", path],
+                check=True,
+            )
+            with open(path, "rb") as f:
+                mp4 = f.read()
+
+        derivatives, errors = media_transcode.make_derivatives(
+            "clip.mp4", mp4, {"size": 64, "image_format": "jpeg", "preview_seconds": 1}
+        )
+        self.assertEqual(errors, [])
+        self.assertEqual(derivatives["poster"][:2], ("clip_poster.jpg", "image/jpeg"))
+        self.assertEqual(derivatives["preview"][:2], ("clip_preview.mp4", "video/mp4"))
+        self.assertLess(len(derivatives["preview"][2]), len(mp4))
+
+    def test_compressed_result_encoding(self):
+        mask = b"\x00" * 50000 + b"\xff" * 50000
+        data, encoding = handler.compress_result_bytes("mask.png", mask, "gzip")
+        self.assertEqual((encoding, handler.gzip.decompress(data)), ("gzip", mask))
+        # Already compressed formats and incompressible data are left alone
+        self.assertEqual(handler.compress_result_bytes("clip.mp4", mask, "gzip"), (mask, "identity"))
+        noise = os.urandom(4096)
+        self.assertEqual(handler.compress_result_bytes("noise.png", noise, "gzip"), (noise, "identity"))
+
+        output_data, errors = [], []
+        handler._deliver_output("job", "mask.png", mask, output_data, errors, result_encoding="zstd")
+        entry = output_data[0]
+        self.assertEqual(entry["encoding"], "zstd")
+        self.assertEqual(entry["original_size"], len(mask))
+        self.assertGreater(entry["compression_ratio"], 100)
+        self.assertEqual(handler._zstd_module().decompress(base64.b64decode(entry["data"])), mask)
+
+        handler._deliver_output("job", "clip.mp4", mask, output_data, errors, result_encoding="zstd")
+        self.assertEqual(output_data[1]["encoding"], "identity")
+        self.assertEqual(output_data[1]["compression_ratio"], 1.0)
+        self.assertTrue(output_data[1]["data"].startswith("data:video/mp4;base64,"))
+        self.assertEqual(errors, [])
+        self.assertIn("'result_encoding' must be one of", handler.validate_input(
+            {"workflow": {}, "result_encoding": "brotli"})[1])
+
+    def test_content_addressed_uploads_reuse_existing_objects(self):
+        class NotFound(Exception):
+            response = {"Error": {"Code": "404"}}
+
+        client = MagicMock()
+        client.head_object.side_effect = NotFound()
+        client.generate_presigned_url.side_effect = (
+            lambda op, Params, ExpiresIn: f"http://bucket.example/{Params['Key']}?X-Amz-Signature=s"
+        )
+        data = b"same pixels"
+        digest = handler.hashlib.sha256(data).hexdigest()
+
+        with handler.tempfile.TemporaryDirectory() as tmp:
+            index_path = os.path.join(tmp, "index.jsonl")
+            store = handler.ContentAddressedStore(bucket="outputs", index_path=index_path, ttl_s=60)
+            store._client = client
+            output_data, errors = [], []
+            with patch.object(handler, "content_store", store), patch.object(
+                handler, "S3_CONTENT_ADDRESSED", True
+            ), patch.dict(os.environ, {"BUCKET_ENDPOINT_URL": "http://bucket.example"}):
+                handler._deliver_output("job-1", "ComfyUI_00001_.png", data, output_data, errors)
+                handler._deliver_output("job-2", "ComfyUI_00007_.png", data, output_data, errors)
+
+            self.assertEqual(errors, [])
+            self.assertEqual(
+                [(entry["data"], entry["deduplicated"]) for entry in output_data],
+                [(f"http://bucket.example/cas/{digest}.png", False),
+                 (f"http://bucket.example/cas/{digest}.png", True)],
+            )
+            # The second job is answered from the index: no HEAD, no second upload
+            client.head_object.assert_called_once_with(Bucket="outputs", Key=f"cas/{digest}.png")
+            client.put_object.assert_called_once_with(
+                Bucket="outputs", Key=f"cas/{digest}.png", Body=data, ContentType="image/png"
+            )
+
+            # A restarted worker reads the persisted index
+            restarted = handler.ContentAddressedStore(bucket="outputs", index_path=index_path, ttl_s=60)
+            restarted._client = client
+            self.assertEqual(restarted.upload("x.png", data)[1], True)
+            self.assertEqual(client.head_object.call_count, 1)
+
+            # Content-Type follows the real MIME type of the extension
+            store.upload("preview.jpg", b"jpeg bytes")
+            self.assertEqual(client.put_object.call_args.kwargs["ContentType"], "image/jpeg")
+
+        # Past the TTL the object is checked with HEAD again, and found
+        client.reset_mock()
+        client.head_object.side_effect = None
+        stale = handler.ContentAddressedStore(bucket="outputs", ttl_s=0)
+        stale._client = client
+        self.assertTrue(stale.upload("x.png", data)[1])
+        client.head_object.assert_called_once()
+        client.put_object.assert_not_called()
+
+    def test_sync_facade_and_streamed_view(self):
+        server = FakeComfyUI().start()
+        server.files[("job-1", "out.png")] = b"x" * 2500
+        try:
+            client = comfy_client.ComfyClient(server.host)
+            self.assertEqual(client.system_stats()["devices"][0]["name"], "fake")
+            self.assertEqual(client.view("out.png", "job-1", "output"), b"x" * 2500)
+
+            async def chunks():
+                stream = comfy_client.get_client(server.host).iter_view(
+                    "out.png", "job-1", "output", chunk_size=1000
+                )
+                result = [len(chunk) async for chunk in stream]
+                await comfy_client.close_clients()
+                return result
+
+            self.assertEqual(sum(asyncio.run(chunks())), 2500)
+            with self.assertRaises(comfy_client.ComfyHTTPError) as raised:
+                client.view("missing.png", "", "output")
+            self.assertEqual(raised.exception.status, 404)
+            with patch.object(handler, "COMFY_HOST", server.host):
+                self.assertIsNone(handler.get_image_data("missing.png", "", "output"))
+        finally:
+            server.stop()
+
+    def test_record_job_trace_writes_anonymized_envelope(self):
+        import tempfile
+
+        job_input = {
+            "workflow": {"3": {"class_type": "KSampler", "inputs": {"text": "secret prompt"}}},
+            "images": [{"name": "a.png", "image": base64.b64encode(b"x" * 300).decode()}],
+        }
+        result = {
+            "images": [{"filename": "secret_00001_.png", "type": "base64", "data": "AAAA"}],
+            "timings": {"gpu_wait_ms": 12.5, "per_output_fetch_ms": {"secret_00001_.png": 3.0}},
+        }
+        trace = {
+            "outputs": [{"bytes": 1234, "video": False}],
+            "node_timeline": [
+                {"node_id": "3", "class_type": "KSampler", "duration_ms": 10.0, "cached": False}
+            ],
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.jsonl")
+            handler.record_job_trace(
+                path, handler._workflow_hashes(job_input), job_input, result, trace
+            )
+            with open(path, encoding="utf-8") as f:
+                raw = f.read()
+
+        self.assertNotIn("secret", raw)
+        envelope = json.loads(raw)
+        self.assertEqual(envelope["input_bytes"], [300])
+        self.assertEqual(envelope["timings"]["per_output_fetch_ms"], [3.0])
+        self.assertEqual(envelope["node_timeline"][0]["class_type"], "KSampler")
+        # Same template with a different prompt keeps the graph hash
+        other = {"workflow": {"3": {"class_type": "KSampler", "inputs": {"text": "other"}}}}
+        self.assertEqual(handler._workflow_hashes(other)[1], envelope["graph_hash"])
+        self.assertNotEqual(handler._workflow_hashes(other)[0], envelope["workflow_hash"])
+
+    def test_memory_profiler_reports_peak_and_output_data(self):
+        profiler = handler.MemoryProfiler(top_sites=3).start()
+        timer = handler.PhaseTimer(profiler)
+        with timer.phase("encode"):
+            held = [bytearray(2 * 1024 * 1024)]
+        report = profiler.report([{"filename": "a.png", "type": "base64", "data": "A" * 1024}])
+
+        self.assertFalse(profiler.started)
+        self.assertIn("encode", report["phases"])
+        self.assertGreaterEqual(report["traced_peak_mb"], 2)
+        self.assertEqual(report["output_data_mb"], round(1024 / (1024 * 1024), 2))
+        self.assertTrue(report["top_sites"][0]["site"].startswith("test_handler.py:"))
+        self.assertGreaterEqual(report["top_sites"][0]["size_kb"], 2048)
+        del held
+
+    @patch("handler.MEMORY_PROFILE_SAMPLE_RATE", 0.0)
+    def test_memory_profile_job_flag(self):
+        self.assertTrue(handler._wants_memory_profile({"memory_profile": True}))
+        self.assertTrue(handler._wants_memory_profile('{"memory_profile": true}'))
+        self.assertFalse(handler._wants_memory_profile({"workflow": {}}))
+
+    def test_async_log_handler_writes_json_with_job_context(self):
+        import io
+        import logging
+
+        stream = io.StringIO()
+        log_handler = handler.AsyncLogHandler(stream=stream, batch_size=8)
+        log_handler.setFormatter(handler.JsonFormatter())
+        test_logger = logging.getLogger("worker-comfyui.test")
+        test_logger.propagate = False
+        test_logger.addHandler(log_handler)
+        try:
+            with handler.log_context(job_id="job-1"):
+                handler.bind_log_context(prompt_id="p-1")
+                test_logger.warning("queued %s", "x", extra={"fields": {"queue_ms": 1.5}})
+            test_logger.warning("outside")
+            log_handler.flush()
+        finally:
+            test_logger.removeHandler(log_handler)
+
+        first, second = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(first["message"], "queued x")
+        self.assertEqual(first["level"], "WARNING")
+        self.assertEqual(first["job_id"], "job-1")
+        self.assertEqual(first["prompt_id"], "p-1")
+        self.assertEqual(first["queue_ms"], 1.5)
+        self.assertNotIn("job_id", second)
+
+    def test_init_worker_runs_timed_steps_once(self):
+        with patch.object(handler, "_initialized", False), patch.object(
+            handler, "startup_timings", {}
+        ), patch("handler.detect_s3_region") as detect, patch(
+            "handler.configure_blip_cache", return_value=(None, None)
+        ):
+            handler.init_worker()
+            handler.init_worker()
+            self.assertEqual(detect.call_count, 1)
+            self.assertEqual(set(handler.startup_timings), {"s3_region", "blip_cache"})
+
+    def test_lazy_module_imports_on_first_attribute_access(self):
+        lazy = handler._LazyModule("json")
+        self.assertIsNone(lazy._module)
+        self.assertEqual(lazy.dumps([1]), "[1]")
+        self.assertIs(lazy._module, json)
@@ -0,0 +1,92 @@
+import unittest
+from unittest.mock import patch
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src import setup_model_symlinks as sms
+
+CONFIG = """\
+comfyui:
+  base_path: /comfyui
+  is_default: true
+  checkpoints: models/checkpoints/
+
+runpod_worker_comfy:
+  base_path: /runpod-volume
+  checkpoints: models/checkpoints/
+  loras: models/loras/  # LoRAs
+  vae: models/vae/
+"""
+
+
+class TestSetupModelSymlinks(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = self.tmp.name
+        self.config = os.path.join(root, "extra_model_paths.yaml")
+        with open(self.config, "w") as f:
+            f.write(CONFIG)
+        self.volume = os.path.join(root, "volume")
+        self.comfy = os.path.join(root, "comfyui")
+        self.state = os.path.join(root, "state.json")
+        os.makedirs(os.path.join(self.volume, "models", "checkpoints"))
+        os.makedirs(os.path.join(self.volume, "models", "loras"))
+        os.makedirs(os.path.join(self.comfy, "models", "loras"))
+        with open(os.path.join(self.comfy, "models", "loras", "local.safetensors"), "w") as f:
+            f.write("x")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_setup(self):
+        return sms.setup_symlinks(
+            self.config, comfy_root=self.comfy, volume_root=self.volume, state_file=self.state
+        )
+
+    def test_load_model_dirs_reads_volume_section(self):
+        base_path, rel_dirs = sms.load_model_dirs(self.config)
+        self.assertEqual(base_path, "/runpod-volume")
+        self.assertEqual(rel_dirs, ["models/checkpoints", "models/loras", "models/vae"])
+
+    def test_simple_parser_matches_yaml(self):
+        with patch.dict(sys.modules, {"yaml": None}):
+            self.assertEqual(
+                sms.load_model_dirs(self.config),
+                ("/runpod-volume", ["models/checkpoints", "models/loras", "models/vae"]),
+            )
+
+    def test_links_created_and_existing_directory_backed_up(self):
+        report = self.run_setup()
+
+        self.assertEqual(report["sources"], 2)  # vae is not on the volume
+        self.assertEqual(report["created"], 1)
+        self.assertEqual(report["backed_up"], 1)
+        for name in ("checkpoints", "loras"):
+            target = os.path.join(self.comfy, "models", name)
+            self.assertEqual(os.readlink(target), os.path.join(self.volume, "models", name))
+        backups = os.listdir(os.path.join(self.comfy, "models", ".backup"))
+        self.assertEqual(len(backups), 1)
+        self.assertTrue(backups[0].startswith("loras."))
+
+    def test_second_run_uses_cached_scan_until_volume_changes(self):
+        self.run_setup()
+        report = self.run_setup()
+        self.assertTrue(report["scan_cached"])
+        self.assertEqual(report["ok"], 2)
+
+        os.makedirs(os.path.join(self.volume, "models", "vae"))
+        report = self.run_setup()
+        self.assertFalse(report["scan_cached"])
+        self.assertEqual((report["ok"], report["created"]), (2, 1))
+
+    def test_wrong_link_is_replaced(self):
+        target = os.path.join(self.comfy, "models", "checkpoints")
+        os.symlink("/nonexistent", target)
+        self.run_setup()
+        self.assertEqual(os.readlink(target), os.path.join(self.volume, "models", "checkpoints"))
+
+
+if __name__ == "__main__":
+    unittest.main()